@@ -1,10 +1,40 @@
+import asyncio
+import multiprocessing
 import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from glob import glob
 
 import fire
 from loguru import logger
-
-from tool.action_execution import chat_with_LLM
+from tqdm import tqdm
+
+from tool import spans as tool_spans
+from tool import trace as tool_trace
+from tool.action_execution import (
+    _advance,
+    _dialog,
+    accept_result,
+    achat_with_LLM,
+    branch_retry,
+    chat_with_LLM,
+    get_init_actions,
+)
+from tool.batch import BatchRequestError, get_batch_runner, run_round
+from tool.checkpoint import compact as compact_checkpoint
+from tool.manifest import get_manifest
+from tool.openai_api import (
+    MAX_ATTEMPTS,
+    set_backend,
+    set_endpoints,
+    set_hedging,
+    set_llm_cache,
+    set_rate_limit,
+)
+from tool.registry import registry
+from tool.result_sink import flush_sinks, set_result_sink
+from tool.tool_cache import set_tool_cache
 from utils import read_json
 
 
@@ -110,10 +140,85 @@ def load_test_data(dataset, add_evidence=False):
 # ------------------------ main ------------------------ #
 
 
-def run(dataset, model_name, debug=False, case_num=None, note="v1", add_evidence=False):
+def run(
+    dataset,
+    model_name,
+    debug=False,
+    case_num=None,
+    note="v1",
+    add_evidence=False,
+    mode="thread",
+    concurrency=20,
+    tool_workers=32,
+    num_procs=4,
+    batch_runner="openai",
+    batch_poll=60,
+    rpm=None,
+    tpm=None,
+    history_budget=None,
+    time_budget=None,
+    prompt_budget=None,
+    completion_budget=None,
+    n=1,
+    stream=False,
+    checkpoint=True,
+    result_sink="json",
+    llm_cache=None,
+    tool_cache=None,
+    trace=None,
+    trace_mode="record",
+    spans=None,
+    endpoints=None,
+    hedge=None,
+    backend="openai",
+    backend_latency=None,
+):
     """
     model_name: ["gpt-4-1106-preview", "llama2-7b-epoch3", ...]
     case_num = 200  # None: unlimit"train"  # "train":xx, "val":xx
+    mode:
+        "thread": one thread per dialog, `concurrency` threads.
+        "async": one event loop, `concurrency` dialogs in flight (e.g. 1000),
+            blocking tools on a pool of `tool_workers` threads.
+        "process": questions grouped by db_id on `num_procs` processes,
+            `concurrency` threads per process.
+        "batch": all dialogs advance one round at a time, each round's LLM
+            requests as one OpenAI Batch file, tools on `tool_workers` threads.
+            `batch_runner`: "openai" (Batch API, polled every `batch_poll` s)
+            or "local" (served by `backend`, for tests).
+    rpm, tpm: requests / tokens per minute quota shared by all dialogs.
+    history_budget: prompt tokens above which old observations are elided, None: off.
+    time_budget, prompt_budget, completion_budget: wall seconds, prompt tokens
+        and completion tokens per dialog, None: unlimited.
+        The round before one runs out is a "finish now" round, the dialog is
+        kept with the best SQL so far instead of being killed at the timeout
+        (300 s, or the time budget + 30 s).
+    n: completions per LLM request, the first one whose action gives a valid
+        observation is kept. The budgets count the tokens of all n.
+    stream: stream completions, cut off at the first complete action, and
+        record the time-to-first-token of every round in `ttft`.
+    checkpoint: append every finished round to `{save_dir}/checkpoint.jsonl`,
+        a restarted run resumes unfinished dialogs from their last round and
+        first drops the rounds of the finished ones from the file.
+    result_sink: how finished dialogs are stored, see tool/result_sink.py.
+        "json": one `{id}.json` per dialog (default), "jsonl": sharded JSONL,
+        "sqlite": one sqlite file in WAL mode.
+    llm_cache: path of the on-disk completion cache (True: default path), None: off.
+    tool_cache: path of the on-disk SearchColumn/SearchValue/FindShortestPath
+        result cache (True: default path), None: off. See tool/tool_cache.py.
+    trace, trace_mode: JSONL trace of every LLM and tool step.
+        "record": write the trace.
+        "replay": serve LLM responses from the trace (no network), run tools for
+            real. Use another `note` so replayed results land in a new save_dir.
+    spans: JSONL of timing spans (LLM requests, tools, queue waits, saves),
+        report with `python -m tool.spans report <spans>`. None: off.
+    endpoints: spread LLM and embedding requests over several OpenAI-compatible
+        endpoints: a JSON file of endpoints or comma separated base URLs, see
+        tool/endpoints.py. None: the one `OPENAI_API_KEY` client.
+    hedge: latency percentile (e.g. 95) after which an LLM request gets a
+        duplicate, the first response wins, see tool/hedging.py. None: off.
+    backend: "openai", or "scripted:<glob of saved dialogs>" to load-test offline
+        with `backend_latency` (e.g. "lognormal:0.5,0.6"), see tool/llm_backend.py.
     """
     assert dataset in [
         "spider-dev",
@@ -134,6 +239,23 @@ def run(dataset, model_name, debug=False, case_num=None, note="v1", add_evidence
     if add_evidence:
         logger.warning("Add evidence.")
 
+    runtime = dict(
+        rpm=rpm,
+        tpm=tpm,
+        result_sink=result_sink,
+        llm_cache=llm_cache,
+        tool_cache=tool_cache,
+        trace=trace,
+        trace_mode=trace_mode,
+        spans=spans,
+        span_resource={"dataset": dataset, "model": model_name, "note": note},
+        endpoints=endpoints,
+        hedge=hedge,
+        backend=backend,
+        backend_latency=backend_latency,
+    )
+    _setup_process(**runtime)
+
     examplars = load_schema_and_examples_dialog(_dname, add_evidence=add_evidence)
     tooldesc = load_tooldesc(_dname, add_evidence=add_evidence)
     data = load_test_data(dataset, add_evidence=add_evidence)
@@ -143,6 +265,11 @@ def run(dataset, model_name, debug=False, case_num=None, note="v1", add_evidence
 
     data = data[:case_num]
 
+    if trace and trace_mode == "replay":
+        trace_ids = tool_trace.replayer.ids()
+        data = [d for d in data if d["id"] in trace_ids]
+        logger.info(f"Replay {len(data)} dialogs from {trace}")
+
     # debug
     # data = [i for i in data if i["id"] == "address-103"]
 
@@ -158,45 +285,395 @@ def run(dataset, model_name, debug=False, case_num=None, note="v1", add_evidence
     save_dir = f"save-crossdb-infer-dialog/{_ds}/{model_name}/{note}"
     logger.info(f"Saving to: {save_dir}")
 
-    skip_ids = []
-    if os.path.exists(save_dir):
-        paths = glob(save_dir + "/*.json")
-        skip_ids += [read_json(p)["id"] for p in paths]
-
-    skip_ids = set(skip_ids)
+    skip_ids = get_manifest(save_dir).completed_ids()
     logger.info(f"Skip id: {len(skip_ids)}")
+    if checkpoint:
+        # before the workers append to it.
+        compact_checkpoint(save_dir, skip_ids)
     data = [d for d in data if d["id"] not in skip_ids]
     logger.info(f"Remain data: {len(data)}")
 
-    from concurrent.futures import ThreadPoolExecutor
-
-    from tqdm import tqdm
-
+    dialog_kwargs = dict(
+        model_name=model_name,
+        save_dir=save_dir,
+        tooldesc_demos=tooldesc_demos,
+        max_round_num=12,
+        dataset=dataset.split("-")[0] if "spider2" not in dataset else dataset,
+        add_evidence=add_evidence,
+        history_budget=history_budget,
+        time_budget=time_budget,
+        prompt_budget=prompt_budget,
+        completion_budget=completion_budget,
+        n=n,
+        stream=stream,
+        checkpoint=checkpoint,
+    )
+    if mode == "thread":
+        _run_threads(data, dialog_kwargs, concurrency=concurrency)
+    elif mode == "process":
+        _run_processes(
+            data,
+            dialog_kwargs,
+            runtime,
+            num_procs=num_procs,
+            concurrency=concurrency,
+        )
+    elif mode == "batch":
+        assert not (trace and trace_mode == "replay"), "replay runs in thread mode."
+        _run_batch(
+            data,
+            dialog_kwargs,
+            batch_runner=batch_runner,
+            batch_poll=batch_poll,
+            tool_workers=tool_workers,
+        )
+    elif mode == "async":
+        asyncio.run(
+            _run_async(
+                data, dialog_kwargs, concurrency=concurrency, tool_workers=tool_workers
+            )
+        )
+    else:
+        raise ValueError(f"mode: {mode} is not supported.")
+    flush_sinks()
+    _report_process()
+
+
+def _setup_process(
+    rpm=None,
+    tpm=None,
+    llm_cache=None,
+    tool_cache=None,
+    trace=None,
+    trace_mode="record",
+    spans=None,
+    span_resource=None,
+    endpoints=None,
+    endpoint_share=1.0,
+    hedge=None,
+    backend="openai",
+    backend_latency=None,
+    result_sink="json",
+):
+    """
+    Process-wide settings, applied in the main process and in every worker.
+    """
+    set_result_sink(result_sink)
+    if rpm or tpm:
+        set_rate_limit(rpm=rpm, tpm=tpm)
+    if llm_cache:
+        set_llm_cache(**({} if llm_cache is True else {"path": llm_cache}))
+    if tool_cache:
+        set_tool_cache(**({} if tool_cache is True else {"path": tool_cache}))
+    if trace:
+        tool_trace.set_trace(trace, mode=trace_mode)
+    if spans:
+        tool_spans.set_spans(spans, **(span_resource or {}))
+    if endpoints:
+        set_endpoints(endpoints, share=endpoint_share)
+    if hedge:
+        set_hedging(quantile=hedge)
+    if backend != "openai":
+        set_backend(backend, latency=backend_latency)
+
+
+def _report_process():
+    from tool import openai_api
+    from tool import tool_cache as tool_cache_module
+
+    logger.info(f"ToolRegistry: {registry.info()}")
+    if openai_api.llm_cache is not None:
+        logger.info(f"LLM cache: {openai_api.llm_cache.info()}")
+    if openai_api.vec_cache is not None:
+        logger.info(f"Embedding cache: {openai_api.vec_cache.info()}")
+    if openai_api.hedger is not None:
+        for model, info in openai_api.hedger.info().items():
+            logger.info(f"Hedging {model}: {info}")
+    if openai_api.pool is not None:
+        for name, info in openai_api.pool.info().items():
+            logger.info(f"Endpoint {name}: {info}")
+    if tool_cache_module.tool_cache is not None:
+        for tool, info in tool_cache_module.tool_cache.info().items():
+            logger.info(f"Tool cache {tool}: {info}")
+    if tool_trace.replayer is not None:
+        logger.info(f"Replay: {tool_trace.replayer.info()}")
+
+
+def _run_threads(data, dialog_kwargs, concurrency=20, progress=True):
+    """
+    Return: (number of finished dialogs, number of failed dialogs)
+    """
     total_items = len(data)
-    with ThreadPoolExecutor(max_workers=20) as executor:
+    ok, failed = 0, 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
         futures = []
         for item in data:
             future = executor.submit(
-                chat_with_LLM,
+                tool_spans.queued(
+                    chat_with_LLM,
+                    "queue.dialog",
+                    **{"dialog.id": item["id"], "db_id": item["db_id"]},
+                ),
                 d=item,
-                model_name=model_name,
-                save_dir=save_dir,
-                tooldesc_demos=tooldesc_demos,
-                max_round_num=12,
-                dataset=dataset.split("-")[0] if "spider2" not in dataset else dataset,
-                add_evidence=add_evidence,
+                **dialog_kwargs,
             )
             futures.append(future)
 
         # Show progress bar
         for future in tqdm(
-            futures, total=total_items, desc="Processing items", ncols=100
+            futures,
+            total=total_items,
+            desc="Processing items",
+            ncols=100,
+            disable=not progress,
         ):
             try:
-                future.result(timeout=300)  # 5 minutes timeout
+                # `chat_with_LLM` enforces the timeout of each dialog.
+                if future.result():
+                    ok += 1
+                else:
+                    failed += 1
             except Exception as e:
                 logger.error(f"Error processing item: {e}")
+                failed += 1
                 continue
+    return ok, failed
+
+
+def _init_worker(runtime):
+    _setup_process(**runtime)
+
+
+def _run_shard(items, dialog_kwargs, concurrency=20):
+    """
+    Worker process: all questions of one db.
+    The per-db tools (chroma collection, schema graph, ES client) are built once
+    here and stay warm in this process for every dialog of the shard.
+    """
+    db = items[0]["db_id"]
+    try:
+        get_init_actions(dialog_kwargs["dataset"])(db=db)
+    except Exception as e:
+        logger.warning(f"Warm-up of db `{db}` failed: {e}")
+    ok, failed = _run_threads(
+        items, dialog_kwargs, concurrency=concurrency, progress=False
+    )
+    flush_sinks()
+    _report_process()
+    return {"db": db, "total": len(items), "ok": ok, "failed": failed}
+
+
+def _merge_shards(stats, save_dir):
+    """
+    Shards write into the result sink of `save_dir` directly, so merging is
+    only a check of the manifest.
+    """
+    saved = get_manifest(save_dir).completed_ids()
+    total = sum(s["total"] for s in stats)
+    ok = sum(s["ok"] for s in stats)
+    failed = sum(s["failed"] for s in stats)
+    for s in sorted(stats, key=lambda s: s["failed"], reverse=True):
+        if s["failed"]:
+            logger.warning(f"db `{s['db']}`: {s['failed']}/{s['total']} failed.")
+    logger.info(
+        f"Merged {len(stats)} shards: {ok}/{total} finished, {failed} failed, "
+        f"{len(saved)} results in {save_dir}"
+    )
+
+
+def _run_processes(data, dialog_kwargs, runtime, num_procs=4, concurrency=20):
+    """
+    Questions grouped by db_id, one group per task on `num_procs` processes,
+    `concurrency` threads per process. The quota is split evenly.
+    """
+    groups = {}
+    for item in data:
+        groups.setdefault(item["db_id"], []).append(item)
+    # largest first, so a big db does not start last.
+    shards = sorted(groups.values(), key=len, reverse=True)
+    logger.info(f"{len(shards)} db shards on {num_procs} processes.")
+
+    worker_runtime = dict(runtime)
+    for k in ["rpm", "tpm"]:
+        if runtime.get(k):
+            worker_runtime[k] = runtime[k] / num_procs
+    worker_runtime["endpoint_share"] = 1 / num_procs
+
+    stats = []
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=num_procs,
+        mp_context=ctx,
+        initializer=_init_worker,
+        initargs=(worker_runtime,),
+    ) as executor:
+        futures = [
+            executor.submit(
+                _run_shard,
+                shard,
+                dialog_kwargs,
+                concurrency=concurrency,
+            )
+            for shard in shards
+        ]
+        with tqdm(total=len(data), desc="Processing items", ncols=100) as pbar:
+            for future in as_completed(futures):
+                try:
+                    s = future.result()
+                except Exception as e:
+                    logger.error(f"Error processing shard: {e}")
+                    continue
+                stats.append(s)
+                pbar.update(s["total"])
+    _merge_shards(stats, dialog_kwargs["save_dir"])
+
+
+async def _run_async(data, dialog_kwargs, concurrency=20, tool_workers=32):
+    """
+    All dialogs on one event loop, at most `concurrency` in flight.
+    Blocking tools (sqlite, chroma, networkx, ES) run on a `tool_workers` pool.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=tool_workers, thread_name_prefix="tool")
+    loop.set_default_executor(executor)
+    sem = asyncio.Semaphore(concurrency)
+
+    async def _one(item):
+        t = time.time_ns()
+        async with sem:
+            tool_spans.record(
+                "queue.dialog",
+                t,
+                time.time_ns(),
+                **{"dialog.id": item["id"], "db_id": item["db_id"]},
+            )
+            try:
+                await achat_with_LLM(d=item, executor=executor, **dialog_kwargs)
+            except Exception as e:
+                logger.error(f"Error processing item: {e}")
+
+    tasks = [asyncio.create_task(_one(item)) for item in data]
+    for task in tqdm(
+        asyncio.as_completed(tasks),
+        total=len(tasks),
+        desc="Processing items",
+        ncols=100,
+    ):
+        await task
+
+
+def _run_batch(
+    data, dialog_kwargs, batch_runner="openai", batch_poll=60, tool_workers=32
+):
+    """
+    All dialogs advance one round at a time: the round's LLM requests go out as
+    one batch (see tool/batch.py), then every dialog runs its tools on a pool
+    of `tool_workers` threads up to its next request.
+    A dialog whose last observation is empty is retried, as in `retry_no_empty`.
+    A request that failed with a retryable error (429, 5xx, expired, ...) goes
+    into the next batch again, up to MAX_ATTEMPTS times as online requests do,
+    other errors are thrown into the dialog.
+    """
+    runner = get_batch_runner(batch_runner, poll_interval=batch_poll)
+    batch_dir = f"{dialog_kwargs['save_dir']}/batch"
+    max_retries = 3
+
+    items = {d["id"]: d for d in data}
+    attempts = {}
+    gens = {}
+
+    def _start(_id, attempt, prefix=None):
+        attempts[_id] = attempt
+        gens[_id] = _dialog(
+            items[_id], cache_salt=attempt or None, prefix=prefix, **dialog_kwargs
+        )
+
+    def _step(_id, value, error):
+        try:
+            with tool_spans.span(
+                "dialog.step",
+                **{
+                    "dialog.id": _id,
+                    "db_id": items[_id]["db_id"],
+                    "dataset": dialog_kwargs["dataset"],
+                    "attempt": attempts[_id],
+                    "round": round_idx,
+                },
+            ):
+                return _advance(gens[_id], value, error, key=(_id, attempts[_id]))
+        except Exception as e:
+            logger.error(f"Error processing item {_id}: {e}")
+            return "done", None
+
+    for _id in items:
+        _start(_id, 0)
+
+    ok, failed = 0, 0
+    inputs = {_id: (None, None) for _id in items}  # id -> (value, error)
+    requeued = {}  # custom_id -> (id, kwargs), sent again in the next round
+    sent = Counter()  # custom_id -> batches it went into
+    round_idx = 0
+    with ThreadPoolExecutor(max_workers=tool_workers) as executor, tqdm(
+        total=len(items), desc="Processing items", ncols=100
+    ) as pbar:
+        while inputs or requeued:
+            requests, requeued = requeued, {}
+            # advance every dialog to its next request, restarting retried ones.
+            while inputs:
+                ids = list(inputs)
+                steps = list(
+                    executor.map(_step, ids, *zip(*[inputs[_id] for _id in ids]))
+                )
+                inputs = {}
+                for _id, (kind, payload) in zip(ids, steps):
+                    if kind == "llm":
+                        custom_id = f"{_id}-{attempts[_id]}-{round_idx}"
+                        requests[custom_id] = (_id, payload)
+                        continue
+                    if payload is None:
+                        failed += 1
+                    elif accept_result(
+                        payload, dialog_kwargs["save_dir"], attempts[_id], max_retries
+                    ):
+                        ok += 1
+                    else:
+                        attempt = attempts[_id] + 1
+                        _start(_id, attempt, branch_retry(payload, attempt))
+                        inputs[_id] = (None, None)
+                        continue
+                    pbar.update(1)
+
+            if not requests:
+                break
+            with tool_spans.span(
+                "batch.round", round=round_idx, **{"batch.requests": len(requests)}
+            ):
+                responses = run_round(
+                    runner,
+                    {
+                        c: (kwargs, (_id, attempts[_id]))
+                        for c, (_id, kwargs) in requests.items()
+                    },
+                    batch_dir,
+                    round_idx,
+                )
+            for custom_id, (_id, _) in requests.items():
+                response = responses[custom_id]
+                sent[custom_id] += 1
+                if (
+                    isinstance(response, BatchRequestError)
+                    and response.retryable
+                    and sent[custom_id] < MAX_ATTEMPTS
+                ):
+                    logger.warning(f"{custom_id}: {response}, retry in the next round.")
+                    requeued[custom_id] = requests[custom_id]
+                elif isinstance(response, Exception):
+                    inputs[_id] = (None, response)
+                else:
+                    inputs[_id] = (response, None)
+            round_idx += 1
+    logger.info(f"Batch mode: {ok} finished, {failed} failed in {round_idx} rounds.")
+    return ok, failed
 
 
 def is_vscode_debug_mode():
@@ -220,6 +697,45 @@ if __name__ == "__main__":
     python interactive_text_to_sql.py --dataset "spider-realistic" --model_name "gpt-4o-2024-05-13" --debug True
     python interactive_text_to_sql.py --dataset "spider-syn" --model_name "gpt-4o-2024-05-13" --debug True
 
+    # record a run, then replay it offline to profile the tools
+    python interactive_text_to_sql.py --dataset "spider-dev" --model_name "gpt-4o-2024-05-13" --trace trace/spider-dev.jsonl
+    python interactive_text_to_sql.py --dataset "spider-dev" --model_name "gpt-4o-2024-05-13" --trace trace/spider-dev.jsonl --trace_mode replay --note replay
+
+    # load test with an offline stand-in LLM
+    python interactive_text_to_sql.py --dataset "spider-dev" --model_name "gpt-4o-2024-05-13" --mode async --concurrency 500 --backend "scripted:save-crossdb-infer-dialog/spider-dev/gpt-4o-2024-05-13/v1/*.json" --backend_latency "lognormal:0.5,0.6" --note loadtest
+
+    # reuse tool results across runs on the same databases (spider-dev/syn/realistic/dk)
+    python interactive_text_to_sql.py --dataset "spider-syn" --model_name "gpt-4o-2024-05-13" --tool_cache True
+
+    # large sweep, results as sharded JSONL instead of one file per dialog
+    python interactive_text_to_sql.py --dataset "bird-dev" --model_name "gpt-4o-2024-05-13" --result_sink jsonl
+
+    # predictable tail latency and cost: finish every dialog within 120 s and 40k prompt tokens
+    python interactive_text_to_sql.py --dataset "bird-dev" --model_name "gpt-4o-2024-05-13" --time_budget 120 --prompt_budget 40000
+
+    # scale out over several endpoints (orgs, replicas), see tool/endpoints.py
+    python interactive_text_to_sql.py --dataset "bird-dev" --model_name "gpt-4o-2024-05-13" --endpoints endpoints.json --mode async --concurrency 500
+
+    # cut the stragglers of a sweep: duplicate LLM requests slower than the running p95
+    python interactive_text_to_sql.py --dataset "bird-dev" --model_name "gpt-4o-2024-05-13" --endpoints endpoints.json --hedge 95
+
+    # where does a slow run spend its time: spans of every LLM request, tool call, queue wait and save
+    python interactive_text_to_sql.py --dataset "spider-dev" --model_name "gpt-4o-2024-05-13" --spans trace/spider-dev.spans.jsonl
+    python -m tool.spans report trace/spider-dev.spans.jsonl
+
+    # stream completions, stop reading at the first complete action
+    python interactive_text_to_sql.py --dataset "spider-dev" --model_name "gpt-4o-2024-05-13" --stream True
+
+    # process runner, 8 processes sharded by db_id
+    python interactive_text_to_sql.py --dataset "spider-test" --model_name "gpt-4o-2024-05-13" --mode process --num_procs 8
+
+    # batch runner, one OpenAI Batch per round, test it offline with the local stand-in
+    python interactive_text_to_sql.py --dataset "bird-dev" --model_name "gpt-4o-2024-05-13" --mode batch
+    python interactive_text_to_sql.py --dataset "spider-dev" --model_name "gpt-4o-2024-05-13" --mode batch --batch_runner local --backend "scripted:save-crossdb-infer-dialog/spider-dev/gpt-4o-2024-05-13/v1/*.json" --note batchtest
+
+    # async runner, 1000 dialogs in flight
+    python interactive_text_to_sql.py --dataset "spider-test" --model_name "gpt-4o-2024-05-13" --mode async --concurrency 1000
+
     # ---------------------------- bird ---------------------------- #
     bird-dev(1534)
 
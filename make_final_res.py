@@ -1,7 +1,7 @@
 import json
 import os
-from glob import glob
 
+from tool.result_sink import read_results
 from tool.utils import extract_last_valid_sql, rewrite_sql_rm_cast
 
 
@@ -14,8 +14,13 @@ def post_process_sql(sql):
     return sql
 
 
+def _pred_sql(d):
+    # a dialog stopped by its budget keeps the best SQL it found.
+    return d.get("budget", {}).get("best_sql") or extract_last_valid_sql(d["dialog"])
+
+
 def get_final_sql(d):
-    pred_sql = extract_last_valid_sql(d["dialog"])
+    pred_sql = _pred_sql(d)
     pred_sql = post_process_sql(pred_sql)
     return pred_sql
 
@@ -67,11 +72,10 @@ def spider():
 
         # pred
         p1 = f"save-crossdb-infer-dialog/spider-{split}/gpt-4o-2024-05-13/v1"
-        paths = glob(p1 + "/*.json")
-        assert paths, f"No data found in {p1}"
+        results = read_results(p1)
+        assert results, f"No data found in {p1}"
         pred_q_sql = {}
-        for p in paths:
-            d = json.load(open(p))
+        for d in results.values():
             pred_q_sql[d["question"]] = get_final_sql(d)
         pred_sqls = [pred_q_sql[q] for q in questions]
         assert len(goldens) == len(pred_sqls), f"{len(goldens)} {len(pred_sqls)}"
@@ -137,15 +141,12 @@ def bird():
             p1 = (
                 f"save-crossdb-infer-dialog/bird-{split}-{setting}/gpt-4o-2024-05-13/v1"
             )
-            paths = glob(p1 + "/*.json")
-            assert paths, f"No data found in {p1}"
+            results = read_results(p1)
+            assert results, f"No data found in {p1}"
             pred_q_sql = {}
-            for p in paths:
-                d = json.load(open(p))
+            for d in results.values():
                 pred_q_sql[d["question"]] = (
-                    extract_last_valid_sql(d["dialog"])
-                    + "\t----- bird -----\t"
-                    + d["db_id"]
+                    _pred_sql(d) + "\t----- bird -----\t" + d["db_id"]
                 )
 
             pred_data = {idx: pred_q_sql[q] for idx, q in enumerate(questions)}
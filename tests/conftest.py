@@ -0,0 +1,148 @@
+import asyncio
+import os
+import sqlite3
+import time
+
+import pytest
+
+from tool import action_execution, openai_api
+
+"""
+Offline stand-ins for the dialog tests: a word tokenizer instead of tiktoken,
+a scripted `chatgpt` and stub tools, in a scratch working directory.
+"""
+
+TOOLDESC = "You answer questions about the database with the tools."
+
+
+class WordTokenizer:
+    """
+    One token per word, tiktoken's encoding needs a download.
+    """
+
+    def encode(self, text):
+        return text.split()
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    monkeypatch.setattr(openai_api, "chatgpt_tok", WordTokenizer())
+    openai_api._count_tokens.cache_clear()
+    yield
+    openai_api._count_tokens.cache_clear()
+
+
+def execute_sql_reply(i):
+    return f'Thought: try query {i}.\nAction: ExecuteSQL("SELECT {i}")'
+
+
+class StubLLM:
+    """
+    `chatgpt` stand-in: round i answers `reply(i)`, after `latency` seconds.
+    `reply(i)` is one completion, sent n times, or a list of the n completions.
+    Prompt tokens are counted like `count_message_tokens`.
+    """
+
+    def __init__(self, reply=execute_sql_reply, latency=0.0, completion_tokens=10):
+        self.reply = reply
+        self.latency = latency
+        self.completion_tokens = completion_tokens
+        self.requests = []
+
+    def __call__(self, **request):
+        time.sleep(self.latency)
+        return self._respond(request)
+
+    async def acall(self, **request):
+        await asyncio.sleep(self.latency)
+        return self._respond(request)
+
+    def _respond(self, request):
+        self.requests.append(request)
+        i = sum(m["role"] == "assistant" for m in request["messages"])
+        replies = self.reply(i)
+        if isinstance(replies, str):
+            replies = [replies] * (request.get("n") or 1)
+        return {
+            "choices": [{"message": {"content": r}} for r in replies],
+            "usage": {
+                "prompt_tokens": openai_api.count_message_tokens(request["messages"]),
+                "completion_tokens": self.completion_tokens * len(replies),
+            },
+        }
+
+
+class StubTool:
+    def __init__(self, result="[('ok',)]"):
+        self.result = result
+        self.calls = []
+        self.flag = False
+
+    def __call__(self, *args, **kwargs):
+        self.calls.append(args)
+        return self.result(*args) if callable(self.result) else self.result
+
+    def set_flag(self):
+        self.flag = True
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("database/dbs_info/spider")
+    with open("database/dbs_info/spider/db1.md", "w") as f:
+        f.write("CREATE TABLE singer (name text, age int)")
+    return tmp_path
+
+
+@pytest.fixture
+def stub_dialog(workdir, monkeypatch):
+    """
+    llm, tools = stub_dialog(StubLLM(...), execute_sql=StubTool(...))
+    """
+
+    def setup(llm, execute_sql=None):
+        tools = [StubTool(), StubTool(), StubTool(), execute_sql or StubTool()]
+        monkeypatch.setattr(action_execution, "chatgpt", llm)
+        monkeypatch.setattr(action_execution, "achatgpt", llm.acall)
+        monkeypatch.setattr(
+            action_execution, "get_init_actions", lambda dataset: lambda db: tools
+        )
+        return llm, tools
+
+    return setup
+
+
+@pytest.fixture
+def singer_db(workdir):
+    """
+    db1 of the spider test databases, for the real ExecuteSQL.
+    """
+    os.makedirs("dataset/spider/test_database/db1")
+    conn = sqlite3.connect("dataset/spider/test_database/db1/db1.sqlite")
+    conn.execute("CREATE TABLE singer (name text, age int, country text)")
+    conn.executemany(
+        "INSERT INTO singer VALUES (?, ?, ?)",
+        [("Joe", 30, "France"), ("Ann", 41, "Spain"), ("Tom", 25, "France")],
+    )
+    conn.commit()
+    conn.close()
+
+
+def dialog_args(workdir, **kwargs):
+    """
+    Arguments of `_dialog` / `chat_with_LLM` for one question on db1.
+    """
+    args = dict(
+        d={"id": "q1", "db_id": "db1", "question": "How many singers?"},
+        model_name="gpt-4o-2024-05-13",
+        dataset="spider",
+        save_dir=str(workdir / "save"),
+        tooldesc_demos=TOOLDESC,
+    )
+    args.update(kwargs)
+    return args
+
+
+def make_dialog(workdir, **kwargs):
+    return action_execution._dialog(**dialog_args(workdir, **kwargs))
@@ -0,0 +1,87 @@
+import pytest
+
+from tool.action_execution import parse_action
+from tool.action_parser import ActionSyntaxError, parse_call
+
+
+@pytest.mark.parametrize(
+    "action, args, kwargs",
+    [
+        ('ExecuteSQL("SELECT name FROM singer")', ("SELECT name FROM singer",), {}),
+        (
+            'SearchColumn(["singer name", "age"], topk=5)',
+            (["singer name", "age"],),
+            {"topk": 5},
+        ),
+        (
+            'FindShortestPath(start="singer.name", end=["concert.year"])',
+            (),
+            {"start": "singer.name", "end": ["concert.year"]},
+        ),
+        (
+            "SearchValue(('a', -1, 2.5, None, True), {'k': {1, 2}})",
+            (("a", -1, 2.5, None, True), {"k": {1, 2}}),
+            {},
+        ),
+    ],
+)
+def test_literal_arguments(action, args, kwargs):
+    assert parse_call(action) == (action.split("(")[0], args, kwargs)
+
+
+@pytest.mark.parametrize(
+    "action, error",
+    [
+        (
+            'ExecuteSQL("a" + "b")',
+            "argument 1 of ExecuteSQL must be a literal (string, number, list, ...), "
+            "got `'a' + 'b'` at column 12",
+        ),
+        (
+            "ExecuteSQL(open('/etc/passwd').read())",
+            "got `open('/etc/passwd').read()` at column 12",
+        ),
+        ("SearchColumn(query)", "argument 1 of SearchColumn must be a literal"),
+        ("SearchColumn(topk=os.sep)", "got `os.sep` at column 19"),
+        ("SearchColumn(*['a'])", "`*` arguments are not supported in SearchColumn"),
+        (
+            "SearchColumn(**{'query': 'a'})",
+            "`**` arguments are not supported in SearchColumn",
+        ),
+        ('RunShell("ls")', "unknown tool `RunShell`"),
+        ('ExecuteSQL.__class__("x")', "unknown tool `ExecuteSQL.__class__`"),
+        ("__import__('os').system('ls')", "unknown tool `__import__('os').system`"),
+        ('"SELECT 1"', "expected `Tool(...)`"),
+        ('ExecuteSQL("SELECT 1"', "invalid syntax at column 11"),
+        ("ExecuteSQL({[1]: 2})", "got `{[1]: 2}` at column 12"),
+        ("ExecuteSQL(" + "-" * 100000 + "1)", "invalid action"),
+        (
+            'ExecuteSQL("\x00")',
+            "invalid syntax: source code string cannot contain null bytes",
+        ),
+    ],
+)
+def test_rejected(action, error):
+    with pytest.raises(ActionSyntaxError) as e:
+        parse_call(action)
+    assert error in str(e.value)
+
+
+def test_rejected_action_is_an_observation():
+    obs = parse_action(
+        "Thought: x\nAction: ExecuteSQL({[1]: 2})", execute=True, _actions=[None] * 4
+    )
+    assert obs.startswith("Error: Action parsing error. ActionSyntaxError:")
+
+
+def test_cached_parse_is_not_mutated():
+    action = 'SearchColumn(["name", "age"], options={"topk": 5})'
+    _, args, kwargs = parse_call(action)
+    args[0].append("country")
+    kwargs["options"]["topk"] = 50
+
+    assert parse_call(action) == (
+        "SearchColumn",
+        (["name", "age"],),
+        {"options": {"topk": 5}},
+    )
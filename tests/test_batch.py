@@ -0,0 +1,108 @@
+import json
+from collections import Counter
+
+import pytest
+from conftest import StubLLM, StubTool, dialog_args
+
+import interactive_text_to_sql
+from tool import openai_api
+from tool.batch import BatchRequestError, LocalBatch, read_batch_output
+from tool.openai_api import MAX_ATTEMPTS
+
+
+def test_batch_errors_are_classified(tmp_path):
+    lines = [
+        {"custom_id": "ok", "response": {"status_code": 200, "body": {"id": 1}}},
+        {"custom_id": "429", "response": {"status_code": 429, "body": {}}},
+        {"custom_id": "503", "response": {"status_code": 503, "body": None}},
+        {"custom_id": "400", "response": {"status_code": 400, "body": {}}},
+        {"custom_id": "expired", "error": {"code": "batch_expired"}},
+        {"custom_id": "invalid", "error": {"code": "invalid_request"}},
+    ]
+    path = tmp_path / "output.jsonl"
+    path.write_text("\n".join(json.dumps(line) for line in lines))
+
+    output = read_batch_output(path)
+
+    assert output["ok"] == {"id": 1}
+    retryable = {
+        c: r.retryable for c, r in output.items() if isinstance(r, BatchRequestError)
+    }
+    assert retryable == {
+        "429": True,
+        "503": True,
+        "400": False,
+        "expired": True,
+        "invalid": False,
+    }
+
+
+def run_batch(workdir, stub_dialog, monkeypatch, fail):
+    """
+    Run three dialogs in batch mode. fail(question id, times sent before) -> an
+    error to return instead of the response, or None.
+    """
+    llm, _ = stub_dialog(StubLLM(), execute_sql=StubTool())
+    sent = Counter()
+
+    def fake_run_round(runner, requests, batch_dir, round_idx):
+        results = {}
+        for custom_id, (kwargs, key) in requests.items():
+            error = fail(key[0], sent[custom_id])
+            sent[custom_id] += 1
+            results[custom_id] = error or llm._respond(kwargs)
+        return results
+
+    monkeypatch.setattr(interactive_text_to_sql, "run_round", fake_run_round)
+    kwargs = dialog_args(workdir, max_round_num=2)
+    d = kwargs.pop("d")
+    data = [{**d, "id": f"q{i}"} for i in range(3)]
+    return interactive_text_to_sql._run_batch(data, kwargs, batch_runner="local"), sent
+
+
+def test_retryable_errors_go_into_the_next_round(workdir, stub_dialog, monkeypatch):
+    def fail(_id, times):
+        if _id == "q0" and times < 2:
+            return BatchRequestError("429", retryable=True)
+        if _id == "q1":
+            return BatchRequestError("400", retryable=False)
+
+    (ok, failed), sent = run_batch(workdir, stub_dialog, monkeypatch, fail)
+
+    assert (ok, failed) == (2, 1)
+    # q0's first request went out three times, q1 failed after one.
+    assert sent["q0-0-0"] == 3
+    assert [c for c in sent if c.startswith("q1")] == ["q1-0-0"]
+
+
+def test_retries_are_bounded(workdir, stub_dialog, monkeypatch):
+    def fail(_id, times):
+        if _id == "q0":
+            return BatchRequestError("batch_expired", retryable=True)
+
+    (ok, failed), sent = run_batch(workdir, stub_dialog, monkeypatch, fail)
+
+    assert (ok, failed) == (2, 1)
+    assert sent["q0-0-0"] == MAX_ATTEMPTS
+
+
+def test_local_batch_reports_status_codes(tmp_path, monkeypatch):
+    class StatusError(Exception):
+        status_code = 429
+
+    class Backend:
+        def chat(self, body):
+            if body["n"] == 1:
+                raise StatusError("slow down")
+            raise ValueError("bad body")
+
+    monkeypatch.setattr(openai_api, "backend", Backend())
+    inp = tmp_path / "input.jsonl"
+    inp.write_text(
+        "\n".join(json.dumps({"custom_id": f"r{n}", "body": {"n": n}}) for n in (1, 2))
+    )
+
+    output = read_batch_output(LocalBatch().run(inp, tmp_path / "output.jsonl"))
+
+    assert output["r1"].retryable
+    assert not output["r2"].retryable
@@ -0,0 +1,54 @@
+from conftest import StubLLM, StubTool, make_dialog
+
+from tool.action_execution import (
+    _drive,
+    branch_retry,
+    last_observation,
+    round_records,
+)
+
+
+def rows_until(n):
+    """
+    ExecuteSQL stand-in: "SELECT i" returns a row for i <= n, nothing after.
+    """
+
+    def execute_sql(sql, *args):
+        return "[('x',)]" if int(sql.strip('"').split()[-1]) <= n else "[]"
+
+    return execute_sql
+
+
+def test_dialog_cut_off_at_max_round_num(workdir, stub_dialog):
+    stub_dialog(StubLLM(), execute_sql=StubTool(rows_until(1)))
+
+    d = _drive(make_dialog(workdir, max_round_num=4))
+
+    # no stop message, the dialog ends on the observation of round 4.
+    assert d["dialog"][-1]["content"] == "Observation: []"
+    records = round_records(d)
+    assert [r["round_idx"] for r in records] == [1, 2, 3, 4]
+    assert records[-1]["last_out"].endswith('ExecuteSQL("SELECT 3")')
+    assert [r["prompt_tokens"] for r in records] == d["prompt_tokens"]
+    assert last_observation(d["dialog"]) == "[]"
+
+    prefix = branch_retry(d, 1)
+    assert prefix == records[:2]
+    assert d["branches"][-1]["round"] == 2
+
+
+def test_dialog_ending_on_done(workdir, stub_dialog):
+    def reply(i):
+        if i < 2:
+            return f'Thought: try query {i}.\nAction: ExecuteSQL("SELECT {i}")'
+        return "Thought: the query answers it.\nAction: Done"
+
+    stub_dialog(StubLLM(reply), execute_sql=StubTool(rows_until(0)))
+
+    d = _drive(make_dialog(workdir, max_round_num=4))
+
+    assert d["dialog"][-1]["content"] == "Stop condition detected."
+    records = round_records(d)
+    assert len(records) == 2
+    assert last_observation(d["dialog"]) == "[]"
+    assert branch_retry(d, 1) == records[:1]
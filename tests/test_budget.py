@@ -0,0 +1,86 @@
+import pytest
+from conftest import StubLLM, StubTool, make_dialog
+
+from tool.action_execution import FINISH_PROMPT, _drive
+
+# every round adds ~1000 tokens of observation to the history it resends.
+BIG_RESULT = " ".join(["x"] * 1000)
+
+
+def run(workdir, **kwargs):
+    return _drive(make_dialog(workdir, **kwargs))
+
+
+@pytest.mark.parametrize("budget", [20, 500, 2000, 3000, 5000, 9000, 20000])
+def test_prompt_budget_is_never_exceeded(stub_dialog, workdir, budget):
+    llm, _ = stub_dialog(StubLLM(), execute_sql=StubTool(BIG_RESULT))
+    d = run(workdir, prompt_budget=budget)
+    assert sum(d["prompt_tokens"]) <= budget
+    assert d["budget"]["stopped"] == "prompt_tokens"
+    assert d["dialog"][-1]["content"] == "STOP because of budget."
+
+
+def test_finish_round_fits_growing_prompts(stub_dialog, workdir):
+    # rounds of ~1000, ~2000, ~3000 tokens: 1000 + 2000 + 3000 would overrun
+    # 5000, so the second round is the last one and asks the model to finish.
+    llm, _ = stub_dialog(StubLLM(), execute_sql=StubTool(BIG_RESULT))
+    d = run(workdir, prompt_budget=5000, tooldesc_demos=BIG_RESULT)
+    assert len(llm.requests) == 2
+    assert sum(d["prompt_tokens"]) <= 5000
+    assert llm.requests[-1]["messages"][-1]["content"].endswith(FINISH_PROMPT)
+    assert d["budget"]["best_sql"] == "SELECT 1"
+
+
+def test_no_request_if_the_first_one_does_not_fit(stub_dialog, workdir):
+    llm, _ = stub_dialog(StubLLM())
+    d = run(workdir, prompt_budget=10)
+    assert llm.requests == []
+    assert d["prompt_tokens"] == []
+    assert d["budget"]["best_sql"] is None
+
+
+def test_without_budget_runs_to_max_round_num(stub_dialog, workdir):
+    llm, _ = stub_dialog(StubLLM())
+    d = run(workdir, max_round_num=4)
+    assert len(llm.requests) == 4
+    assert "budget" not in d
+
+
+class OverReporting(StubLLM):
+    """
+    Reports 20% more prompt tokens than `count_message_tokens` counts, as an
+    API whose tokenizer or message overhead differs from the local estimate.
+    """
+
+    def _respond(self, request):
+        response = super()._respond(request)
+        response["usage"]["prompt_tokens"] = int(
+            response["usage"]["prompt_tokens"] * 1.2
+        )
+        return response
+
+
+@pytest.mark.parametrize("budget", [500, 2000, 3000, 3400, 5000, 9000, 20000])
+def test_prompt_budget_holds_when_usage_is_over_reported(stub_dialog, workdir, budget):
+    llm, _ = stub_dialog(OverReporting(), execute_sql=StubTool(BIG_RESULT))
+    d = run(workdir, prompt_budget=budget, tooldesc_demos=BIG_RESULT)
+    assert sum(d["prompt_tokens"]) <= budget
+    assert d["budget"]["stopped"] == "prompt_tokens"
+
+
+def test_projection_follows_the_reported_usage(stub_dialog, workdir):
+    # rounds of ~1200, ~2400 reported tokens. Counted locally the second one is
+    # ~2000 and would fit 3400, reported it does not: it is not sent.
+    llm, _ = stub_dialog(OverReporting(), execute_sql=StubTool(BIG_RESULT))
+    d = run(workdir, prompt_budget=3400, tooldesc_demos=BIG_RESULT)
+    assert len(llm.requests) == 1
+    assert d["dialog"][-1]["content"] == "STOP because of budget."
+
+
+def test_finish_round_fits_over_reported_usage(stub_dialog, workdir):
+    # ~1200 + ~2400 + ~3600 would overrun 5000: the second round is the last.
+    llm, _ = stub_dialog(OverReporting(), execute_sql=StubTool(BIG_RESULT))
+    d = run(workdir, prompt_budget=5000, tooldesc_demos=BIG_RESULT)
+    assert len(llm.requests) == 2
+    assert llm.requests[-1]["messages"][-1]["content"].endswith(FINISH_PROMPT)
+    assert sum(d["prompt_tokens"]) <= 5000
@@ -0,0 +1,86 @@
+from collections import Counter
+
+import pytest
+from conftest import StubLLM, StubTool, make_dialog
+
+from tool.action_execution import _drive, _execute_candidates, parse_action
+from tool.spider_execution import create_execute_sql
+
+
+def actions():
+    return [
+        StubTool("[('singer.name',)]"),
+        StubTool(),
+        StubTool(),
+        create_execute_sql("db1"),
+    ]
+
+
+def candidate(action):
+    return f"Thought: try it.\nAction: {action}"
+
+
+ALIASED = 'ExecuteSQL("SELECT T1.name FROM singer AS T1")'
+ALIASED_2 = 'ExecuteSQL("SELECT T2.age FROM singer AS T2")'
+PLAIN = 'ExecuteSQL("SELECT name FROM singer")'
+MULTI = 'ExecuteSQL("SELECT name, age FROM singer")'
+SEARCH = 'SearchColumn("name")'
+
+
+@pytest.mark.parametrize(
+    "calls",
+    [
+        [ALIASED, ALIASED],
+        [ALIASED, ALIASED_2, ALIASED],
+        [PLAIN, ALIASED, PLAIN, ALIASED],
+        [MULTI, MULTI, PLAIN],
+        [SEARCH, ALIASED, SEARCH, 'ExecuteSQL("SELECT  T1.name FROM singer AS T1")'],
+    ],
+)
+def test_observations_match_sequential_execution(singer_db, calls):
+    contents = [candidate(c) for c in calls]
+    sequential_actions = actions()
+    expected = [
+        parse_action(c, execute=True, _actions=sequential_actions) for c in contents
+    ]
+
+    stats = Counter()
+    got = _drive(_execute_candidates(contents, actions(), {}, stats))
+
+    assert got == expected
+    assert stats["candidates"] == len(contents)
+    assert stats["executed"] <= len(contents)
+
+
+def test_repeated_plain_results_run_once(singer_db):
+    contents = [candidate(c) for c in [PLAIN, SEARCH, PLAIN, SEARCH]]
+    tools = actions()
+    memo, stats = {}, Counter()
+
+    first = _drive(_execute_candidates(contents, tools, memo, stats))
+    again = _drive(_execute_candidates(contents, tools, memo, stats))
+
+    assert first == again
+    assert len(tools[0].calls) == 1
+    assert stats["executed"] == 2
+
+
+def test_dialog_keeps_a_valid_one_of_n(stub_dialog, workdir):
+    def reply(i):
+        if i:
+            return "Thought: done.\nAction: Done"
+        return [candidate('ExecuteSQL("SELECT bad")')] + [candidate(PLAIN)] * 2
+
+    def execute_sql(sql):
+        return "Error: no such column: bad" if "bad" in sql else "[('Joe',)]"
+
+    llm, _ = stub_dialog(
+        StubLLM(reply, completion_tokens=10), execute_sql=StubTool(execute_sql)
+    )
+    d = _drive(make_dialog(workdir, n=3))
+
+    assert [r["n"] for r in llm.requests] == [3, 3]
+    assert d["dialog"][-4]["content"].endswith(PLAIN)
+    assert d["dialog"][-3]["content"] == "Observation: [('Joe',)]"
+    # the usage of a round covers all n completions.
+    assert d["completion_tokens"] == [30, 30]
@@ -0,0 +1,120 @@
+import os
+
+import pytest
+from conftest import StubLLM, make_dialog
+
+from tool import checkpoint
+from tool.action_execution import _drive, _restore_flags
+from tool.checkpoint import Checkpoint, compact, get_checkpoint
+from tool.spider_execution import create_execute_sql
+
+
+def record(round_idx):
+    return {"round_idx": round_idx, "messages": [], "last_out": "Thought: é"}
+
+
+def test_torn_trailing_line_is_skipped(tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    ckpt = Checkpoint(path)
+    ckpt.append(("q1", 0), record(1))
+    ckpt.append(("q1", 0), record(2))
+    # a crash in the middle of the third line, inside a 2-byte character.
+    with open(path, "ab") as f:
+        f.write(
+            '{"id": "q1", "attempt": 0, "round_idx": 3, "last_out": "é'.encode()[:-1]
+        )
+
+    ckpt = Checkpoint(path)
+    assert [r["round_idx"] for r in ckpt.rounds(("q1", 0))] == [1, 2]
+
+    ckpt.append(("q1", 0), record(3))
+    assert [r["round_idx"] for r in Checkpoint(path).rounds(("q1", 0))] == [1, 2, 3]
+
+
+@pytest.mark.parametrize("fsync, expected", [(None, 2), (True, 2), (False, 0)])
+def test_append_fsyncs(tmp_path, monkeypatch, fsync, expected):
+    synced = []
+    monkeypatch.setattr(os, "fsync", synced.append)
+    monkeypatch.setattr(checkpoint, "FSYNC", True)
+
+    ckpt = Checkpoint(str(tmp_path / "checkpoint.jsonl"), fsync=fsync)
+    ckpt.append(("q1", 0), record(1))
+    ckpt.append(("q1", 0), record(2))
+
+    assert len(synced) == expected
+
+
+def test_compact_drops_finished_dialogs(tmp_path, monkeypatch):
+    monkeypatch.setattr(checkpoint, "_checkpoints", {})
+    save_dir = str(tmp_path)
+    ckpt = get_checkpoint(save_dir)
+    for _id in ("q1", "q2", "q3"):
+        ckpt.append((_id, 0), record(1))
+        ckpt.append((_id, 1), record(1))
+    with open(ckpt.path, "ab") as f:
+        f.write(b'{"id": "q2", "attempt": 0, "round_idx": 2, "la')
+
+    assert compact(save_dir, {"q1", "q3"}) == 5
+    assert compact(save_dir, {"q1", "q3"}) == 0
+
+    ckpt = get_checkpoint(save_dir)
+    assert sorted(ckpt._rounds) == [("q2", 0), ("q2", 1)]
+    # the new log appends to the compacted file.
+    ckpt.append(("q2", 0), record(2))
+    rounds = Checkpoint(ckpt.path).rounds(("q2", 0))
+    assert [r["round_idx"] for r in rounds] == [1, 2]
+
+
+ALIASED = 'Thought: x.\nAction: ExecuteSQL("SELECT T1.name FROM singer AS T1")'
+
+
+def test_resume_keeps_the_alias_hint_given(
+    stub_dialog, singer_db, workdir, monkeypatch
+):
+    """
+    Round 0 used up the one-shot table alias hint (its first candidate got it,
+    the same SQL run again got the rows), round 1 has to get the empty result
+    of its aliased SQL in the resumed dialog too, not the hint.
+    """
+
+    def reply(i):
+        return ALIASED if i == 0 else ALIASED.replace('T1")', 'T1 WHERE T1.age > 99")')
+
+    def dialog(save_dir, max_round_num):
+        stub_dialog(StubLLM(reply), execute_sql=create_execute_sql("db1"))
+        d = make_dialog(
+            workdir,
+            save_dir=str(workdir / save_dir),
+            checkpoint=True,
+            max_round_num=max_round_num,
+        )
+        return _drive(d)["dialog"]
+
+    monkeypatch.setattr(checkpoint, "_checkpoints", {})
+    whole = dialog("whole", max_round_num=2)
+    dialog("resumed", max_round_num=1)
+    monkeypatch.setattr(checkpoint, "_checkpoints", {})  # a new process
+    resumed = dialog("resumed", max_round_num=2)
+
+    assert whole[-1]["content"] == "Observation: []"
+    assert resumed == whole
+
+
+@pytest.mark.parametrize(
+    "obs, flag, alias_flag",
+    [
+        ("[('Joe',)]", False, False),
+        ("[('Joe', 30)] (Hint: DOUBLE-CHECK the columns ...)", True, False),
+        (
+            "Error. Do not use table alias, please write the full table name.",
+            False,
+            True,
+        ),
+    ],
+)
+def test_flags_of_rounds_without_them(obs, flag, alias_flag):
+    execute_sql = create_execute_sql("db1")
+    r = {"messages": [{"content": ALIASED}, {"content": "Observation: " + obs}]}
+    _restore_flags(execute_sql, r)
+    assert execute_sql.get_flag() == (not flag)
+    assert execute_sql.get_alias_flag() == (not alias_flag)
@@ -0,0 +1,48 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from conftest import StubLLM, dialog_args
+
+from tool import action_execution
+from tool.action_execution import chat_with_LLM
+
+LATENCY = 0.2
+
+
+def chat(workdir, i, max_round_num=2):
+    d = {"id": f"q{i}", "db_id": "db1", "question": "How many singers?"}
+    return chat_with_LLM(**dialog_args(workdir, d=d, max_round_num=max_round_num))
+
+
+def timed(func):
+    t = time.monotonic()
+    func()
+    return time.monotonic() - t
+
+
+def test_concurrent_dialogs_take_one_dialog_latency(stub_dialog, workdir):
+    stub_dialog(StubLLM(latency=LATENCY))
+    one = timed(lambda: chat(workdir, 0))
+    assert one >= 2 * LATENCY
+
+    n = 20
+    with ThreadPoolExecutor(max_workers=n) as executor:
+        wall = timed(lambda: list(executor.map(lambda i: chat(workdir, i), range(n))))
+    # concurrent callers never queue behind each other in `timeout`.
+    assert wall < 1.5 * one
+
+
+def test_timed_out_dialog_stops_before_its_next_request(
+    stub_dialog, workdir, monkeypatch
+):
+    monkeypatch.setattr(action_execution, "DIALOG_TIMEOUT", 2.5 * LATENCY)
+    llm, _ = stub_dialog(StubLLM(latency=LATENCY))
+    with pytest.raises(TimeoutError):
+        chat(workdir, 0, max_round_num=8)
+    # the request in flight at the timeout still finishes, no request after it.
+    time.sleep(3 * LATENCY)
+    sent = len(llm.requests)
+    assert sent == 3
+    time.sleep(3 * LATENCY)
+    assert len(llm.requests) == sent
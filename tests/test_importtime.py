@@ -0,0 +1,13 @@
+import pytest
+
+from tool.importtime import BUDGETS, import_seconds
+
+
+@pytest.mark.parametrize("module", list(BUDGETS))
+def test_import_time_within_budget(module):
+    # a fresh interpreter each time, best of 3.
+    seconds = import_seconds(module)
+    assert seconds <= BUDGETS[module], (
+        f"import {module} took {seconds:.3f}s, budget {BUDGETS[module]}s, "
+        f"see `python -m tool.importtime report {module}`"
+    )
@@ -0,0 +1,46 @@
+import json
+import os
+
+from tool.jsonl import AppendLog
+
+
+def read(path):
+    with open(path, encoding="utf-8") as f:
+        return f.read().splitlines()
+
+
+def test_short_writes_are_completed(tmp_path, monkeypatch):
+    write = os.write
+    sizes = []
+
+    def short_write(fd, data):
+        sizes.append(len(data))
+        return write(fd, bytes(data[:7]))
+
+    monkeypatch.setattr(os, "write", short_write)
+    log = AppendLog(str(tmp_path / "logs" / "spans.jsonl"))
+    log.write({"id": "q1", "text": "é" * 10}, {"id": "q2"})
+    log.write({"id": "q3"})
+
+    lines = read(log.path)
+    assert [json.loads(line)["id"] for line in lines] == ["q1", "q2", "q3"]
+    assert len(sizes) > 3
+
+
+def test_torn_last_line_is_ended(tmp_path):
+    path = str(tmp_path / "manifest.jsonl")
+    with open(path, "w") as f:
+        f.write('{"id": "q1"}\n{"id": "q2", "sta')
+
+    log = AppendLog(path)
+    log.write({"id": "q3"})
+    log.close()
+    log.write({"id": "q4"})
+
+    assert read(path) == [
+        '{"id": "q1"}',
+        '{"id": "q2", "sta',
+        '{"id": "q3"}',
+        '{"id": "q4"}',
+    ]
+    assert log.size() == os.path.getsize(path)
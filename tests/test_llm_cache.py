@@ -0,0 +1,34 @@
+from tool.llm_cache import LLMCache
+from tool.openai_api import _chat_request
+
+
+def test_stream_is_part_of_the_key(tmp_path):
+    cache = LLMCache(str(tmp_path / "llm_cache.db"))
+    messages = [{"role": "user", "content": "How many singers?"}]
+    plain = _chat_request(model="gpt-4o", messages=messages)
+    streamed = _chat_request(model="gpt-4o", messages=messages, stream=True)
+
+    cut_off = {"choices": [{"message": {"content": "Action: Done"}}], "cutoff": True}
+    cache.put(cache.key(streamed), cut_off)
+
+    assert cache.get(cache.key(plain)) is None
+    assert cache.get(cache.key(streamed)) == cut_off
+    assert cache.key(streamed) != cache.key(streamed, salt=1)
+    # the keys of plain requests are the ones written before.
+    assert cache.key(plain) == cache.key({**plain, "stream": False})
+    assert (
+        cache.key(plain)
+        == "10bfcde1091dcc1c7bc4f252f465ee642bbdd350859f881c667eb870c8a3eae4"
+    )
+
+
+def test_n_is_part_of_the_key(tmp_path):
+    cache = LLMCache(str(tmp_path / "llm_cache.db"))
+    messages = [{"role": "user", "content": "How many singers?"}]
+    one = _chat_request(model="gpt-4o", messages=messages)
+    three = _chat_request(model="gpt-4o", messages=messages, n=3)
+
+    cache.put(cache.key(one), {"choices": [{"message": {"content": "a"}}]})
+
+    assert cache.key(one) == cache.key({**one, "n": 1})
+    assert cache.get(cache.key(three)) is None
@@ -0,0 +1,87 @@
+import functools
+import gc
+import os
+import sqlite3
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import networkx
+
+from tool.registry import ToolRegistry
+from tool.spider_search import GraphSearcher
+
+
+def make_db(database_dir, db):
+    os.makedirs(f"{database_dir}/{db}")
+    conn = sqlite3.connect(f"{database_dir}/{db}/{db}.sqlite")
+    conn.execute("CREATE TABLE singer (singer_id int PRIMARY KEY, name text)")
+    conn.execute(
+        "CREATE TABLE song (song_id int, singer_id int REFERENCES singer(singer_id))"
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_release_on_eviction():
+    released = []
+    registry = ToolRegistry(maxsize=2)
+    for key in ["a", "b", "c", "a"]:
+        registry.get(key, lambda: key, release=functools.partial(released.append, key))
+    assert released == ["a", "b"]
+    registry.clear()
+    assert sorted(released) == ["a", "a", "b", "c"]
+
+
+def graph_registry(workdir, dbs):
+    database_dir = str(workdir / "databases")
+    for db in dbs:
+        make_db(database_dir, db)
+    searcher = GraphSearcher(database_dir=database_dir)
+    graphs = {}
+
+    def build(db):
+        # as `create_path_finder`: the finder owns the graph.
+        graph = searcher.load_graph(db)
+        graphs[db] = weakref.ref(graph[0])
+        return functools.partial(searcher.find_shortest_path, db, graph=graph)
+
+    return ToolRegistry(maxsize=1), build, graphs
+
+
+def test_evicted_db_graph_is_freed(workdir):
+    registry, build, graphs = graph_registry(workdir, ["db1", "db2", "db3"])
+
+    for db in ["db1", "db2", "db3"]:
+        find_path = registry.get(db, functools.partial(build, db))
+    gc.collect()
+    # only the graph of the entry still in the registry is kept.
+    assert [db for db, ref in graphs.items() if ref() is not None] == ["db3"]
+    assert "singer" in find_path("song", "singer")
+
+
+def test_evict_while_finding_a_path(workdir, monkeypatch):
+    registry, build, graphs = graph_registry(workdir, ["db1", "db2"])
+    find_path = registry.get("db1", functools.partial(build, "db1"))
+
+    running, evicted = threading.Event(), threading.Event()
+    shortest_path = networkx.shortest_path
+
+    def blocking_shortest_path(*args, **kwargs):
+        running.set()
+        evicted.wait(5)
+        return shortest_path(*args, **kwargs)
+
+    monkeypatch.setattr(networkx, "shortest_path", blocking_shortest_path)
+    with ThreadPoolExecutor(1) as pool:
+        future = pool.submit(find_path, "song", "singer")
+        running.wait(5)
+        registry.get("db2", functools.partial(build, "db2"))
+        evicted.set()
+        assert future.result() == "song.singer_id = singer.singer_id"
+
+    monkeypatch.setattr(networkx, "shortest_path", shortest_path)
+    del find_path, future
+    gc.collect()
+    assert graphs["db1"]() is None
+    assert graphs["db2"]() is not None
@@ -0,0 +1,16 @@
+import threading
+
+from tool.sqlite_wal import ThreadConnections
+
+
+def test_one_wal_connection_per_thread(tmp_path):
+    conns = ThreadConnections(str(tmp_path / "cache" / "cache.db"))
+    main = conns()
+    assert conns() is main
+    assert main.execute("PRAGMA journal_mode;").fetchone() == ("wal",)
+
+    other = []
+    t = threading.Thread(target=lambda: other.append(conns()))
+    t.start()
+    t.join()
+    assert other[0] is not main
@@ -0,0 +1,94 @@
+import pytest
+
+from tool.action_execution import parse_action
+from tool.streaming import ActionCutoff
+
+"""
+A streamed completion is cut right after its action, every chunking of it
+must give the same cut text and the same action as the whole completion.
+"""
+
+
+# the stop words of the dialog's requests, where a non-stream completion ends.
+STOP = ["\nObservation", "\nThought", "[END]"]
+
+
+def non_stream(text):
+    for stop in STOP:
+        text = text.split(stop)[0]
+    return text
+
+
+def chunkings(text):
+    yield [text]
+    for size in (1, 2, 3, 7):
+        yield [text[i : i + size] for i in range(0, len(text), size)]
+
+
+def cut(chunks):
+    cutoff = ActionCutoff()
+    for i, delta in enumerate(chunks):
+        if cutoff.feed(delta):
+            # the stream is closed, later chunks are never fed.
+            return cutoff, chunks[i + 1 :]
+    return cutoff, []
+
+
+@pytest.mark.parametrize(
+    "action, tail",
+    [
+        ('ExecuteSQL("SELECT name FROM singer")', "\nObservation: [('Joe',)]"),
+        (
+            "ExecuteSQL(\"SELECT count(*) FROM singer WHERE name = 'a)(b'\")",
+            "\nThought: done.",
+        ),
+        (
+            'ExecuteSQL("SELECT name FROM singer WHERE note = \\"x)\\"")',
+            "\nThought: (x) is there.",
+        ),
+        (
+            "SearchColumn(['name (full)', (\"age\")], topk=max((5)))",
+            "\nObservation: [('singer', 'name')]",
+        ),
+        ('FindShortestPath(start="song.id", end=["singer.id"])', "[END]"),
+        ("Done", "\nThought: the answer is above."),
+    ],
+)
+def test_cutoff_matches_the_whole_completion(action, tail):
+    head = "Thought: I should look at the singers (all of them).\nAction: "
+    completion = head + action
+    for chunks in chunkings(completion + tail):
+        cutoff, unread = cut(chunks)
+        assert cutoff.done
+        assert cutoff.text == completion
+        assert parse_action(cutoff.text) == parse_action(non_stream(completion + tail))
+        assert "".join(unread) in tail
+
+
+def test_action_split_across_chunks():
+    cutoff, _ = cut(["Thought: x\nAct", "ion", ": Exec", "uteSQL", '("SELECT 1', '")'])
+    assert cutoff.text == 'Thought: x\nAction: ExecuteSQL("SELECT 1")'
+
+
+def test_parentheses_before_the_action_are_ignored():
+    completion = 'Thought: count(*) of singer (")\nAction: ExecuteSQL("SELECT 1")'
+    for chunks in chunkings(completion + "\n"):
+        assert cut(chunks)[0].text == completion
+
+
+@pytest.mark.parametrize(
+    "partial",
+    [
+        "Thought: x",
+        "Thought: x\nAction: Execute",
+        'Thought: x\nAction: ExecuteSQL("SELECT count(*',
+        'Thought: x\nAction: ExecuteSQL("SELECT \\")',
+    ],
+)
+def test_stream_ends_before_the_call_closes(partial):
+    for chunks in chunkings(partial):
+        cutoff, _ = cut(chunks)
+        assert not cutoff.done
+        # nothing is cut, the text parses as the non-stream completion does.
+        assert cutoff.text == partial
+        assert parse_action(cutoff.text) == parse_action(partial)
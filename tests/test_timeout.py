@@ -0,0 +1,34 @@
+import asyncio
+
+import pytest
+from conftest import StubLLM, dialog_args
+
+from tool import action_execution
+from tool.action_execution import achat_with_LLM, chat_with_LLM
+
+
+@pytest.fixture
+def short_timeout(monkeypatch):
+    monkeypatch.setattr(action_execution, "DIALOG_TIMEOUT", 0.3)
+    monkeypatch.setattr(action_execution, "BUDGET_GRACE", 0.3)
+
+
+def test_time_budget_over_the_default_timeout(stub_dialog, workdir, short_timeout):
+    # the default hard limit would kill this dialog, its time budget lets it finish.
+    llm, _ = stub_dialog(StubLLM(latency=0.1))
+    assert chat_with_LLM(**dialog_args(workdir, time_budget=0.6)) == 1
+    assert len(llm.requests) > 3
+
+    with pytest.raises(TimeoutError):
+        chat_with_LLM(**dialog_args(workdir))
+
+
+def test_async_time_budget_over_the_default_timeout(
+    stub_dialog, workdir, short_timeout
+):
+    llm, _ = stub_dialog(StubLLM(latency=0.1))
+    assert asyncio.run(achat_with_LLM(**dialog_args(workdir, time_budget=0.6))) == 1
+    assert len(llm.requests) > 3
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(achat_with_LLM(**dialog_args(workdir)))
@@ -0,0 +1,66 @@
+import pytest
+
+from tool import tool_cache
+from tool.tool_cache import ToolCache, cached_tool
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = ToolCache(path=str(tmp_path / "tool_cache.db"))
+    monkeypatch.setattr(tool_cache, "tool_cache", cache)
+    return cache
+
+
+def recording(calls):
+    def search_column(query, topk=5, str_mode=True):
+        calls.append(query)
+        return f"columns of {query}"
+
+    def find_shortest_path(start, end, debug=False):
+        calls.append((start, end))
+        return f"path {start} -> {end}"
+
+    return search_column, find_shortest_path
+
+
+def test_search_column_queries_share_normalized_entry(cache):
+    calls = []
+    search_column, _ = recording(calls)
+    SearchColumn = cached_tool(
+        search_column, ("spider", "db1", "SearchColumn"), lambda: "fp"
+    )
+
+    first = SearchColumn("Name")
+    assert SearchColumn(" name ") == first
+    assert SearchColumn(query="NAME") == first
+    assert SearchColumn(["Age ", "Name"]) == SearchColumn(["age", "name"])
+    SearchColumn("name", topk=10)
+
+    assert calls == ["name", ["age", "name"], "name"]
+    assert cache.info()["SearchColumn"] == {
+        "memory": 3,
+        "disk": 0,
+        "miss": 3,
+        "hit_rate": 0.5,
+    }
+
+
+def test_path_finder_nodes_are_a_set(cache):
+    calls = []
+    _, find_shortest_path = recording(calls)
+    FindShortestPath = cached_tool(
+        find_shortest_path, ("spider", "db1", "FindShortestPath"), lambda: "fp"
+    )
+
+    first = FindShortestPath(["singer.id", "concert.id"], "stadium.id")
+    assert (
+        FindShortestPath(["concert.id", "singer.id", "concert.id"], ["stadium.id"])
+        == first
+    )
+    FindShortestPath("singer.id", "Stadium.id")
+
+    assert calls == [
+        (["concert.id", "singer.id"], ["stadium.id"]),
+        (["singer.id"], ["Stadium.id"]),
+    ]
+    assert cache.info()["FindShortestPath"]["miss"] == 2
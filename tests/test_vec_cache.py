@@ -0,0 +1,120 @@
+import json
+import sqlite3
+from array import array
+
+from tool.vec_cache import BATCH, LEGACY_TABLE, VecCache, migrate
+
+MODEL = "text-embedding-3-large"
+
+
+def legacy_cache(path, vecs, model=MODEL):
+    """
+    A cache file in the old layout: name = text + model, vec = JSON.
+    """
+    conn = sqlite3.connect(path)
+    conn.execute(f"CREATE TABLE {LEGACY_TABLE} (name TEXT PRIMARY KEY, vec TEXT)")
+    conn.executemany(
+        f"INSERT INTO {LEGACY_TABLE} VALUES (?, ?)",
+        [(text + model, json.dumps(vec)) for text, vec in vecs.items()],
+    )
+    conn.commit()
+    conn.close()
+
+
+def tables(path):
+    conn = sqlite3.connect(path)
+    try:
+        return {r[0] for r in conn.execute("SELECT name FROM sqlite_master")}
+    finally:
+        conn.close()
+
+
+def test_float32_round_trip(tmp_path):
+    cache = VecCache(str(tmp_path / "cache" / "vec.db"))
+    vec = [0.1, -2.5, 1e-3, 3.0]
+
+    stored = cache.put_many(MODEL, {"singer": vec})
+
+    as_f32 = array("f", vec).tolist()
+    assert stored == {"singer": as_f32}
+    assert stored["singer"] != vec  # 0.1 is not a float32
+    assert VecCache(cache.path).get_many(MODEL, ["singer"]) == stored
+    # keyed by model too.
+    assert cache.get_many("text-embedding-3-small", ["singer"]) == {}
+
+
+def test_lookups_across_the_batch_boundary(tmp_path, monkeypatch):
+    cache = VecCache(str(tmp_path / "vec.db"))
+    texts = [f"text {i}" for i in range(2 * BATCH + 3)]
+    cache.put_many(MODEL, {t: [float(i)] for i, t in enumerate(texts[::2])})
+
+    queries = []
+    conn = cache._conn()
+    monkeypatch.setattr(cache, "_conn", lambda: Recorder(conn, queries))
+    found = cache.get_many(MODEL, texts + texts[:10])
+
+    assert found == {t: [float(i)] for i, t in enumerate(texts[::2])}
+    # distinct texts only, at most BATCH per IN (...).
+    assert [q.count("?") for q in queries] == [BATCH, BATCH, 3]
+    assert cache.info()["hits"] == BATCH + 2
+    assert cache.info()["misses"] == BATCH + 1
+
+
+class Recorder:
+    def __init__(self, conn, queries):
+        self.conn = conn
+        self.queries = queries
+
+    def execute(self, sql, params=()):
+        self.queries.append(sql)
+        return self.conn.execute(sql, params)
+
+
+def test_legacy_rows_move_over_on_a_miss(tmp_path):
+    path = str(tmp_path / "vec.db")
+    legacy_cache(path, {"singer": [0.5, 1.5], "concert": [2.0]})
+
+    cache = VecCache(path)
+    assert cache.legacy
+    assert cache.get_many(MODEL, ["singer", "stadium"]) == {"singer": [0.5, 1.5]}
+
+    conn = sqlite3.connect(path)
+    moved = conn.execute("SELECT COUNT(*) FROM vec_cache_f32").fetchone()[0]
+    conn.close()
+    assert moved == 1
+    # found in the new table from now on.
+    cache.legacy = False
+    assert cache.get_many(MODEL, ["singer"]) == {"singer": [0.5, 1.5]}
+
+
+def test_migrate_drops_the_old_table(tmp_path):
+    path = str(tmp_path / "vec.db")
+    vecs = {f"text {i}": [float(i), 0.25] for i in range(BATCH + 5)}
+    legacy_cache(path, vecs)
+    # a row of a model that is not known is skipped.
+    conn = sqlite3.connect(path)
+    conn.execute(
+        f"INSERT INTO {LEGACY_TABLE} VALUES (?, ?)", ("orphan" + "other-model", "[1.0]")
+    )
+    conn.commit()
+    conn.close()
+
+    assert migrate(path) == len(vecs)
+
+    assert LEGACY_TABLE not in tables(path)
+    cache = VecCache(path)
+    assert not cache.legacy
+    assert cache.get_many(MODEL, list(vecs)) == vecs
+    assert migrate(path) == 0
+
+
+def test_migrate_keep_old(tmp_path):
+    path = str(tmp_path / "vec.db")
+    legacy_cache(path, {"singer": [1.0]}, model="text-embedding-3-small")
+
+    assert migrate(path, keep_old=True) == 1
+
+    assert LEGACY_TABLE in tables(path)
+    assert VecCache(path).get_many("text-embedding-3-small", ["singer"]) == {
+        "singer": [1.0]
+    }
@@ -1,6 +1,29 @@
-def init_actions_spider(db, _hint=True):
-    from tool.spider_execution import create_execute_sql
+import functools
+
+from tool.registry import registry
+from tool.tool_cache import cached_tool, file_fingerprint
+
+
+def _es_fingerprint(index, *paths):
+    from tool.client_es import get_es_client
+
+    try:
+        uuid = get_es_client().index_uuid(index)
+    except Exception:
+        uuid = None
+    return f"{file_fingerprint(*paths)}:{uuid}"
+
+
+def _cache_searchers(dataset, db, searchers, fingerprints):
+    return tuple(
+        cached_tool(func, (dataset, db, name), fingerprint)
+        for (name, func), fingerprint in zip(searchers, fingerprints)
+    )
+
+
+def _build_searchers_spider(db):
     from tool.spider_search import (
+        COL_VEC_PKL_FILE,
         create_column_searcher,
         create_path_finder,
         create_value_searcher,
@@ -9,20 +32,96 @@ def init_actions_spider(db, _hint=True):
     SearchColumn = create_column_searcher(db=db)
     SearchValue = create_value_searcher(db=db)
     FindShortestPath = create_path_finder(db=db)
-    ExecuteSQL = create_execute_sql(db=db, _hint=_hint)
-    return SearchColumn, SearchValue, FindShortestPath, ExecuteSQL
 
+    db_file = f"dataset/spider/test_database/{db}/{db}.sqlite"
+    return _cache_searchers(
+        "spider",
+        db,
+        [
+            ("SearchColumn", SearchColumn),
+            ("SearchValue", SearchValue),
+            ("FindShortestPath", FindShortestPath),
+        ],
+        [
+            functools.partial(
+                file_fingerprint,
+                db_file,
+                COL_VEC_PKL_FILE,
+                "database/db_chroma_spider/chroma.sqlite3",
+            ),
+            functools.partial(
+                _es_fingerprint,
+                f"spider-{db}".lower(),
+                db_file,
+                "preprocess/spider_db_has_text_filed_list.json",
+            ),
+            functools.partial(
+                file_fingerprint, db_file, f".cache/nx_cache/spider/{db}.gpickle"
+            ),
+        ],
+    )
 
-def init_actions_bird(db, _hint=True):
-    from tool.bird_execution import create_execute_sql
+
+def _build_searchers_bird(db):
     from tool.bird_search import (
+        COL_VEC_PKL_FILE,
         create_column_searcher,
         create_path_finder,
         create_value_searcher,
+        get_sqlite_file,
     )
 
     SearchColumn = create_column_searcher(db=db)
     SearchValue = create_value_searcher(db=db)
     FindShortestPath = create_path_finder(db=db)
+
+    db_file = get_sqlite_file(db)
+    return _cache_searchers(
+        "bird",
+        db,
+        [
+            ("SearchColumn", SearchColumn),
+            ("SearchValue", SearchValue),
+            ("FindShortestPath", FindShortestPath),
+        ],
+        [
+            functools.partial(
+                file_fingerprint,
+                db_file,
+                COL_VEC_PKL_FILE,
+                "database/db_chroma_bird/chroma.sqlite3",
+            ),
+            functools.partial(
+                _es_fingerprint,
+                f"bird-{db}".lower(),
+                db_file,
+                "preprocess/bird_db_has_text_filed_list.json",
+            ),
+            functools.partial(
+                file_fingerprint, db_file, f".cache/nx_cache/bird/{db}.gpickle"
+            ),
+        ],
+    )
+
+
+def init_actions_spider(db, _hint=True):
+    from tool.spider_execution import create_execute_sql
+
+    # the searchers are read-only and shared, ExecuteSQL keeps per-dialog hint flags.
+    # the graph of `db` lives in FindShortestPath, freed with the entry once
+    # no dialog holds it any more.
+    SearchColumn, SearchValue, FindShortestPath = registry.get(
+        ("spider", db), functools.partial(_build_searchers_spider, db)
+    )
+    ExecuteSQL = create_execute_sql(db=db, _hint=_hint)
+    return SearchColumn, SearchValue, FindShortestPath, ExecuteSQL
+
+
+def init_actions_bird(db, _hint=True):
+    from tool.bird_execution import create_execute_sql
+
+    SearchColumn, SearchValue, FindShortestPath = registry.get(
+        ("bird", db), functools.partial(_build_searchers_bird, db)
+    )
     ExecuteSQL = create_execute_sql(db=db, _hint=_hint)
     return SearchColumn, SearchValue, FindShortestPath, ExecuteSQL
@@ -1,13 +1,26 @@
+import asyncio
+import contextvars
+import functools
 import os
+import time
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 from loguru import logger
-from openai import BadRequestError
 
-from tool.openai_api import chatgpt
+from tool import spans, trace
+from tool.action_parser import TOOLS, parse_call
+from tool.checkpoint import get_checkpoint
+from tool.openai_api import (
+    achatgpt,
+    chatgpt,
+    count_message_tokens,
+    is_bad_request,
+)
+from tool.result_sink import get_sink
 from tool.utils import INVALID_RESULTS
-from utils import colorful, read_json, save_to_json, timeout
+from utils import check_deadline, colorful, timeout
 
 
 def parse_action(text: str, execute=False, _actions=[]):
@@ -68,11 +81,10 @@ def parse_action(text: str, execute=False, _actions=[]):
         action_str = action_str[: action_str.rfind(")") + 1]
 
         if execute:
-            SearchColumn, SearchValue, FindShortestPath, ExecuteSQL = _actions
-            if "ExecuteSQL" in action_str:
-                x = 1
+            # literal arguments only, model output is never executed as code.
+            tool, args, kwargs = parse_call(action_str)
             # may time out, return None
-            obs = eval(action_str)
+            obs = dict(zip(TOOLS, _actions))[tool](*args, **kwargs)
             return obs
         else:
             return action_str
@@ -148,6 +160,115 @@ def preprocess_output(content: str):
     return content.replace("[END]", "")
 
 
+def compact_history(messages: List[dict], budget: int, keep_last: int = 2):
+    """
+    Elide stale observations, oldest first, until the prompt fits in `budget` tokens.
+    The system prompt and the question (messages[:2]) are never touched and the
+    result only depends on `messages`, so the sent prefix stays byte-identical
+    across rounds for provider prefix caching.
+    Return: (messages to send, tokens saved)
+    """
+    total = count_message_tokens(messages)
+    if total <= budget:
+        return messages, 0
+
+    obs_idx = [
+        i
+        for i, m in enumerate(messages)
+        if i >= 2 and m["role"] == "user" and m["content"].startswith("Observation: ")
+    ]
+    obs_idx = obs_idx[:-keep_last] if keep_last else obs_idx
+
+    compacted = list(messages)
+    saved = 0
+    for i in obs_idx:
+        if total - saved <= budget:
+            break
+        content = messages[i]["content"]
+        head = content[len("Observation: ") :][:80]
+        elided = f"Observation: {head}... (elided)"
+        _saved = count_message_tokens([messages[i]]) - count_message_tokens(
+            [{"content": elided}]
+        )
+        if _saved <= 0:
+            continue
+        compacted[i] = {"role": "user", "content": elided}
+        saved += _saved
+    return compacted, saved
+
+
+def _action_key(content: str):
+    """
+    Normalized action of a candidate, equal for the same call written differently.
+    """
+    return " ".join(parse_action(content, execute=False).split())
+
+
+# tools whose result depends on the calls before it (ExecuteSQL's one-shot
+# table-alias error), their candidates run in candidate order.
+ORDERED_TOOLS = ("ExecuteSQL",)
+
+
+def _reusable(obs):
+    """
+    A plain valid result: any later call of the same action returns it again.
+    """
+    return is_valid_result(obs) and "(Hint:" not in str(obs)
+
+
+def _execute_candidates(contents: List[str], _actions, memo: dict, stats: Counter):
+    """
+    Sub-generator of `_dialog`: the observation of every candidate in `contents`,
+    the same as executing them one after the other.
+    A candidate whose normalized action already gave a plain valid result (this
+    round or before, `memo`) reuses it. The distinct other actions run once,
+    concurrently as one ("tools", [func, ...]) step, except ORDERED_TOOLS: only
+    the first of them joins that step, the rest run after it in candidate
+    order, and a repeated action runs again unless its result is reusable.
+    """
+    keys = [_action_key(c) for c in contents]
+
+    def _call(i):
+        return functools.partial(
+            parse_action, contents[i], execute=True, _actions=_actions
+        )
+
+    first, ordered = {}, []
+    for i, key in enumerate(keys):
+        if key in memo:
+            continue
+        if key.startswith(ORDERED_TOOLS):
+            ordered.append(i)
+        else:
+            first.setdefault(key, i)
+    wave = list(first.values()) + ordered[:1]
+    observations = [None] * len(contents)
+    if wave:
+        values = yield ("tools", [_call(i) for i in wave])
+        for i, obs in zip(wave, values):
+            observations[i] = obs
+            if _reusable(obs):
+                memo[keys[i]] = obs
+    executed = len(wave)
+
+    for i, key in enumerate(keys):
+        if i in wave:
+            continue
+        if key in memo:
+            observations[i] = memo[key]
+        elif not key.startswith(ORDERED_TOOLS):
+            # stateless, the result of its first run this round.
+            observations[i] = observations[first[key]]
+        else:
+            observations[i] = yield ("tool", _call(i))
+            executed += 1
+            if _reusable(observations[i]):
+                memo[key] = observations[i]
+    stats["candidates"] += len(contents)
+    stats["executed"] += executed
+    return observations
+
+
 def _has_execution(messages: List[dict]):
     for m in messages[2:][::-1]:
         if m["role"] == "assistant" and "ExecuteSQL(" in m["content"]:
@@ -155,31 +276,224 @@ def _has_execution(messages: List[dict]):
     return False
 
 
+# appended to the last observation of the round a budget is about to run out.
+FINISH_PROMPT = (
+    "\n\n(Budget almost used up: finish now. Call ExecuteSQL with your final SQL, "
+    "or Done if the last executed SQL already answers the question.)"
+)
+
+
+def _near_budget(budgets: dict, spent: dict, next_round: dict, growth: dict):
+    """
+    next_round: projected cost of the next round, growth: what each round after
+        it adds on top (prompts resend the whole history, so they grow).
+    Return: (budget, last) of the budget about to run out, (None, False) if none.
+        last=True: the next round fits, the one after it does not, so the next
+        round has to be the last one. last=False: not even the next round fits.
+    """
+    res = (None, False)
+    for k, limit in budgets.items():
+        if limit is None or k not in next_round:
+            continue
+        if spent[k] + next_round[k] > limit:
+            return k, False
+        after = next_round[k] + growth.get(k, 0)
+        if res[0] is None and spent[k] + next_round[k] + after > limit:
+            res = (k, True)
+    return res
+
+
+def best_sql(messages: List[dict]):
+    """
+    The SQL of the last ExecuteSQL with a valid observation, None if there is none.
+    """
+    for i in range(len(messages) - 2, 1, -1):
+        if messages[i]["role"] != "assistant" or messages[i + 1]["role"] != "user":
+            continue
+        action = parse_action(messages[i]["content"], execute=False)
+        if not action.startswith("ExecuteSQL("):
+            continue
+        if not is_valid_result(
+            messages[i + 1]["content"].replace("Observation: ", "").strip()
+        ):
+            continue
+        try:
+            _, args, kwargs = parse_call(action)
+        except ValueError:
+            continue
+        return args[0] if args else kwargs.get("sql")
+    return None
+
+
+def get_init_actions(dataset: str):
+    if dataset == "spider2-lite-sqlite":
+        from tool import init_actions_spider2_sqlite as _init_actions
+    elif dataset == "spider2-lite-snowflake":
+        from tool import init_actions_spider2_snowflake as _init_actions
+    elif "spider" in dataset:
+        from tool import init_actions_spider as _init_actions
+    elif "bird" in dataset:
+        from tool import init_actions_bird as _init_actions
+    else:
+        raise ValueError(f"dataset: {dataset} is not supported.")
+    return _init_actions
+
+
+def _is_observation(message: dict):
+    return message["role"] == "user" and message["content"].startswith("Observation: ")
+
+
+def last_observation(dialog: List[dict]):
+    last_obs = None
+    # a dialog cut off at max_round_num ends on the observation of its last
+    # round, the others on a stop message.
+    if dialog and not _is_observation(dialog[-1]):
+        dialog = dialog[:-1]
+    for dia in dialog[::-1]:
+        if dia["role"] == "user":
+            last_obs = dia["content"].replace("Observation: ", "").strip()
+            break
+    return last_obs
+
+
+def accept_result(d: dict, save_dir, attempt, max_retries=3):
+    """
+    Hand a finished dialog to the result sink of `save_dir`, unless its last
+    observation is empty and retries are left.
+    Return: True if kept.
+    """
+    valid = is_valid_result(last_observation(d["dialog"]))
+    # a retry would overrun the budget that stopped the dialog.
+    stopped = d.get("budget", {}).get("stopped")
+    if not valid and not stopped and attempt < max_retries - 1:
+        return False
+    get_sink(save_dir).put(d, status="ok" if valid else "empty")
+    return True
+
+
+def round_records(d: dict):
+    """
+    The rounds of a finished dialog `d` in the record format of tool/checkpoint.py:
+    the (assistant, observation) pairs, without the final stop message or the
+    "Done" answer before it. A dialog cut off at max_round_num has neither.
+    """
+    dialog = d["dialog"]
+    ttft = d.get("ttft") or []
+    tokens_saved = d.get("compaction", {}).get("tokens_saved", [])
+    records = []
+    for i in range(2, len(dialog) - 1, 2):
+        if dialog[i]["role"] != "assistant" or not _is_observation(dialog[i + 1]):
+            break
+        j = len(records)
+        records.append(
+            {
+                "round_idx": j + 1,
+                "messages": dialog[i : i + 2],
+                "last_out": dialog[i]["content"],
+                "prompt_tokens": d["prompt_tokens"][j],
+                "completion_tokens": d["completion_tokens"][j],
+                "ttft": ttft[j] if j < len(ttft) else None,
+                "tokens_saved": tokens_saved[j] if j < len(tokens_saved) else None,
+            }
+        )
+    return records
+
+
+def _tool_flags(execute_sql):
+    """
+    The one-shot hints of ExecuteSQL not given yet (True: still to give), see
+    tool/spider_execution.py. Kept with each checkpointed round, so that a
+    resumed dialog gets the observations the interrupted one would have got.
+    """
+    return {
+        k: getattr(execute_sql, f"get_{k}")()
+        for k in ("flag", "alias_flag")
+        if hasattr(execute_sql, f"get_{k}")
+    }
+
+
+def _restore_flags(execute_sql, record: dict):
+    flags = record.get("flags")
+    if flags is None:
+        # a round of a saved dialog (`branch_retry`) or of an older checkpoint:
+        # the hints it gave are in its observation.
+        obs = record["messages"][-1]["content"]
+        flags = {
+            "flag": "(Hint: DOUBLE-CHECK the columns" not in obs,
+            "alias_flag": "Do not use table alias" not in obs,
+        }
+    for k, on in flags.items():
+        if not on and hasattr(execute_sql, f"set_{k}"):
+            getattr(execute_sql, f"set_{k}")()
+
+
+def branch_retry(d: dict, attempt):
+    """
+    Where the retry of a dialog with an empty last observation starts: after
+    the last earlier round with a valid observation, so those rounds (messages
+    and tool results) are reused instead of requested again.
+    Return: the rounds to pass as `prefix`, [] to start over.
+    """
+    records = round_records(d)
+    keep = 0
+    # the last record holds the empty observation itself (`last_observation`).
+    for j, r in enumerate(records[:-1]):
+        obs = r["messages"][-1]["content"].replace("Observation: ", "").strip()
+        if is_valid_result(obs):
+            keep = j + 1
+    prefix = records[:keep]
+    saved = sum(r["prompt_tokens"] + r["completion_tokens"] for r in prefix)
+    d.setdefault("branches", []).append(
+        {"attempt": attempt, "round": keep, "of": len(records), "tokens_saved": saved}
+    )
+    logger.info(
+        f"Retry {d['id']} attempt {attempt}: branch after round {keep}/{len(records)}, "
+        f"{saved} tokens reused."
+    )
+    return prefix
+
+
 def retry_no_empty(func):
     def wrapper(*args, **kwargs):
         max_retries = 3
+        prefix = None
         for current_num in range(max_retries):
-            res_json = func(*args, **kwargs)
-            if res_json is None:
+            # a retry must sample anew, not replay the cached completions.
+            d = func(*args, cache_salt=current_num or None, prefix=prefix, **kwargs)
+            if d is None:
                 return 0
-            result_json = read_json(res_json)
-            dialog = result_json["dialog"]
-            for dia in dialog[:-1][::-1]:
-                if dia["role"] == "user":
-                    last_obs = dia["content"].replace("Observation: ", "").strip()
-                    break
-            if is_valid_result(last_obs):
+            if accept_result(d, kwargs["save_dir"], current_num, max_retries):
                 return 1
-            elif current_num < max_retries - 1:
-                os.remove(res_json)
+            prefix = branch_retry(d, current_num + 1)
         return 1  # Return the last result after max retries
 
     return wrapper
 
 
-@retry_no_empty
-@timeout(60 * 5)
-def chat_with_LLM(
+def aretry_no_empty(func):
+    """
+    `retry_no_empty` for coroutine functions.
+    """
+
+    async def wrapper(*args, **kwargs):
+        max_retries = 3
+        prefix = None
+        for current_num in range(max_retries):
+            d = await func(
+                *args, cache_salt=current_num or None, prefix=prefix, **kwargs
+            )
+            if d is None:
+                return 0
+            # only enqueues, the sink writes in the background.
+            if accept_result(d, kwargs["save_dir"], current_num, max_retries):
+                return 1
+            prefix = branch_retry(d, current_num + 1)
+        return 1
+
+    return wrapper
+
+
+def _dialog(
     d: dict,
     model_name: str,
     dataset: str,
@@ -187,8 +501,42 @@ def chat_with_LLM(
     tooldesc_demos: str = None,
     max_round_num: int = 8,
     add_evidence=False,
+    history_budget: int = None,
+    cache_salt=None,
+    stream=False,
+    checkpoint=False,
+    prefix=None,
+    time_budget: float = None,
+    prompt_budget: int = None,
+    completion_budget: int = None,
+    n: int = 1,
 ):
     """
+    The dialog loop as a generator, so the same code runs under the sync and
+    the async driver. It yields one step at a time:
+        ("llm", kwargs): a `chatgpt` request, send back the response.
+        ("tool", func): a tool call, `parse_action` bound to the action text.
+        ("tools", [func, ...]): independent tool calls, run concurrently,
+            send back the list of results.
+        ("call", func): other blocking calls (tool setup, disk io).
+    Both send back the return value of `func`.
+    Exceptions raised by a step are thrown back into the generator.
+    history_budget: prompt tokens above which old observations are elided, None: off.
+    cache_salt: passed to `chatgpt`, keeps retries apart in the response cache.
+    stream: stream completions and stop reading at the first complete action.
+    checkpoint: append every round to `{save_dir}/checkpoint.jsonl` and resume
+        from it, see tool/checkpoint.py.
+    prefix: rounds to start from instead of round 0, see `branch_retry`.
+    time_budget, prompt_budget, completion_budget: seconds / prompt tokens /
+        completion tokens per dialog, None: unlimited. Before one runs out, the
+        last round asks the model to finish now (`FINISH_PROMPT`), a round that
+        would overrun it is not sent, and `d["budget"]["best_sql"]` keeps the
+        best SQL found so far.
+    n: completions per round, the first one with a valid observation is kept,
+        see `self_consistency_for_action`.
+    Return: the finished `d`, None if the dialog is aborted. Saving is up to
+        the caller, see `accept_result`.
+
     different between apis:
     same:
         - messages
@@ -243,20 +591,19 @@ def chat_with_LLM(
     # info
     completion_tokens = []
     prompt_tokens = []
+    tokens_saved = []
+    ttft = []
+    # normalized action -> observation, shared by all rounds of this dialog.
+    tool_memo = {}
+    tool_stats = Counter()
 
-    if dataset == "spider2-lite-sqlite":
-        from tool import init_actions_spider2_sqlite as _init_actions
-    elif dataset == "spider2-lite-snowflake":
-        from tool import init_actions_spider2_snowflake as _init_actions
-    elif "spider" in dataset:
-        from tool import init_actions_spider as _init_actions
-    elif "bird" in dataset:
-        from tool import init_actions_bird as _init_actions
-    else:
-        raise ValueError(f"dataset: {dataset} is not supported.")
+    _init_actions = get_init_actions(dataset)
 
     _actions = [None, None, None, None]
-    SearchColumn, SearchValue, FindShortestPath, ExecuteSQL = _init_actions(db=db)
+    SearchColumn, SearchValue, FindShortestPath, ExecuteSQL = yield (
+        "call",
+        functools.partial(_init_actions, db=db),
+    )
     _actions[0] = SearchColumn
     _actions[1] = SearchValue
     _actions[2] = FindShortestPath
@@ -265,21 +612,118 @@ def chat_with_LLM(
     # history: all inp and out
     history = []
 
+    # resume from the rounds checkpointed by an earlier run, else start a
+    # retry from the `prefix` rounds of the attempt before.
+    ckpt, ckpt_key = None, (d["id"], cache_salt or 0)
+    rounds = []
+    if checkpoint:
+        ckpt = yield ("call", functools.partial(get_checkpoint, save_dir))
+        rounds = ckpt.rounds(ckpt_key)
+        if rounds:
+            logger.info(f"Resume {d['id']} from round {rounds[-1]['round_idx']}.")
+    if not rounds and prefix:
+        rounds = prefix
+        if ckpt is not None:
+            for r in prefix:
+                yield ("call", functools.partial(ckpt.append, ckpt_key, r))
+    for r in rounds:
+        messages.extend(r["messages"])
+        round_idx = r["round_idx"]
+        _last_out = r["last_out"]
+        prompt_tokens.append(r["prompt_tokens"])
+        completion_tokens.append(r["completion_tokens"])
+        ttft.append(r.get("ttft"))
+        if r.get("tokens_saved") is not None:
+            tokens_saved.append(r["tokens_saved"])
+        _restore_flags(_actions[3], r)
+
+    budgets = {
+        "time": time_budget,
+        "prompt_tokens": prompt_budget,
+        "completion_tokens": completion_budget,
+    }
+    # the budget about to run out, the round after it is the last one.
+    finish = None
+    start, rounds_run = time.monotonic(), 0
+    # reported / counted prompt tokens of the last round: `count_message_tokens`
+    # is only an estimate of what the API charges.
+    prompt_scale = 1.0
+
     while round_idx < max_round_num:
         if round_idx > 0:
             logger.debug(f"round_idx: {round_idx}")
 
+        send_messages = messages
+        if history_budget:
+            send_messages, _saved = compact_history(messages, history_budget)
+            tokens_saved.append(_saved)
+
+        if finish is None and any(v is not None for v in budgets.values()):
+            elapsed = time.monotonic() - start
+            next_round, growth = {}, {}
+            if rounds_run:
+                next_round["time"] = elapsed / rounds_run
+                next_round["completion_tokens"] = sum(completion_tokens) / len(
+                    completion_tokens
+                )
+            if prompt_budget is not None:
+                # the prompt of the next round as it would be sent with
+                # FINISH_PROMPT, and the history the last round added to it.
+                next_round["prompt_tokens"] = prompt_scale * count_message_tokens(
+                    send_messages + [{"role": "user", "content": FINISH_PROMPT}]
+                )
+                if prompt_tokens:
+                    growth["prompt_tokens"] = max(
+                        0, next_round["prompt_tokens"] - prompt_tokens[-1]
+                    )
+            finish, last = _near_budget(
+                budgets,
+                spent={
+                    "time": elapsed,
+                    "prompt_tokens": sum(prompt_tokens),
+                    "completion_tokens": sum(completion_tokens),
+                },
+                next_round=next_round,
+                growth=growth,
+            )
+            if finish and not last:
+                logger.info(f"{d['id']}: {finish} budget used up, stop.")
+                if history_budget:
+                    tokens_saved.pop()  # of the round that is not sent
+                messages.append({"role": "user", "content": "STOP because of budget."})
+                break
+            if finish:
+                logger.info(f"{d['id']}: {finish} budget almost used up, finish now.")
+        if finish:
+            send_messages = send_messages[:-1] + [
+                {
+                    "role": send_messages[-1]["role"],
+                    "content": send_messages[-1]["content"] + FINISH_PROMPT,
+                }
+            ]
+
+        # a timed-out dialog runs on in its thread, stop it before it spends
+        # tokens on another request.
+        check_deadline()
         try:
-            response = chatgpt(
-                model=model_name,
-                # db=db,
-                messages=messages,
-                stop=["\nObservation", "\nThought", "[END]"],
-                temperature=0.7,
-                max_tokens=512,
-                n=1,
+            response = yield (
+                "llm",
+                dict(
+                    model=model_name,
+                    # db=db,
+                    messages=send_messages,
+                    stop=["\nObservation", "\nThought", "[END]"],
+                    temperature=0.7,
+                    max_tokens=512,
+                    n=n,
+                    cache_salt=cache_salt,
+                    # only when on, so recorded traces keep their request hash.
+                    **({"stream": True} if stream else {}),
+                ),
             )
-        except BadRequestError as e:
+        except Exception as e:
+            if not is_bad_request(e):
+                raise
             logger.error(f"BadRequestError: {e}")
             return
         if response is None:
@@ -290,7 +734,13 @@ def chat_with_LLM(
             return
 
         prompt_tokens.append(response["usage"]["prompt_tokens"])
+        if prompt_budget is not None:
+            prompt_scale = prompt_tokens[-1] / max(
+                1, count_message_tokens(send_messages)
+            )
         completion_tokens.append(response["usage"]["completion_tokens"])
+        ttft.append(response.get("ttft"))
+        rounds_run += 1
 
         # Preprocessing
         choices = [r["message"]["content"].strip() for r in response["choices"]]
@@ -310,16 +760,19 @@ def chat_with_LLM(
         history.append({"round_idx": round_idx, "choices": choices})
 
         # Try to execute the first valid action in actions as default observation
+        # the ranked candidates run together with it, see `_execute_candidates`.
         out_thought_action = choices[0].strip()
-        Observation = parse_action(out_thought_action, execute=True, _actions=_actions)
+        observations = yield from _execute_candidates(
+            [out_thought_action] + ranked_choicess, _actions, tool_memo, tool_stats
+        )
+        Observation = observations[0]
 
         # time out
         if Observation is None:
             return
 
         # If there is a valid observation, use this observation
-        for content in ranked_choicess:
-            _obs = parse_action(content, execute=True, _actions=_actions)
+        for content, _obs in zip(ranked_choicess, observations[1:]):
             if is_valid_result(_obs):
                 Observation = _obs
                 # Note: the content here is the raw model output, not cleaned
@@ -332,7 +785,7 @@ def chat_with_LLM(
         # if "(Hint: DOUBLE-CHECK the requirements" in Observation:
         #     _actions[3].set_flag1()
         if "(Hint: DOUBLE-CHECK the columns" in Observation:
-            _actions[3].set_flag2()
+            _actions[3].set_flag()
 
         if out_thought_action == _last_out:
             messages.append({"role": "user", "content": "STOP because of repetition."})
@@ -376,6 +829,23 @@ def chat_with_LLM(
                 )
                 round_idx += 1
 
+        if ckpt is not None:
+            record = {
+                "round_idx": round_idx,
+                "messages": messages[-2:],
+                "last_out": _last_out,
+                "prompt_tokens": prompt_tokens[-1],
+                "completion_tokens": completion_tokens[-1],
+                "ttft": ttft[-1],
+                "tokens_saved": tokens_saved[-1] if history_budget else None,
+                "flags": _tool_flags(_actions[3]),
+            }
+            yield ("call", functools.partial(ckpt.append, ckpt_key, record))
+
+        if finish:
+            messages.append({"role": "user", "content": "STOP because of budget."})
+            break
+
         # debug
         # break
 
@@ -385,9 +855,341 @@ def chat_with_LLM(
     d["model_name"] = model_name
     d["completion_tokens"] = completion_tokens
     d["prompt_tokens"] = prompt_tokens
+    d["tool_calls"] = dict(tool_stats)
+    if stream:
+        d["ttft"] = ttft
+    if any(v is not None for v in budgets.values()):
+        d["budget"] = {
+            **budgets,
+            "stopped": finish,
+            "best_sql": best_sql(messages) if finish else None,
+        }
+    if history_budget:
+        d["compaction"] = {
+            "budget": history_budget,
+            "tokens_saved": tokens_saved,
+            "total_saved": sum(tokens_saved),
+        }
+    return d
+
+
+def _run_step(kind, payload, key):
+    """
+    Execute one step of a `_dialog`, recording or replaying it (see tool/trace.py),
+    in a span (see tool/spans.py).
+    key: (id, attempt) of the dialog.
+    """
+    t = time.time()
+    if kind == "llm":
+        spans.annotate(round=_round_of(payload))
+        with spans.span(
+            "llm", kind="SPAN_KIND_CLIENT", **{"gen_ai.request.model": payload["model"]}
+        ) as s:
+            if trace.replayer is not None:
+                value = trace.replayer.llm(key, payload)
+            else:
+                value = chatgpt(**payload)
+                if trace.recorder is not None:
+                    trace.recorder.llm(key, payload, value, time.time() - t)
+            s.set(**_llm_outcome(value))
+        return value
+
+    if kind == "tools":
+        return _run_tools(payload, key)
+
+    if kind == "call":
+        with spans.span("call", **{"call.name": _func_name(payload)}):
+            return payload()
+
+    with spans.span("tool", **{"tool.name": _tool_name(payload)}) as s:
+        value = payload()
+        s.set(outcome=_tool_outcome(value))
+    _trace_tool(key, payload, value, time.time() - t)
+    return value
+
+
+def _round_of(request: dict):
+    return sum(m["role"] == "assistant" for m in request["messages"])
+
+
+def _llm_outcome(response):
+    if not response or "usage" not in response:
+        return {"outcome": "error"}
+    return {
+        "outcome": "ok",
+        "gen_ai.usage.input_tokens": response["usage"]["prompt_tokens"],
+        "gen_ai.usage.output_tokens": response["usage"]["completion_tokens"],
+    }
+
+
+def _func_name(func):
+    func = getattr(func, "func", func)
+    return getattr(func, "__qualname__", repr(func))
+
+
+def _tool_name(payload):
+    action = parse_action(payload.args[0], execute=False)
+    # "Done", or "Error" for actions that do not parse.
+    return action.split("(")[0] if action.startswith(TOOLS) else action.split(":")[0]
+
+
+def _tool_outcome(value):
+    if value is None:
+        return "timeout"
+    if is_valid_result(value):
+        return "ok"
+    return "error" if "Error" in str(value) else "empty"
+
+
+# shared by the dialogs of a process for ("tools", ...) steps.
+_tool_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("TOOL_WORKERS", 32)), thread_name_prefix="tool"
+)
+
+
+def _run_tools(funcs, key):
+    if len(funcs) == 1:
+        return [_run_step("tool", funcs[0], key)]
+    # copy the context, so the tools see the caller's deadline.
+    futures = [
+        _tool_pool.submit(
+            contextvars.copy_context().run,
+            spans.queued(_run_step, "queue.tool"),
+            "tool",
+            f,
+            key,
+        )
+        for f in funcs
+    ]
+    return [f.result() for f in futures]
+
+
+async def _arun_step(kind, payload, key, executor=None):
+    t = time.time()
+    if kind == "llm":
+        spans.annotate(round=_round_of(payload))
+        with spans.span(
+            "llm", kind="SPAN_KIND_CLIENT", **{"gen_ai.request.model": payload["model"]}
+        ) as s:
+            if trace.replayer is not None:
+                value = trace.replayer.llm(key, payload)
+            else:
+                value = await achatgpt(**payload)
+                if trace.recorder is not None:
+                    trace.recorder.llm(key, payload, value, time.time() - t)
+            s.set(**_llm_outcome(value))
+        return value
+
+    if kind == "tools":
+        return list(
+            await asyncio.gather(
+                *[_arun_step("tool", f, key, executor=executor) for f in payload]
+            )
+        )
+
+    # the sync step in the pool, with the caller's context for its span.
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor,
+        contextvars.copy_context().run,
+        spans.queued(_run_step, f"queue.{kind}"),
+        kind,
+        payload,
+        key,
+    )
+
 
-    save_to_json(d, f"{save_dir}/{d['id']}.json")
-    return f"{save_dir}/{d['id']}.json"
+def _trace_tool(key, payload, value, latency):
+    action = payload.args[0]
+    if trace.recorder is not None:
+        trace.recorder.tool(key, action, value, latency)
+    if trace.replayer is not None:
+        trace.replayer.check_tool(key, action, value)
+
+
+def _advance(gen, value=None, error=None, key=None):
+    """
+    Run a `_dialog` generator up to its next ("llm", kwargs) step, sending in
+    `value` (or throwing `error`) first.
+    Return: ("llm", kwargs), or ("done", return value of the dialog).
+    """
+    while True:
+        try:
+            kind, payload = gen.throw(error) if error else gen.send(value)
+        except StopIteration as e:
+            return "done", e.value
+        if kind == "llm":
+            return kind, payload
+        value, error = None, None
+        try:
+            value = _run_step(kind, payload, key)
+        except Exception as e:
+            error = e
+
+
+def _drive(gen, key=None):
+    """
+    Run a `_dialog` generator in the calling thread.
+    """
+    value, error = None, None
+    while True:
+        kind, payload = _advance(gen, value, error, key)
+        if kind == "done":
+            return payload
+        value, error = None, None
+        try:
+            value = _run_step(kind, payload, key)
+        except Exception as e:
+            error = e
+
+
+async def _adrive(gen, key=None, executor=None):
+    """
+    Run a `_dialog` generator on the event loop, blocking calls go to `executor`.
+    """
+    value, error = None, None
+    while True:
+        try:
+            kind, payload = gen.throw(error) if error else gen.send(value)
+        except StopIteration as e:
+            return e.value
+        value, error = None, None
+        try:
+            value = await _arun_step(kind, payload, key, executor=executor)
+        except Exception as e:
+            error = e
+
+
+# hard limit of a dialog without a time budget, in seconds.
+DIALOG_TIMEOUT = 60 * 5
+# with one, the finish round may run a little past it before the hard limit.
+BUDGET_GRACE = 30
+
+
+def _dialog_timeout(*args, time_budget=None, **kwargs):
+    if time_budget is None:
+        return DIALOG_TIMEOUT
+    return time_budget + BUDGET_GRACE
+
+
+def _dialog_span(d: dict, dataset, cache_salt=None):
+    return spans.span(
+        "dialog",
+        **{
+            "dialog.id": d["id"],
+            "db_id": d["db_id"],
+            "dataset": dataset,
+            "attempt": cache_salt or 0,
+        },
+    )
+
+
+def _dialog_outcome(d):
+    if d is None:
+        return "aborted"
+    if d.get("budget", {}).get("stopped"):
+        return "budget"
+    return "ok" if is_valid_result(last_observation(d["dialog"])) else "empty"
+
+
+@retry_no_empty
+@timeout(_dialog_timeout)
+def chat_with_LLM(
+    d: dict,
+    model_name: str,
+    dataset: str,
+    save_dir: str = None,
+    tooldesc_demos: str = None,
+    max_round_num: int = 8,
+    add_evidence=False,
+    history_budget: int = None,
+    cache_salt=None,
+    stream=False,
+    checkpoint=False,
+    prefix=None,
+    time_budget: float = None,
+    prompt_budget: int = None,
+    completion_budget: int = None,
+    n: int = 1,
+):
+    with _dialog_span(d, dataset, cache_salt) as s:
+        res = _drive(
+            _dialog(
+                d,
+                model_name=model_name,
+                dataset=dataset,
+                save_dir=save_dir,
+                tooldesc_demos=tooldesc_demos,
+                max_round_num=max_round_num,
+                add_evidence=add_evidence,
+                history_budget=history_budget,
+                cache_salt=cache_salt,
+                stream=stream,
+                checkpoint=checkpoint,
+                prefix=prefix,
+                time_budget=time_budget,
+                prompt_budget=prompt_budget,
+                completion_budget=completion_budget,
+                n=n,
+            ),
+            key=(d["id"], cache_salt or 0),
+        )
+        s.set(outcome=_dialog_outcome(res))
+    return res
+
+
+@aretry_no_empty
+async def achat_with_LLM(
+    d: dict,
+    model_name: str,
+    dataset: str,
+    save_dir: str = None,
+    tooldesc_demos: str = None,
+    max_round_num: int = 8,
+    add_evidence=False,
+    history_budget: int = None,
+    cache_salt=None,
+    stream=False,
+    checkpoint=False,
+    prefix=None,
+    time_budget: float = None,
+    prompt_budget: int = None,
+    completion_budget: int = None,
+    n: int = 1,
+    executor=None,
+):
+    """
+    Async variant of `chat_with_LLM`.
+    executor: pool for the blocking tools, None for the loop default.
+    """
+    with _dialog_span(d, dataset, cache_salt) as s:
+        res = await asyncio.wait_for(
+            _adrive(
+                _dialog(
+                    d,
+                    model_name=model_name,
+                    dataset=dataset,
+                    save_dir=save_dir,
+                    tooldesc_demos=tooldesc_demos,
+                    max_round_num=max_round_num,
+                    add_evidence=add_evidence,
+                    history_budget=history_budget,
+                    cache_salt=cache_salt,
+                    stream=stream,
+                    checkpoint=checkpoint,
+                    prefix=prefix,
+                    time_budget=time_budget,
+                    prompt_budget=prompt_budget,
+                    completion_budget=completion_budget,
+                    n=n,
+                ),
+                key=(d["id"], cache_salt or 0),
+                executor=executor,
+            ),
+            timeout=_dialog_timeout(time_budget=time_budget),
+        )
+        s.set(outcome=_dialog_outcome(res))
+    return res
 
 
 if __name__ == "__main__":
@@ -0,0 +1,189 @@
+import ast
+import copy
+import functools
+import time
+from collections import Counter
+from glob import glob
+
+"""
+Literal-only parser for model actions, replaces `eval` on model output.
+
+An action is one call of a known tool whose arguments are literals:
+    ExecuteSQL("SELECT name FROM singer")
+    SearchColumn(["singer name", "age"], topk=5)
+    FindShortestPath(start="singer.name", end=["concert.year"])
+The text is parsed into an AST and checked node by node, nothing is executed.
+"""
+
+TOOLS = ("SearchColumn", "SearchValue", "FindShortestPath", "ExecuteSQL")
+
+
+class ActionSyntaxError(ValueError):
+    pass
+
+
+# what `ast.parse` / `ast.literal_eval` raise on bad model output: non-literals,
+# unhashable keys (`{[1]: 2}`), null bytes, nesting too deep to parse.
+_LITERAL_ERRORS = (ValueError, TypeError, SyntaxError, MemoryError, RecursionError)
+
+
+def _unparse(node: ast.AST):
+    try:
+        return ast.unparse(node)
+    except RecursionError:
+        return "..."
+
+
+def _literal(node: ast.AST, what: str):
+    try:
+        return ast.literal_eval(node)
+    except _LITERAL_ERRORS:
+        raise ActionSyntaxError(
+            f"{what} must be a literal (string, number, list, ...), "
+            f"got `{_unparse(node)}` at column {node.col_offset + 1}"
+        ) from None
+
+
+@functools.lru_cache(maxsize=8192)
+def _parse_call(action_str: str):
+    try:
+        tree = ast.parse(action_str.strip(), mode="eval")
+    except SyntaxError as e:
+        where = f" at column {e.offset}" if e.offset else ""
+        raise ActionSyntaxError(f"invalid syntax{where}: {e.msg}") from None
+    except _LITERAL_ERRORS as e:
+        raise ActionSyntaxError(f"invalid action: {e.__class__.__name__}") from None
+
+    call = tree.body
+    if not isinstance(call, ast.Call):
+        raise ActionSyntaxError(f"expected `Tool(...)`, got `{_unparse(call)}`")
+    if not isinstance(call.func, ast.Name) or call.func.id not in TOOLS:
+        raise ActionSyntaxError(
+            f"unknown tool `{_unparse(call.func)}`, must be one of {list(TOOLS)}"
+        )
+
+    tool = call.func.id
+    args = []
+    for i, arg in enumerate(call.args, 1):
+        if isinstance(arg, ast.Starred):
+            raise ActionSyntaxError(f"`*` arguments are not supported in {tool}")
+        args.append(_literal(arg, f"argument {i} of {tool}"))
+    kwargs = {}
+    for kw in call.keywords:
+        if kw.arg is None:
+            raise ActionSyntaxError(f"`**` arguments are not supported in {tool}")
+        kwargs[kw.arg] = _literal(kw.value, f"argument `{kw.arg}` of {tool}")
+    return tool, tuple(args), kwargs
+
+
+def parse_call(action_str: str):
+    """
+    Return: (tool, args, kwargs) of `Tool(arg, ..., key=arg)`.
+    Raise: ActionSyntaxError with the reason and column.
+    """
+    tool, args, kwargs = _parse_call(action_str)
+    # the parse is cached, tools must not share mutable arguments.
+    return tool, copy.deepcopy(args), copy.deepcopy(kwargs)
+
+
+@functools.lru_cache(maxsize=8192)
+def parse_literal(text: str):
+    """
+    `ast.literal_eval` with a cache, for hot paths. Do not mutate the result.
+    Raise: ValueError / SyntaxError if `text` is not a literal.
+    """
+    return ast.literal_eval(text.strip())
+
+
+def benchmark(pattern="save-crossdb-infer-dialog/*/*/*/*.json", repeat=5):
+    """
+    Parse every assistant action of the saved dialogs with `eval` (the old way,
+    tools replaced by stubs) and with `parse_call`.
+    Report latency per action and the actions that made `eval` run code beyond
+    the tool call itself.
+    """
+    from tool.action_execution import parse_action
+    from utils import read_json
+
+    actions = []
+    for p in sorted(glob(pattern)):
+        for m in read_json(p).get("dialog", [])[2:]:
+            if m["role"] != "assistant":
+                continue
+            action = parse_action(m["content"], execute=False)
+            if action and not action.startswith(("Error", "Done")):
+                actions.append(action)
+    print(f"{len(actions)} actions from {pattern}")
+    if not actions:
+        return
+
+    calls = Counter()
+
+    def _stub(name):
+        def stub(*args, **kwargs):
+            calls[name] += 1
+
+        return stub
+
+    namespace = {name: _stub(name) for name in TOOLS}
+
+    def run_eval():
+        ok = 0
+        for a in actions:
+            try:
+                eval(a, {"__builtins__": {}}, dict(namespace))
+                ok += 1
+            except Exception:
+                pass
+        return ok
+
+    def run_parser(cold):
+        if cold:
+            _parse_call.cache_clear()
+        ok, errors = 0, Counter()
+        for a in actions:
+            try:
+                parse_call(a)
+                ok += 1
+            except ActionSyntaxError as e:
+                errors[str(e).split(",")[0][:60]] += 1
+        return ok, errors
+
+    def timed(func, *args):
+        best = float("inf")
+        for _ in range(repeat):
+            t = time.perf_counter()
+            res = func(*args)
+            best = min(best, time.perf_counter() - t)
+        return res, best / len(actions) * 1e6
+
+    eval_ok, eval_us = timed(run_eval)
+    (cold_ok, errors), cold_us = timed(run_parser, True)
+    _, warm_us = timed(run_parser, False)
+
+    # eval ran code beyond the tool call: accepted by eval, rejected as non-literal.
+    executed = 0
+    for a in actions:
+        try:
+            eval(a, {"__builtins__": {}}, dict(namespace))
+        except Exception:
+            continue
+        try:
+            parse_call(a)
+        except ActionSyntaxError:
+            executed += 1
+
+    print(f"eval:            {eval_ok}/{len(actions)} ok, {eval_us:.1f} us/action")
+    print(f"parse_call cold: {cold_ok}/{len(actions)} ok, {cold_us:.1f} us/action")
+    print(f"parse_call warm: {cold_ok}/{len(actions)} ok, {warm_us:.1f} us/action")
+    print(f"actions where eval ran non-literal code: {executed}, parse_call: 0")
+    for reason, count in errors.most_common(10):
+        print(f"  rejected {count}: {reason}")
+
+
+if __name__ == "__main__":
+    # python -m tool.action_parser
+    # python -m tool.action_parser --pattern "save-crossdb-infer-dialog/spider-dev/*/v1/*.json"
+    import fire
+
+    fire.Fire(benchmark)
@@ -0,0 +1,231 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from tool import openai_api, trace
+
+"""
+Round-synchronous batch execution, see `run_round`.
+
+Every round, the LLM requests of all active dialogs go into one JSONL file in
+the OpenAI Batch format:
+    {"custom_id": "..", "method": "POST", "url": "/v1/chat/completions", "body": {..}}
+and the results come back as:
+    {"id": "..", "custom_id": "..", "response": {"status_code": 200, "body": {..}}, "error": null}
+
+OpenAIBatch submits the file to the Batch API and polls until it is done.
+LocalBatch is a stand-in that serves the file with the configured backend
+(see `tool.openai_api.set_backend`), for tests without the Batch API.
+"""
+
+ENDPOINT = "/v1/chat/completions"
+
+# error codes of a batch request without an HTTP status that are worth sending
+# again, as `openai_api._is_retryable` does online: requests a batch did not
+# get to before it expired / was cancelled, and timeouts / connection errors.
+RETRYABLE_CODES = {
+    "batch_expired",
+    "batch_cancelled",
+    "rate_limit_exceeded",
+    "server_error",
+    "timeout",
+    "APITimeoutError",
+    "APIConnectionError",
+}
+
+
+class BatchRequestError(RuntimeError):
+    """
+    A failed request of a batch.
+    retryable: a 429, 5xx, expired, ... worth sending in the next round.
+    """
+
+    def __init__(self, message, retryable=False) -> None:
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class OpenAIBatch:
+    def __init__(self, poll_interval=60, completion_window="24h") -> None:
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+
+    def run(self, input_path, output_path):
+        client = openai_api.get_client()
+        with open(input_path, "rb") as f:
+            batch_file = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint=ENDPOINT,
+            completion_window=self.completion_window,
+        )
+        logger.info(f"Submitted batch {batch.id}: {input_path}")
+        while batch.status not in ["completed", "failed", "expired", "cancelled"]:
+            time.sleep(self.poll_interval)
+            batch = client.batches.retrieve(batch.id)
+            logger.debug(f"Batch {batch.id}: {batch.status} {batch.request_counts}")
+
+        # an expired batch still returns the finished part, the requests without
+        # a result are sent again in the next round.
+        if not (batch.output_file_id or batch.error_file_id) and batch.status not in [
+            "expired",
+            "cancelled",
+        ]:
+            raise RuntimeError(f"Batch {batch.id} {batch.status}: {batch.errors}")
+        with open(output_path, "w", encoding="utf-8") as f:
+            for file_id in [batch.output_file_id, batch.error_file_id]:
+                if file_id:
+                    f.write(client.files.content(file_id).text.rstrip("\n") + "\n")
+        logger.info(f"Batch {batch.id} {batch.status}: {batch.request_counts}")
+        return output_path
+
+
+class LocalBatch:
+    """
+    Serves a batch file with `openai_api.backend`, `concurrency` requests at a time.
+    """
+
+    def __init__(self, concurrency=64) -> None:
+        self.concurrency = concurrency
+
+    def _one(self, line):
+        r = json.loads(line)
+        try:
+            body = openai_api.backend.chat(r["body"])
+            return {
+                "id": f"batch_req_{r['custom_id']}",
+                "custom_id": r["custom_id"],
+                "response": {"status_code": 200, "body": body},
+                "error": None,
+            }
+        except Exception as e:
+            status_code = getattr(e, "status_code", None)
+            if status_code is not None:
+                # as the Batch API reports a failed request.
+                return {
+                    "id": f"batch_req_{r['custom_id']}",
+                    "custom_id": r["custom_id"],
+                    "response": {
+                        "status_code": status_code,
+                        "body": {"error": {"message": str(e)}},
+                    },
+                    "error": None,
+                }
+            return {
+                "id": f"batch_req_{r['custom_id']}",
+                "custom_id": r["custom_id"],
+                "response": None,
+                "error": {"code": e.__class__.__name__, "message": str(e)},
+            }
+
+    def run(self, input_path, output_path):
+        with open(input_path, encoding="utf-8") as f:
+            lines = [line for line in f if line.strip()]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = list(executor.map(self._one, lines))
+        with open(output_path, "w", encoding="utf-8") as f:
+            for r in results:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+        return output_path
+
+
+def get_batch_runner(spec="openai", poll_interval=60):
+    """
+    spec: "openai" (the Batch API) or "local" (the stand-in).
+    """
+    if spec == "openai":
+        return OpenAIBatch(poll_interval=poll_interval)
+    if spec == "local":
+        return LocalBatch()
+    raise ValueError(f"batch runner: {spec} is not supported.")
+
+
+def read_batch_output(path):
+    """
+    Return: {custom_id: response body, or a BatchRequestError}
+    """
+    results = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            r = json.loads(line)
+            response = r.get("response") or {}
+            if r.get("error"):
+                results[r["custom_id"]] = BatchRequestError(
+                    f"Batch request failed: {r['error']}",
+                    retryable=r["error"].get("code") in RETRYABLE_CODES,
+                )
+            elif response.get("status_code") != 200:
+                status_code = response.get("status_code") or 0
+                results[r["custom_id"]] = BatchRequestError(
+                    f"Batch request failed: {status_code} "
+                    f"{(response.get('body') or {}).get('error')}",
+                    retryable=openai_api._is_retryable_status(status_code),
+                )
+            else:
+                results[r["custom_id"]] = response["body"]
+    return results
+
+
+def run_round(runner, requests: dict, batch_dir, round_idx):
+    """
+    One round of LLM requests as one batch.
+    requests: {custom_id: (kwargs of `chatgpt`, trace key)}
+    Return: {custom_id: response, or a BatchRequestError, see `retryable`}
+    """
+    results = {}
+    bodies = {}
+    for custom_id, (kwargs, _key) in requests.items():
+        body = openai_api._chat_request(**kwargs)
+        body.pop("stream", None)
+        body.pop("stream_options", None)
+        if openai_api.llm_cache is not None:
+            cached = openai_api.llm_cache.get(
+                openai_api.llm_cache.key(body, salt=kwargs.get("cache_salt"))
+            )
+            if cached is not None:
+                results[custom_id] = cached
+                continue
+        bodies[custom_id] = body
+
+    logger.info(
+        f"Round {round_idx}: {len(requests)} requests, "
+        f"{len(requests) - len(bodies)} cached, {len(bodies)} in batch."
+    )
+    if not bodies:
+        return results
+
+    os.makedirs(batch_dir, exist_ok=True)
+    input_path = f"{batch_dir}/round-{round_idx}.jsonl"
+    output_path = f"{batch_dir}/round-{round_idx}.output.jsonl"
+    with open(input_path, "w", encoding="utf-8") as f:
+        for custom_id, body in bodies.items():
+            line = {"custom_id": custom_id, "method": "POST", "url": ENDPOINT}
+            line["body"] = body
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+    t = time.time()
+    output = read_batch_output(runner.run(input_path, output_path))
+    latency = time.time() - t
+    for custom_id, body in bodies.items():
+        response = output.get(custom_id)
+        if response is None:
+            response = BatchRequestError(
+                f"Batch returned no result for {custom_id}.", retryable=True
+            )
+        results[custom_id] = response
+        if isinstance(response, Exception):
+            continue
+        kwargs, key = requests[custom_id]
+        if openai_api.llm_cache is not None:
+            openai_api.llm_cache.put(
+                openai_api.llm_cache.key(body, salt=kwargs.get("cache_salt")),
+                response,
+            )
+        if trace.recorder is not None:
+            trace.recorder.llm(key, kwargs, response, latency)
+    return results
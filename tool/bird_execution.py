@@ -5,7 +5,7 @@ from tool.utils import (
     contain_multi_columns_in_select_clause,
     contain_op_in_select_clause,
 )
-from utils import timeout
+from utils import deadline_exceeded, timeout
 
 
 def create_execute_sql(db, _hint=True):
@@ -32,6 +32,8 @@ def create_execute_sql(db, _hint=True):
         _sql = sql.lower()
 
         conn = sqlite3.connect(db_file)
+        # abort the query once the caller's deadline has passed.
+        conn.set_progress_handler(lambda: int(deadline_exceeded()), 10000)
         cursor = conn.cursor()
 
         nonlocal FLAG
@@ -55,11 +57,12 @@ def create_execute_sql(db, _hint=True):
                 ):
                     result += " (Hint: DOUBLE-CHECK the columns in the SELECT clause, do not select irrelevant columns, and the order of the columns must strictly match the requirements of the question. Re-call ExecuteSQL function if necessary.)"
 
-            cursor.close()
             return result
         except Exception as e:
-            cursor.close()
             return str(e)
+        finally:
+            cursor.close()
+            conn.close()
 
     execute_sql.set_flag = set_flag
     execute_sql.get_flag = get_flag
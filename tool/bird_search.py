@@ -1,9 +1,11 @@
+import functools
 import os
 from glob import glob
 from typing import List, Union
 
 from loguru import logger
 
+from tool.action_parser import parse_literal
 from tool.openai_api import get_embedding_batch
 from tool.spider_search import GraphSearcher
 from tool.utils import init_chroma_client, is_dict
@@ -12,6 +14,7 @@ from utils import read_json, timeout
 COL_VEC_PKL_FILE = "database/cache_vector_db/bird_cols_tb_name_coldesc_3_large.pkl"
 
 
+@functools.lru_cache()
 def load_bird_dbs():
     paths = glob("database/cols_info/bird/*.json")
     paths.sort()
@@ -93,7 +96,7 @@ def create_column_searcher(db):
                 if "statistics" in metadata:
                     _vd = metadata["statistics"]
                     if is_dict(_vd):
-                        _vd = list(eval(_vd).keys())
+                        _vd = list(parse_literal(_vd).keys())
                         _vd = f"categorical field. {_vd}"
                         if len(_vd) > 400:
                             _vd = _vd[:400] + f"...(Omit {len(_vd) - 400} chars)"
@@ -145,26 +148,29 @@ class GraphSearcherBIRD(GraphSearcher):
         self._nx_tmp_dir = ".tmp/nx/bird"
         os.makedirs(self._nx_cache_dir, exist_ok=True)
         os.makedirs(self._nx_tmp_dir, exist_ok=True)
-        self._node_pair_to_edge = {}  # {db: {(n1,n2):edge, ...}, db2:...}
-        self._G = {}  # {db: nx.Graph}
 
     def _get_sqlite_file(self, db: str):
         return get_sqlite_file(db)
 
 
-g_searcher = GraphSearcherBIRD()
+@functools.lru_cache()
+def get_searcher():
+    # built on first use, not at import.
+    return GraphSearcherBIRD()
 
 
 def create_path_finder(db: str):
-    global g_searcher
-    # for init
-    g_searcher.find_shortest_path(db=db, start="!@#$%^", end="!@#$%^")
+    g_searcher = get_searcher()
+    # owned by the finder, freed with it.
+    graph = g_searcher.load_graph(db)
 
     @timeout(60)
     def _find_shortest_path(
         start: Union[str, List[str]], end: Union[str, List[str]], debug=False
     ):
-        return g_searcher.find_shortest_path(db=db, start=start, end=end, debug=debug)
+        return g_searcher.find_shortest_path(
+            db=db, start=start, end=end, debug=debug, graph=graph
+        )
 
     return _find_shortest_path
 
@@ -172,15 +178,19 @@ def create_path_finder(db: str):
 # -------------------------- search value -------------------------- #
 
 
+@functools.lru_cache()
+def load_db_has_text_filed_list():
+    return set(read_json("preprocess/bird_db_has_text_filed_list.json"))
+
+
 def create_value_searcher(db):
     """
     db_has_text_filed_list: Output by preprocess/bird_db_indexing_es.py
     """
-    db_has_text_filed_list = read_json("preprocess/bird_db_has_text_filed_list.json")
-    if db in db_has_text_filed_list:
-        from tool.client_es import ESClient
+    if db in load_db_has_text_filed_list():
+        from tool.client_es import get_es_client
 
-        es_client = ESClient()
+        es_client = get_es_client()
         FLAG_GO = True
     else:
         FLAG_GO = False
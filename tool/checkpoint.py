@@ -0,0 +1,105 @@
+import json
+import os
+import threading
+from collections import defaultdict
+
+from loguru import logger
+
+from tool.jsonl import AppendLog
+
+"""
+Per-round checkpoints of the dialogs of a run, see `_dialog(checkpoint=True)`.
+
+`{save_dir}/checkpoint.jsonl` gets one line per completed round:
+    {"id": .., "attempt": 0, "round_idx": 1, "messages": [assistant, observation],
+     "last_out": "..", "prompt_tokens": 1200, "completion_tokens": 40,
+     "flags": {"flag": true, "alias_flag": false}, ...}
+A restarted run replays these lines into the dialog and continues from the
+next round, so finished rounds are never requested (and paid) again.
+`compact` drops the lines of the dialogs the manifest has as finished, a run
+calls it before it starts, so the file only holds the unfinished dialogs.
+
+The lines are left to the OS to write out, a round survives a crash of the
+process, not a power loss (that costs the round again, not the result). Set
+CHECKPOINT_FSYNC=1 to fsync every line. A line cut by a crash is skipped on load.
+"""
+
+FSYNC = os.environ.get("CHECKPOINT_FSYNC", "0") != "0"
+
+_checkpoints = {}
+_lock = threading.Lock()
+
+
+def get_checkpoint(save_dir):
+    """
+    Return: the process-wide Checkpoint of `save_dir`, loaded on first use.
+    """
+    with _lock:
+        if save_dir not in _checkpoints:
+            _checkpoints[save_dir] = Checkpoint(f"{save_dir}/checkpoint.jsonl")
+        return _checkpoints[save_dir]
+
+
+def compact(save_dir, done_ids):
+    """
+    Rewrite `{save_dir}/checkpoint.jsonl` without the lines of `done_ids` and
+    the lines cut by a crash. Run it before any dialog appends to the file.
+    Return: number of lines dropped.
+    """
+    path = f"{save_dir}/checkpoint.jsonl"
+    if not os.path.exists(path):
+        return 0
+    dropped = 0
+    tmp = f"{path}.tmp"
+    with open(path, "rb") as f, open(tmp, "wb") as out:
+        for line in f:
+            try:
+                r = json.loads(line)
+            except ValueError:
+                dropped += 1
+                continue
+            if r["id"] in done_ids:
+                dropped += 1
+                continue
+            out.write(line if line.endswith(b"\n") else line + b"\n")
+    if not dropped:
+        os.remove(tmp)
+        return 0
+    with _lock:
+        ckpt = _checkpoints.pop(save_dir, None)
+        if ckpt is not None:
+            ckpt._log.close()
+        os.replace(tmp, path)
+    logger.info(f"Compacted {path}: dropped {dropped} lines of finished dialogs.")
+    return dropped
+
+
+class Checkpoint:
+    def __init__(self, path, fsync=None) -> None:
+        self.path = path
+        self._rounds = defaultdict(list)  # (id, attempt) -> records in order
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        r = json.loads(line)
+                    except ValueError:
+                        # the last line of a crashed run may be cut.
+                        continue
+                    self._rounds[(r["id"], r["attempt"])].append(r)
+            logger.info(f"Loaded checkpoints of {len(self._rounds)} dialogs: {path}")
+        # a cut last line is ended before the first round is appended to it.
+        self._log = AppendLog(path, fsync=FSYNC if fsync is None else fsync)
+
+    def rounds(self, key):
+        """
+        key: (id, attempt)
+        Return: the completed rounds of the dialog, oldest first.
+        """
+        with self._lock:
+            return list(self._rounds.get(key, []))
+
+    def append(self, key, record: dict):
+        # only written, resumes read what was there when the run started.
+        self._log.write({"id": key[0], "attempt": key[1], **record})
@@ -1,5 +1,6 @@
 import json
 import os
+import threading
 from typing import List
 
 from elasticsearch import Elasticsearch, helpers
@@ -126,6 +127,28 @@ class ESClient:
     def count(self, index):
         return self.client.count(index=index)
 
+    def index_uuid(self, index):
+        """
+        Changes whenever the index is re-created.
+        """
+        settings = self.client.indices.get_settings(index=index)
+        return settings[index]["settings"]["index"]["uuid"]
+
+
+_es_client = None
+_es_lock = threading.Lock()
+
+
+def get_es_client():
+    """
+    Process-wide ESClient, the underlying Elasticsearch client is thread-safe.
+    """
+    global _es_client
+    with _es_lock:
+        if _es_client is None:
+            _es_client = ESClient()
+    return _es_client
+
 
 def text_usage():
     from datetime import datetime
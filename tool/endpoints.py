@@ -0,0 +1,234 @@
+import contextlib
+import json
+import os
+import random
+import threading
+import time
+
+import openai
+from loguru import logger
+
+from tool.rate_limit import RateLimiter
+
+"""
+Pool of OpenAI-compatible endpoints behind `chatgpt` and the embedding calls,
+see `tool.openai_api.set_endpoints`.
+
+An endpoints file is a JSON list, one object per endpoint (replica, org, key):
+    [
+        {"name": "org-a", "api_key": "env:OPENAI_API_KEY_A", "rpm": 500, "tpm": 300000},
+        {"name": "org-b", "api_key": "env:OPENAI_API_KEY_B", "rpm": 500, "tpm": 300000},
+        {"name": "vllm-0", "base_url": "http://10.0.0.5:8000/v1", "api_key": "none", "max_outstanding": 64}
+    ]
+`api_key`: the key, or "env:NAME" to read it from the environment.
+`rpm` / `tpm`: quota of this endpoint (tool/rate_limit.py), `max_outstanding`:
+requests in flight at most, both unlimited if absent.
+
+Routing: the healthy endpoint with the least outstanding requests, doubled
+per recent consecutive failure (ties at random). 429s hold back only the endpoint that sent them. An endpoint is
+ejected after `eject_after` consecutive failures (5xx, timeouts, connection
+errors), a background check readmits it once `GET /models` answers again.
+"""
+
+
+def _is_endpoint_failure(e: BaseException):
+    """
+    Errors that say the endpoint is unhealthy, not the request.
+    """
+    if isinstance(e, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    return isinstance(e, openai.APIStatusError) and e.status_code >= 500
+
+
+class Endpoint:
+    def __init__(
+        self,
+        name=None,
+        base_url=None,
+        api_key=None,
+        rpm=None,
+        tpm=None,
+        max_outstanding=None,
+        timeout=10,
+    ) -> None:
+        if api_key and api_key.startswith("env:"):
+            api_key = os.environ[api_key[len("env:") :]]
+        api_key = api_key or os.environ.get("OPENAI_API_KEY")
+        self.name = name or base_url or "openai"
+        self.base_url = base_url
+        # retries are owned by `tool.openai_api._retry_policy`, not by the SDK.
+        self.client = openai.OpenAI(
+            api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0
+        )
+        self.aclient = openai.AsyncOpenAI(
+            api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0
+        )
+        self.limiter = RateLimiter(rpm=rpm, tpm=tpm)
+        self.max_outstanding = max_outstanding
+
+        self.outstanding = 0
+        self.failures = 0  # consecutive
+        self.ejected_until = None  # monotonic time of the next health check
+        self.ejections = 0
+        self.requests = 0
+        self.ok = 0
+        self.errors = 0
+        self.latency = 0.0  # total seconds of the successful requests
+
+    def available(self):
+        return self.ejected_until is None and (
+            not self.max_outstanding or self.outstanding < self.max_outstanding
+        )
+
+    def info(self):
+        return {
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "ejections": self.ejections,
+            "ejected": self.ejected_until is not None,
+            "avg_latency": round(self.latency / max(1, self.ok), 3),
+        }
+
+
+class EndpointPool:
+    """
+    pool = EndpointPool([Endpoint(...), Endpoint(...)])
+    with pool.lease(tokens=1200) as ep:
+        ep.client.chat.completions.create(...)
+    """
+
+    def __init__(
+        self, endpoints, eject_after=3, eject_seconds=30, health_interval=5
+    ) -> None:
+        assert endpoints, "no endpoints."
+        self.endpoints = list(endpoints)
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.health_interval = health_interval
+        self.limits_tokens = any(ep.limiter.tokens for ep in self.endpoints)
+        self._lock = threading.Lock()
+        self._checker = None
+
+    def _pick(self):
+        with self._lock:
+            candidates = [ep for ep in self.endpoints if ep.available()]
+            if not candidates:
+                # all ejected or saturated: the one that frees up first, fail open.
+                candidates = [
+                    ep for ep in self.endpoints if ep.ejected_until is None
+                ] or [min(self.endpoints, key=lambda ep: ep.ejected_until)]
+            # a failing endpoint answers fast, do not let it draw all traffic.
+            load = {ep: (ep.outstanding + 1) * 2**ep.failures for ep in candidates}
+            least = min(load.values())
+            ep = random.choice([ep for ep in candidates if load[ep] == least])
+            ep.outstanding += 1
+            ep.requests += 1
+            return ep
+
+    def _release(self, ep: Endpoint, error: BaseException = None, latency=0.0):
+        with self._lock:
+            ep.outstanding -= 1
+            if error is None:
+                ep.failures = 0
+                ep.ok += 1
+                ep.latency += latency
+                return
+            if not _is_endpoint_failure(error):
+                ep.failures = 0
+                if isinstance(error, openai.RateLimitError):
+                    from tool.openai_api import _retry_after
+
+                    ep.limiter.block_for(_retry_after(error) or 1)
+                return
+            ep.errors += 1
+            ep.failures += 1
+            if ep.failures < self.eject_after or ep.ejected_until is not None:
+                return
+            ep.ejections += 1
+            ep.ejected_until = time.monotonic() + self.eject_seconds
+        logger.warning(
+            f"Endpoint {ep.name} ejected after {ep.failures} failures: {error}"
+        )
+        self._start_checker()
+
+    @contextlib.contextmanager
+    def lease(self, tokens=0):
+        ep = self._pick()
+        t = time.time()
+        try:
+            ep.limiter.acquire(tokens=tokens)
+            yield ep
+        except BaseException as e:
+            self._release(ep, e)
+            raise
+        self._release(ep, latency=time.time() - t)
+
+    @contextlib.asynccontextmanager
+    async def alease(self, tokens=0):
+        ep = self._pick()
+        t = time.time()
+        try:
+            await ep.limiter.aacquire(tokens=tokens)
+            yield ep
+        except BaseException as e:
+            self._release(ep, e)
+            raise
+        self._release(ep, latency=time.time() - t)
+
+    def _start_checker(self):
+        with self._lock:
+            if self._checker is not None:
+                return
+            self._checker = threading.Thread(
+                target=self._check_loop, name="endpoint-health", daemon=True
+            )
+            self._checker.start()
+
+    def _check_loop(self):
+        while True:
+            time.sleep(self.health_interval)
+            self.check_health()
+
+    def check_health(self):
+        """
+        Probe the ejected endpoints that are due, readmit the ones that answer.
+        """
+        now = time.monotonic()
+        for ep in self.endpoints:
+            if ep.ejected_until is None or ep.ejected_until > now:
+                continue
+            try:
+                ep.client.with_options(timeout=5).models.list()
+            except Exception as e:
+                with self._lock:
+                    ep.ejected_until = time.monotonic() + self.eject_seconds
+                logger.warning(f"Endpoint {ep.name} still unhealthy: {e}")
+                continue
+            with self._lock:
+                ep.failures = 0
+                ep.ejected_until = None
+            logger.info(f"Endpoint {ep.name} readmitted.")
+
+    def info(self):
+        return {ep.name: ep.info() for ep in self.endpoints}
+
+
+def load_endpoints(spec, share=1.0, **kwargs):
+    """
+    spec: path of an endpoints file (see above), or comma separated base URLs
+        sharing `OPENAI_API_KEY`.
+    share: part of each quota for this process, e.g. 1 / number of processes.
+    kwargs: see `EndpointPool`.
+    """
+    if os.path.exists(spec):
+        with open(spec, encoding="utf-8") as f:
+            configs = json.load(f)
+        for e in configs:
+            for k in ["rpm", "tpm"]:
+                if e.get(k):
+                    e[k] = e[k] * share
+        endpoints = [Endpoint(**e) for e in configs]
+    else:
+        endpoints = [Endpoint(base_url=url.strip()) for url in spec.split(",")]
+    return EndpointPool(endpoints, **kwargs)
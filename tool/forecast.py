@@ -0,0 +1,223 @@
+import json
+import os
+import time
+from collections import defaultdict
+from glob import glob
+
+from loguru import logger
+
+"""
+Forecast of the tokens, dollars and wall time of a planned run, before it is
+launched:
+    python -m tool.forecast --dataset bird-dev --model_name gpt-4o-2024-05-13 --concurrency 20
+
+The first prompt of every question is counted with `chatgpt_tokenize`, built
+the way `_dialog` builds it: tooldesc + demos (once), the schema of each db
+(once per db) and the question. How the dialog grows from there comes from the
+earlier runs under `save-crossdb-infer-dialog` (rounds, prompt growth and
+completion tokens per round). Wall time per round comes from a spans file of
+an earlier run (tool/spans.py) if given.
+"""
+
+# $ per 1M tokens: (prompt, completion)
+PRICES = {
+    "gpt-4o-2024-05-13": (5.0, 15.0),
+    "gpt-4o-2024-08-06": (2.5, 10.0),
+    "gpt-4o-mini-2024-07-18": (0.15, 0.6),
+    "gpt-4-1106-preview": (10.0, 30.0),
+    "gpt-4-turbo-2024-04-09": (10.0, 30.0),
+    "gpt-3.5-turbo-0125": (0.5, 1.5),
+}
+
+
+def _message_tokens(content_tokens):
+    # as `count_message_tokens`: 4 per message, 3 per request.
+    return 4 + content_tokens
+
+
+class History:
+    """
+    Round and token distributions of finished dialogs.
+    """
+
+    def __init__(self, dialogs) -> None:
+        self.n = 0
+        rounds = []
+        growth = defaultdict(list)  # round -> prompt tokens added since round 0
+        completion = defaultdict(list)  # round -> completion tokens
+        for d in dialogs:
+            prompt_tokens = d.get("prompt_tokens") or []
+            if not prompt_tokens:
+                continue
+            self.n += 1
+            rounds.append(len(prompt_tokens))
+            for r, (p, c) in enumerate(zip(prompt_tokens, d["completion_tokens"])):
+                growth[r].append(p - prompt_tokens[0])
+                completion[r].append(c)
+        assert self.n, "No finished dialogs with token counts in the history."
+
+        max_rounds = max(rounds)
+        # survival[r]: share of dialogs that make an r-th request.
+        self.survival = [sum(n > r for n in rounds) / self.n for r in range(max_rounds)]
+        self.growth = [sum(growth[r]) / len(growth[r]) for r in range(max_rounds)]
+        self.completion = [
+            sum(completion[r]) / len(completion[r]) for r in range(max_rounds)
+        ]
+        self.mean_rounds = sum(rounds) / self.n
+        self.p95_rounds = sorted(rounds)[min(self.n - 1, int(0.95 * self.n))]
+
+    def prompt_tokens(self, first_prompt):
+        """
+        Expected prompt tokens of a dialog whose first request has `first_prompt` tokens.
+        """
+        return sum(s * (first_prompt + g) for s, g in zip(self.survival, self.growth))
+
+    def completion_tokens(self):
+        return sum(s * c for s, c in zip(self.survival, self.completion))
+
+
+def load_history(pattern):
+    from tool.result_sink import iter_results
+
+    dialogs = []
+    for save_dir in sorted(glob(pattern)):
+        if os.path.isdir(save_dir):
+            dialogs.extend(d for _, d in iter_results(save_dir))
+    logger.info(f"History: {len(dialogs)} dialogs from {pattern}")
+    return History(dialogs)
+
+
+def seconds_per_round(spans_path):
+    """
+    Mean wall time of a dialog round (LLM request + tools) in a spans file.
+    """
+    dialog_seconds, llm_requests = 0.0, 0
+    with open(spans_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                s = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if s["name"] == "dialog":
+                dialog_seconds += (s["endTimeUnixNano"] - s["startTimeUnixNano"]) / 1e9
+            elif s["name"] == "llm":
+                llm_requests += 1
+    assert llm_requests, f"No llm spans in {spans_path}"
+    return dialog_seconds / llm_requests
+
+
+def forecast(
+    dataset,
+    model_name="gpt-4o-2024-05-13",
+    add_evidence=False,
+    case_num=None,
+    history=None,
+    concurrency=20,
+    spans=None,
+    round_seconds=4.0,
+    rpm=None,
+    tpm=None,
+    price_in=None,
+    price_out=None,
+):
+    """
+    history: glob of earlier save_dirs, default: every note of this dataset and model.
+    spans: spans file of an earlier run for the seconds per round, else `round_seconds`.
+    rpm, tpm: the quota, it bounds the wall time from below.
+    price_in, price_out: $ per 1M prompt / completion tokens, default from PRICES.
+    """
+    from interactive_text_to_sql import (
+        load_schema_and_examples_dialog,
+        load_test_data,
+        load_tooldesc,
+    )
+    from tool.openai_api import count_tokens_batch
+
+    _dname = dataset.split("-")[0] if "spider2" not in dataset else dataset
+    _ds = dataset
+    if "bird" in dataset.lower():
+        _ds += "-with_evidence" if add_evidence else "-no_evidence"
+    if history is None:
+        history = f"save-crossdb-infer-dialog/{_ds}/{model_name}/*"
+    hist = load_history(history)
+
+    examplars = load_schema_and_examples_dialog(_dname, add_evidence=add_evidence)
+    tooldesc = load_tooldesc(_dname, add_evidence=add_evidence)
+    tooldesc_demos = tooldesc + "\n\n" + "\n\n".join(examplars)
+    data = load_test_data(dataset, add_evidence=add_evidence)[:case_num]
+
+    # same texts as `_dialog`, counted in parts so that shared parts are counted once.
+    t = time.time()
+    system = (
+        tooldesc_demos.strip() + "\n\nNow, solve the following question step by step."
+    )
+    dbs = sorted({d["db_id"] for d in data})
+    schemas = []
+    for db in dbs:
+        with open(f"database/dbs_info/{_dname}/{db}.md") as f:
+            schemas.append(f"Schema of database {db}:\n{f.read().strip()}")
+    questions = []
+    for d in data:
+        q = f"\n\nQ: {d['question'].strip()}"
+        if add_evidence:
+            q += f"\nEvidence: {d['evidence'].replace(chr(10), ' ').strip()}"
+        questions.append(q)
+    counts = count_tokens_batch([system] + schemas + questions)
+    system_tokens = counts[0]
+    schema_tokens = dict(zip(dbs, counts[1 : 1 + len(dbs)]))
+    question_tokens = counts[1 + len(dbs) :]
+    tokenize_seconds = time.time() - t
+
+    prompt_tokens = 0.0
+    for d, q in zip(data, question_tokens):
+        first = (
+            3
+            + _message_tokens(system_tokens)
+            + _message_tokens(schema_tokens[d["db_id"]] + q)
+        )
+        prompt_tokens += hist.prompt_tokens(first)
+    completion_tokens = hist.completion_tokens() * len(data)
+    requests = hist.mean_rounds * len(data)
+
+    if price_in is None or price_out is None:
+        assert model_name in PRICES, f"No price for {model_name}, pass --price_in/out."
+        price_in, price_out = PRICES[model_name]
+    cost = (prompt_tokens * price_in + completion_tokens * price_out) / 1e6
+
+    if spans:
+        round_seconds = seconds_per_round(spans)
+    dialog_seconds = hist.mean_rounds * round_seconds
+    wall = {
+        "concurrency": max(1, len(data) / concurrency) * dialog_seconds,
+    }
+    if tpm:
+        wall["tpm"] = (prompt_tokens + completion_tokens) / tpm * 60
+    if rpm:
+        wall["rpm"] = requests / rpm * 60
+    bound = max(wall, key=wall.get)
+
+    print(f"dataset: {dataset}, model: {model_name}, questions: {len(data)}")
+    print(
+        f"history: {hist.n} dialogs, {hist.mean_rounds:.2f} rounds on average, "
+        f"p95 {hist.p95_rounds}"
+    )
+    print(
+        f"first prompt: system {system_tokens}, {len(dbs)} schemas, "
+        f"tokenized in {tokenize_seconds:.1f}s"
+    )
+    print(f"requests:          {requests:,.0f}")
+    print(f"prompt tokens:     {prompt_tokens:,.0f}")
+    print(f"completion tokens: {completion_tokens:,.0f}")
+    print(f"cost:              ${cost:,.2f} (${price_in}/${price_out} per 1M)")
+    print(
+        f"wall time:         {wall[bound] / 3600:.2f} h, bound by {bound} "
+        f"({round_seconds:.2f}s per round, concurrency {concurrency})"
+    )
+
+
+if __name__ == "__main__":
+    # python -m tool.forecast --dataset spider-dev --model_name gpt-4o-2024-05-13
+    # python -m tool.forecast --dataset bird-dev --concurrency 50 --tpm 2000000 --spans trace/bird-dev.spans.jsonl
+    import fire
+
+    fire.Fire(forecast)
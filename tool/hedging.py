@@ -0,0 +1,247 @@
+import asyncio
+import contextvars
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+from loguru import logger
+
+"""
+Hedged LLM requests, see `tool.openai_api.set_hedging`.
+
+A request still running after the running p95 latency of its model gets a
+duplicate; the first response wins. Async losers are cancelled (the connection
+is closed). A blocking sync request cannot be aborted, so a sync loser runs to
+the end and is dropped, its usage is counted as extra spend.
+With an endpoint pool (tool/endpoints.py) the duplicate goes to the endpoint
+with the least outstanding requests, which is rarely the one that is slow.
+
+Tracked per model: requests, hedged, won (by the duplicate), extra_tokens
+(usage of the losers that finished, estimated prompt tokens of the cancelled
+ones) and saved_s, estimated from the latencies seen above the win time.
+"""
+
+
+class LatencyWindow:
+    """
+    The last `size` latencies of one model, quantiles refreshed every `every` samples.
+    """
+
+    def __init__(self, size=1000, every=20) -> None:
+        self.samples = deque(maxlen=size)
+        self.every = every
+        self._sorted = []
+        self._new = 0
+
+    def add(self, latency: float):
+        self.samples.append(latency)
+        self._new += 1
+        if self._new >= self.every or len(self._sorted) < self.every:
+            self._sorted = sorted(self.samples)
+            self._new = 0
+
+    def quantile(self, q: float):
+        if not self._sorted:
+            return None
+        return self._sorted[
+            min(len(self._sorted) - 1, int(q / 100 * len(self._sorted)))
+        ]
+
+    def excess_over(self, t: float):
+        """
+        Mean of (latency - t) over the latencies above t: the expected wait
+        still ahead of a request that has run for t seconds.
+        """
+        above = [s - t for s in self._sorted if s > t]
+        return sum(above) / len(above) if above else 0.0
+
+
+def _spawn(func, *args):
+    """
+    Run `func` in a short-lived daemon thread with the caller's context.
+    Return: a Future of its result.
+    """
+    future = Future()
+    ctx = contextvars.copy_context()
+
+    def target():
+        try:
+            future.set_result(ctx.run(func, *args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=target, name="hedge", daemon=True).start()
+    return future
+
+
+class Hedger:
+    """
+    hedger = Hedger(quantile=95)
+    response = hedger.run(lambda: backend.chat(request), request)
+    """
+
+    def __init__(
+        self,
+        quantile=95,
+        min_samples=50,
+        min_delay=1.0,
+        max_ratio=0.1,
+        estimate_tokens=None,
+    ) -> None:
+        """
+        quantile: hedge a request once it runs longer than this latency percentile.
+        min_samples: latencies of a model to see before hedging it.
+        min_delay: never hedge earlier than this, in seconds.
+        max_ratio: at most this share of the requests get a duplicate.
+        estimate_tokens: request -> prompt tokens, the spend of a cancelled loser.
+        """
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.estimate_tokens = estimate_tokens
+        self.windows = defaultdict(LatencyWindow)
+        self.stats = defaultdict(lambda: defaultdict(float))
+        self._lock = threading.Lock()
+
+    def delay(self, model):
+        """
+        Return: seconds after which a request of `model` is hedged, None: do not hedge.
+        """
+        with self._lock:
+            window = self.windows[model]
+            stats = self.stats[model]
+            stats["requests"] += 1
+            if len(window.samples) < self.min_samples:
+                return None
+            if stats["hedged"] >= self.max_ratio * stats["requests"]:
+                return None
+            return max(self.min_delay, window.quantile(self.quantile))
+
+    def _observe(self, model, latency):
+        with self._lock:
+            self.windows[model].add(latency)
+
+    def _won(self, model, elapsed):
+        with self._lock:
+            stats = self.stats[model]
+            stats["won"] += 1
+            stats["saved_s"] += self.windows[model].excess_over(elapsed)
+
+    def _spent(self, model, request, response=None):
+        if response is not None and "usage" in response:
+            tokens = response["usage"]["total_tokens"]
+        elif self.estimate_tokens is not None:
+            tokens = self.estimate_tokens(request)
+        else:
+            return
+        with self._lock:
+            self.stats[model]["extra_tokens"] += tokens
+
+    def _timed(self, call, model):
+        t = time.time()
+        response = call()
+        self._observe(model, time.time() - t)
+        return response
+
+    def run(self, call, request: dict, before_hedge=None):
+        """
+        call: sends `request` once, e.g. `functools.partial(backend.chat, request)`.
+        before_hedge: run before the duplicate is sent, e.g. the rate limiter.
+        """
+        model = request["model"]
+        delay = self.delay(model)
+        if delay is None:
+            return self._timed(call, model)
+
+        start = time.time()
+        primary = _spawn(self._timed, call, model)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        with self._lock:
+            self.stats[model]["hedged"] += 1
+        logger.debug(f"Hedge a {model} request after {delay:.2f}s.")
+        if before_hedge is not None:
+            before_hedge()
+        hedge = _spawn(self._timed, call, model)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    continue
+                if future is hedge:
+                    self._won(model, time.time() - start)
+                for loser in pending:
+                    loser.add_done_callback(
+                        lambda f: self._spent(
+                            model, request, None if f.exception() else f.result()
+                        )
+                    )
+                return future.result()
+        # both failed: the primary's error goes to the retry policy.
+        return primary.result()
+
+    async def arun(self, acall, request: dict, before_hedge=None):
+        """
+        Async variant of `run`, acall: a coroutine function, the loser is cancelled.
+        before_hedge: a coroutine function.
+        """
+        model = request["model"]
+        delay = self.delay(model)
+
+        async def timed():
+            t = time.time()
+            response = await acall()
+            self._observe(model, time.time() - t)
+            return response
+
+        if delay is None:
+            return await timed()
+
+        start = time.time()
+        primary = asyncio.ensure_future(timed())
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done:
+                return primary.result()
+
+            with self._lock:
+                self.stats[model]["hedged"] += 1
+            logger.debug(f"Hedge a {model} request after {delay:.2f}s.")
+            if before_hedge is not None:
+                await before_hedge()
+            hedge = asyncio.ensure_future(timed())
+            tasks.append(hedge)
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is not None:
+                        continue
+                    if task is hedge:
+                        self._won(model, time.time() - start)
+                    for _ in pending:
+                        self._spent(model, request)
+                    return task.result()
+            return primary.result()
+        finally:
+            # the loser, or both if the caller gave up (e.g. `asyncio.wait_for`).
+            for task in tasks:
+                task.cancel()
+
+    def info(self):
+        with self._lock:
+            res = {}
+            for model, stats in self.stats.items():
+                res[model] = {k: round(v, 2) for k, v in stats.items()}
+                res[model][f"p{self.quantile}"] = self.windows[model].quantile(
+                    self.quantile
+                )
+            return res
@@ -0,0 +1,96 @@
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+"""
+Import time of the entry points, from `python -X importtime` in a fresh process.
+
+Report the slowest top-level packages behind one module:
+    python -m tool.importtime report interactive_text_to_sql
+Check every module of BUDGETS, exit 1 if one is over its budget (also run by
+tests/test_importtime.py):
+    python -m tool.importtime check
+
+Heavy dependencies (openai, chromadb, networkx, sqlparse, tiktoken, matplotlib)
+are imported inside the functions that use them, keep it that way.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# seconds, cumulative import time of the module in a fresh interpreter.
+BUDGETS = {
+    "utils": 0.15,
+    "tool": 0.2,
+    "tool.utils": 0.2,
+    "tool.openai_api": 0.3,
+    "tool.action_execution": 0.4,
+    "tool.spider_search": 0.4,
+    "tool.bird_search": 0.4,
+    "tool.manifest": 0.3,
+    "tool.forecast": 0.3,
+    "tool.spans": 0.3,
+    "make_final_res": 0.3,
+    "interactive_text_to_sql": 0.5,
+}
+
+
+def measure(module):
+    """
+    Return: [(name, self seconds, cumulative seconds)] in import order, the
+        module itself last.
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+    res = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        res.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return res
+
+
+def import_seconds(module, repeat=3):
+    """
+    Best of `repeat` fresh imports, the others are disk cache / scheduler noise.
+    """
+    return min(measure(module)[-1][2] for _ in range(repeat))
+
+
+def report(module, top=15):
+    records = measure(module)
+    by_package = defaultdict(float)
+    for name, self_s, _ in records:
+        by_package[name.split(".")[0]] += self_s
+    print(f"import {module}: {records[-1][2]:.3f}s, {len(records)} modules")
+    print(f"{'package':<32} {'self':>8}")
+    for package, seconds in sorted(by_package.items(), key=lambda x: -x[1])[:top]:
+        print(f"{package:<32} {seconds:>8.3f}")
+
+
+def check(repeat=3):
+    over = []
+    for module, budget in BUDGETS.items():
+        seconds = import_seconds(module, repeat=repeat)
+        status = "ok" if seconds <= budget else "OVER"
+        print(f"{module:<32} {seconds:>7.3f}s / {budget:.2f}s  {status}")
+        if seconds > budget:
+            over.append(module)
+    if over:
+        print(f"Over budget: {over}, see `python -m tool.importtime report <module>`")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    # python -m tool.importtime report interactive_text_to_sql
+    # python -m tool.importtime check
+    import fire
+
+    fire.Fire({"report": report, "check": check})
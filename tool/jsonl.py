@@ -0,0 +1,78 @@
+import json
+import os
+import threading
+
+"""
+Append-only JSONL files shared by the threads and processes of a run: the
+checkpoint, manifest, trace, span and result files.
+"""
+
+
+class AppendLog:
+    """
+    log = AppendLog("trace/spans.jsonl")
+    log.write({"id": ..}, ...)  # one line per record
+
+    The file is opened with O_APPEND on the first write, so every write lands
+    at the end of the file, whoever else appends to it. The records of one call
+    go out in a single write, so lines of different writers do not interleave,
+    unless the OS writes only part of them (a full disk, a signal): the rest is
+    written right after, before the next write of this process.
+    A last line cut by a crash is ended first, so it stays one bad line that
+    readers skip instead of taking the next record with it.
+    fsync: sync every write to disk, so that it survives a power loss.
+    """
+
+    def __init__(self, path, fsync=False) -> None:
+        self.path = path
+        self.fsync = fsync
+        self._fd = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        size = os.fstat(fd).st_size
+        if size:
+            with open(self.path, "rb") as f:
+                f.seek(size - 1)
+                if f.read(1) != b"\n":
+                    _write_all(fd, b"\n")
+        return fd
+
+    def write(self, *records: dict):
+        data = "".join(
+            json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in records
+        ).encode("utf-8")
+        with self._lock:
+            if self._fd is None:
+                self._fd = self._open()
+            _write_all(self._fd, data)
+            if self.fsync:
+                os.fsync(self._fd)
+
+    def size(self):
+        """
+        Return: bytes in the file, 0 if it does not exist yet.
+        """
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def close(self):
+        """
+        Close the file, the next write opens it again (e.g. after it is replaced).
+        """
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+def _write_all(fd, data: bytes):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
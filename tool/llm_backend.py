@@ -0,0 +1,253 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+from glob import glob
+
+from loguru import logger
+from tqdm import tqdm
+
+from tool.streaming import ActionCutoff
+
+"""
+LLM backends behind `tool.openai_api.chatgpt`.
+
+A backend is any object with:
+    chat(request: dict) -> dict          # OpenAI chat.completions response as a dict
+    async achat(request: dict) -> dict
+where `request` holds the chat.completions arguments (model, messages, n, ...).
+
+OpenAIBackend (tool/openai_api.py) is the default. ScriptedBackend below is an
+offline stand-in for load tests, e.g.
+    python interactive_text_to_sql.py ... --backend "scripted:save-crossdb-infer-dialog/spider-dev/*/v1/*.json" --backend_latency "lognormal:0.5,0.6"
+
+`serve` puts it behind a local OpenAI-compatible HTTP server, e.g. to test
+the endpoint pool (tool/endpoints.py) against a few stand-in replicas:
+    python -m tool.llm_backend serve "save-crossdb-infer-dialog/spider-dev/*/v1/*.json" --port 8001 --error_rate 0.1
+"""
+
+
+def parse_latency(spec):
+    """
+    spec:
+        "0" or None: no delay.
+        "const:1.5"
+        "uniform:0.5,3"
+        "normal:2,0.5" (mean, std), clipped at 0.
+        "lognormal:0.5,0.6" (mu, sigma of the underlying normal).
+    Return: a function rng -> seconds.
+    """
+    if not spec or str(spec) == "0":
+        return lambda rng: 0.0
+    name, _, args = str(spec).partition(":")
+    args = [float(a) for a in args.split(",") if a]
+    if name == "const":
+        return lambda rng: args[0]
+    if name == "uniform":
+        return lambda rng: rng.uniform(args[0], args[1])
+    if name == "normal":
+        return lambda rng: max(0.0, rng.gauss(args[0], args[1]))
+    if name == "lognormal":
+        return lambda rng: rng.lognormvariate(args[0], args[1])
+    raise ValueError(f"latency: {spec} is not supported.")
+
+
+def _approx_tokens(text: str):
+    # no tokenizer download on an air-gapped box.
+    return max(1, len(text) // 4)
+
+
+def _load_dialogs(pattern):
+    """
+    pattern: a save_dir (any layout of tool/result_sink.py), or a glob of json files.
+    """
+    if os.path.isdir(pattern):
+        from tool.result_sink import iter_results
+
+        for _, d in iter_results(pattern):
+            yield d
+        return
+    for p in sorted(glob(pattern)):
+        with open(p, encoding="utf-8") as f:
+            yield json.load(f)
+
+
+def _question_key(content: str):
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+class ScriptedBackend:
+    """
+    Serves assistant turns mined from saved dialogs (a save_dir, or a glob of
+    `save-crossdb-infer-dialog/*.json` files). A request is matched to its dialog by the question message
+    (messages[1]) and gets the turn at its round, unknown questions get a
+    dialog picked by hash. Each call sleeps for a sampled latency.
+    """
+
+    def __init__(self, pattern, latency=None, seed=0) -> None:
+        self.pattern = pattern
+        self._latency = parse_latency(latency)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+        self._turns = {}  # question key -> [assistant content, ...]
+        for d in tqdm(_load_dialogs(pattern), ncols=100, desc="Loading scripts"):
+            dialog = d.get("dialog", [])
+            if len(dialog) < 3:
+                continue
+            turns = [m["content"] for m in dialog[2:] if m["role"] == "assistant"]
+            if turns:
+                self._turns[_question_key(dialog[1]["content"])] = turns
+        assert self._turns, f"No dialogs found in {pattern}"
+        self._pool = list(self._turns.values())
+        logger.info(f"ScriptedBackend: {len(self._turns)} dialogs from {pattern}")
+
+    def _sample_latency(self):
+        with self._lock:
+            self.calls += 1
+            return self._latency(self._rng)
+
+    def _respond(self, request: dict):
+        messages = request["messages"]
+        key = _question_key(messages[1]["content"]) if len(messages) > 1 else ""
+        turns = self._turns.get(key)
+        if turns is None:
+            turns = self._pool[int(key or "0", 16) % len(self._pool)]
+        round_idx = sum(m["role"] == "assistant" for m in messages[2:])
+        content = turns[min(round_idx, len(turns) - 1)]
+        if request.get("stream"):
+            cutoff = ActionCutoff()
+            cutoff.feed(content)
+            content = cutoff.text
+
+        n = request.get("n") or 1
+        prompt_tokens = sum(_approx_tokens(m["content"]) for m in messages)
+        return {
+            "id": f"scripted-{self.calls}",
+            "object": "chat.completion",
+            "model": request["model"],
+            "choices": [
+                {
+                    "index": i,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+                for i in range(n)
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": _approx_tokens(content) * n,
+                "total_tokens": prompt_tokens + _approx_tokens(content) * n,
+            },
+        }
+
+    def chat(self, request: dict):
+        time.sleep(self._sample_latency())
+        return self._respond(request)
+
+    async def achat(self, request: dict):
+        await asyncio.sleep(self._sample_latency())
+        return self._respond(request)
+
+
+def _embedding(text: str, dim=256):
+    # deterministic unit vector, so cached and fresh embeddings agree.
+    rng = random.Random(_question_key(text))
+    vec = [rng.gauss(0, 1) for _ in range(dim)]
+    norm = math.sqrt(sum(v * v for v in vec))
+    return [v / norm for v in vec]
+
+
+def serve(pattern, port=8001, latency=None, error_rate=0.0, seed=0):
+    """
+    ScriptedBackend behind `POST /v1/chat/completions`, plus `POST /v1/embeddings`
+    (pseudo-random vectors) and `GET /v1/models`.
+    error_rate: share of chat requests answered with a 500.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    backend = ScriptedBackend(pattern, latency=latency, seed=seed)
+    rng = random.Random(seed)
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, body: dict):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_stream(self, response: dict):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            chunks = [
+                {
+                    "id": response["id"],
+                    "object": "chat.completion.chunk",
+                    "model": response["model"],
+                    "choices": [
+                        {
+                            "index": c["index"],
+                            "delta": c["message"],
+                            "finish_reason": c["finish_reason"],
+                        }
+                        for c in response["choices"]
+                    ],
+                },
+                {
+                    "id": response["id"],
+                    "object": "chat.completion.chunk",
+                    "model": response["model"],
+                    "choices": [],
+                    "usage": response["usage"],
+                },
+            ]
+            for chunk in chunks:
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.write(b"data: [DONE]\n\n")
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/models"):
+                return self._send(200, {"object": "list", "data": []})
+            self._send(404, {"error": {"message": f"{self.path} not found"}})
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if self.path.endswith("/embeddings"):
+                texts = request["input"]
+                texts = [texts] if isinstance(texts, str) else texts
+                data = [
+                    {"object": "embedding", "index": i, "embedding": _embedding(t)}
+                    for i, t in enumerate(texts)
+                ]
+                usage = {"prompt_tokens": 0, "total_tokens": 0}
+                return self._send(200, {"object": "list", "data": data, "usage": usage})
+            if not self.path.endswith("/chat/completions"):
+                return self._send(404, {"error": {"message": f"{self.path} not found"}})
+            if rng.random() < error_rate:
+                return self._send(500, {"error": {"message": "injected failure"}})
+            response = backend.chat(request)
+            if request.get("stream"):
+                return self._send_stream(response)
+            self._send(200, response)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    logger.info(f"Serving {pattern} at http://127.0.0.1:{port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    # python -m tool.llm_backend serve "save-crossdb-infer-dialog/spider-dev/*/v1/*.json" --port 8001
+    import fire
+
+    fire.Fire({"serve": serve})
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import threading
+import time
+
+from loguru import logger
+
+from tool.sqlite_wal import ThreadConnections
+
+# request fields that determine a completion.
+KEY_FIELDS = ["model", "messages", "temperature", "top_p", "n", "stop", "max_tokens"]
+
+
+class LLMCache:
+    """
+    Content-addressed store of chat completions in one sqlite file (WAL mode),
+    safe for concurrent threads and processes.
+    When the stored bytes exceed `max_bytes`, the least recently used entries
+    are evicted down to 90% of it.
+
+    cache = LLMCache("database/cache_llm/llm_cache.db")
+    key = cache.key(request)
+    response = cache.get(key)  # None on miss
+    cache.put(key, response)
+    """
+
+    def __init__(self, path="database/cache_llm/llm_cache.db", max_bytes=2 * 1024**3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._conn = ThreadConnections(path)
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        conn = self._conn()
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            );"""
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_last_access ON llm_cache (last_access);"
+        )
+        conn.commit()
+
+    @staticmethod
+    def key(request: dict, salt=None):
+        payload = {k: request.get(k) for k in KEY_FIELDS}
+        if salt is not None:
+            payload["salt"] = salt
+        # a streamed response may be cut off after its action, with estimated
+        # usage (tool/streaming.py), never serve it for a plain request or the
+        # other way round. Only set when on: the keys of plain requests stay.
+        if request.get("stream"):
+            payload["stream"] = True
+        payload = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        conn = self._conn()
+        # fetchall: finish the read before writing, or WAL reports a busy snapshot.
+        rows = conn.execute(
+            "SELECT response FROM llm_cache WHERE key=?;", (key,)
+        ).fetchall()
+        row = rows[0] if rows else None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE llm_cache SET last_access=? WHERE key=?;", (time.time(), key)
+        )
+        conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key, response: dict):
+        text = json.dumps(response, ensure_ascii=False)
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, response, size, last_access) VALUES (?, ?, ?, ?);",
+            (key, text, len(text), time.time()),
+        )
+        conn.commit()
+        with self._lock:
+            self._puts += 1
+            check = self._puts % 100 == 0
+        if check:
+            self.evict()
+
+    def evict(self):
+        # one eviction at a time, a concurrent one would only over-evict.
+        if not self._evict_lock.acquire(blocking=False):
+            return 0
+        try:
+            return self._evict()
+        finally:
+            self._evict_lock.release()
+
+    def _evict(self):
+        conn = self._conn()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache;").fetchone()
+        total = total[0]
+        if total <= self.max_bytes:
+            return 0
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        rows = conn.execute(
+            "SELECT key, size FROM llm_cache ORDER BY last_access;"
+        ).fetchall()
+        keys = []
+        for key, size in rows:
+            if freed >= target:
+                break
+            keys.append((key,))
+            freed += size
+        conn.executemany("DELETE FROM llm_cache WHERE key=?;", keys)
+        conn.commit()
+        removed = len(keys)
+        logger.info(f"LLMCache evicted {removed} entries ({freed} bytes).")
+        return removed
+
+    def info(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "path": self.path}
@@ -0,0 +1,118 @@
+import json
+import os
+import threading
+import time
+
+from loguru import logger
+from tqdm import tqdm
+
+from tool.jsonl import AppendLog
+
+"""
+Manifest of the finished dialogs of a save_dir, so that resuming a run does
+not have to parse every result file.
+
+`{save_dir}/manifest.jsonl` gets one line per finished dialog, the last line
+of an id wins:
+    {"id": .., "status": "ok", "model": "gpt-4o-2024-05-13", "note": "v1", "path": "..", "time": ..}
+status: "ok", or "empty" if the last observation is still empty after all retries.
+
+Rebuild it for a directory written before the manifest existed:
+    python -m tool.manifest rebuild save-crossdb-infer-dialog/spider-dev/gpt-4o-2024-05-13/v1
+"""
+
+DONE = ("ok", "empty")
+
+_manifests = {}
+_lock = threading.Lock()
+
+
+def get_manifest(save_dir):
+    with _lock:
+        if save_dir not in _manifests:
+            _manifests[save_dir] = Manifest(save_dir)
+        return _manifests[save_dir]
+
+
+class Manifest:
+    def __init__(self, save_dir) -> None:
+        self.save_dir = save_dir
+        self.path = f"{save_dir}/manifest.jsonl"
+        self._log = AppendLog(self.path)
+        self._lock = threading.Lock()
+
+    def add(self, id, status="ok", **fields):
+        record = {"id": id, "status": status, **fields, "time": time.time()}
+        # not into the old file while `rebuild` replaces it.
+        with self._lock:
+            self._log.write(record)
+
+    def records(self):
+        """
+        Return: {id: last record}
+        """
+        res = {}
+        if not os.path.exists(self.path):
+            return res
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    r = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                res[r["id"]] = r
+        return res
+
+    def completed_ids(self):
+        """
+        Return: set of finished ids. A directory without a manifest but with
+        results from before is rebuilt once first.
+        """
+        from tool.result_sink import has_results
+
+        if not os.path.exists(self.path) and has_results(self.save_dir):
+            logger.warning(f"No manifest in {self.save_dir}, rebuilding it.")
+            self.rebuild()
+        return {i for i, r in self.records().items() if r["status"] in DONE}
+
+    def rebuild(self):
+        """
+        Scan the results (any layout of tool/result_sink.py) and write a fresh manifest.
+        Return: number of records.
+        """
+        from tool.action_execution import is_valid_result, last_observation
+        from tool.result_sink import iter_results
+
+        n = 0
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for p, d in tqdm(
+                iter_results(self.save_dir), ncols=100, desc=f"Rebuilding {self.path}"
+            ):
+                n += 1
+                valid = is_valid_result(last_observation(d.get("dialog", [])))
+                record = {
+                    "id": d["id"],
+                    "status": "ok" if valid else "empty",
+                    "model": d.get("model_name"),
+                    "note": os.path.basename(self.save_dir),
+                    "path": p,
+                    "time": os.path.getmtime(p),
+                }
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        with self._lock:
+            self._log.close()
+            os.replace(tmp, self.path)
+        logger.info(f"Rebuilt {self.path}: {n} results.")
+        return n
+
+
+def rebuild(save_dir):
+    return get_manifest(save_dir.rstrip("/")).rebuild()
+
+
+if __name__ == "__main__":
+    # python -m tool.manifest rebuild save-crossdb-infer-dialog/spider-dev/gpt-4o-2024-05-13/v1
+    import fire
+
+    fire.Fire({"rebuild": rebuild})
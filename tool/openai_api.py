@@ -1,16 +1,23 @@
+import asyncio
+import contextlib
+import functools
 import json
 import os
-import sqlite3
-import threading
+import time
+from email.utils import parsedate_to_datetime
 from typing import List
 
-import openai
-from tenacity import retry, stop_after_attempt, wait_fixed, wait_random_exponential
+from loguru import logger
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 
-OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", None)
-assert (
-    OPENAI_API_KEY is not None
-), "OPENAI_API_KEY is None, use `export OPENAI_API_KEY=your_key` to set it."
+from tool.rate_limit import RateLimiter
+from tool.streaming import StreamCollector
+from utils import deadline_exceeded, remaining_time
 
 OPENAI_EMBEDDING_MODELS = [
     "text-embedding-ada-002",
@@ -18,11 +25,223 @@ OPENAI_EMBEDDING_MODELS = [
     "text-embedding-3-large",
 ]
 
-client = openai.OpenAI(api_key=OPENAI_API_KEY, timeout=10)
+CLIENT_TIMEOUT = 10
+MAX_ATTEMPTS = 5
+
+# the `OPENAI_API_KEY` clients, built on first use, see `get_client`.
+client = None
+aclient = None
+
+
+def get_client(aio=False):
+    """
+    Return: the sync (or async) client of `OPENAI_API_KEY`.
+    `openai` is imported here, so that importing this module stays cheap.
+    """
+    global client, aclient
+    if client is None:
+        import openai
+
+        api_key = os.environ.get("OPENAI_API_KEY", None)
+        assert (
+            api_key is not None
+        ), "OPENAI_API_KEY is None, use `export OPENAI_API_KEY=your_key` to set it."
+        # retries are owned by `_retry_policy` below, not by the SDK.
+        aclient = openai.AsyncOpenAI(
+            api_key=api_key, timeout=CLIENT_TIMEOUT, max_retries=0
+        )
+        client = openai.OpenAI(api_key=api_key, timeout=CLIENT_TIMEOUT, max_retries=0)
+    return aclient if aio else client
+
+
+# shared by every thread / coroutine of the process, unlimited by default.
+# e.g. `export OPENAI_RPM=500 OPENAI_TPM=300000`
+scheduler = RateLimiter(
+    rpm=float(os.environ.get("OPENAI_RPM", 0)),
+    tpm=float(os.environ.get("OPENAI_TPM", 0)),
+)
+
+
+# optional on-disk response cache, see `set_llm_cache`.
+llm_cache = None
+
+
+def set_llm_cache(path="database/cache_llm/llm_cache.db", max_bytes=2 * 1024**3):
+    global llm_cache
+    from tool.llm_cache import LLMCache
+
+    llm_cache = LLMCache(path=path, max_bytes=max_bytes) if path else None
+    logger.info(f"LLM cache: {path}")
+
+
+# optional pool of endpoints, see `set_endpoints`, None: `client` / `aclient`.
+pool = None
+
+
+def set_endpoints(spec, share=1.0, **kwargs):
+    """
+    Spread chat and embedding requests over several endpoints, see tool/endpoints.py.
+    spec: path of an endpoints file, or comma separated base URLs.
+    share: part of each endpoint quota for this process.
+    """
+    global pool
+    from tool.endpoints import load_endpoints
+
+    pool = load_endpoints(spec, share=share, **kwargs)
+    logger.info(f"Endpoints: {[ep.name for ep in pool.endpoints]}")
+
+
+@contextlib.contextmanager
+def _lease(request: dict = None):
+    """
+    Yield: the client for one request, from the pool if there is one.
+    """
+    if pool is None:
+        yield get_client()
+        return
+    tokens = estimate_request_tokens(request) if request and pool.limits_tokens else 0
+    with pool.lease(tokens=tokens) as ep:
+        yield ep.client
+
+
+@contextlib.asynccontextmanager
+async def _alease(request: dict = None):
+    if pool is None:
+        yield get_client(aio=True)
+        return
+    tokens = estimate_request_tokens(request) if request and pool.limits_tokens else 0
+    async with pool.alease(tokens=tokens) as ep:
+        yield ep.aclient
+
+
+# optional request hedging, see `set_hedging`.
+hedger = None
+
+
+def set_hedging(quantile=95, **kwargs):
+    """
+    Send a duplicate of a request that runs longer than the `quantile` latency
+    of its model, the first response wins, see tool/hedging.py.
+    """
+    global hedger
+    from tool.hedging import Hedger
+
+    hedger = Hedger(
+        quantile=quantile,
+        estimate_tokens=lambda request: count_message_tokens(request["messages"]),
+        **kwargs,
+    )
+    logger.info(f"Hedging at p{quantile}")
+
+
+def set_rate_limit(rpm=None, tpm=None):
+    global scheduler
+    scheduler = RateLimiter(rpm=rpm, tpm=tpm)
+    logger.info(f"Rate limit: rpm={rpm}, tpm={tpm}")
+
+
+def _is_retryable_status(status_code: int):
+    return status_code in (408, 409, 429) or status_code >= 500
+
+
+def _is_retryable(e: BaseException):
+    """
+    Only 429, 5xx, timeouts and connection errors are worth retrying.
+    """
+    import openai
+
+    if isinstance(e, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return _is_retryable_status(e.status_code)
+    return False
+
+
+def is_bad_request(e: BaseException):
+    """
+    A 400 from the API (e.g. the context is too long), not worth a retry.
+    """
+    import openai
 
+    return isinstance(e, openai.BadRequestError)
 
-@retry(wait=wait_random_exponential(min=5, max=30), stop=stop_after_attempt(3))
-def chatgpt(
+
+def _retry_after(e: BaseException):
+    """
+    Return: seconds from the `Retry-After(-ms)` header, None if absent.
+    """
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return parsedate_to_datetime(value).timestamp() - time.time()
+    except Exception:
+        return None
+
+
+_wait_backoff = wait_random_exponential(multiplier=0.5, max=30)
+
+
+def _wait_retry_after(retry_state):
+    """
+    Honor `Retry-After` (and hold back every other caller) on 429s, otherwise
+    a jittered exponential backoff starting well below one second.
+    """
+    import openai
+
+    e = retry_state.outcome.exception()
+    seconds = _retry_after(e)
+    # with a pool, only the endpoint that sent it is held back (tool/endpoints.py).
+    if seconds is not None and seconds > 0 and pool is None:
+        if isinstance(e, openai.RateLimitError):
+            scheduler.block_for(seconds)
+        return min(seconds, 60)
+    return _wait_backoff(retry_state)
+
+
+def _stop_at_deadline(retry_state):
+    # do not keep retrying for a caller that has already timed out.
+    return deadline_exceeded()
+
+
+_retry_policy = dict(
+    retry=retry_if_exception(_is_retryable),
+    wait=_wait_retry_after,
+    stop=stop_after_attempt(MAX_ATTEMPTS) | _stop_at_deadline,
+    reraise=True,
+)
+
+
+@functools.lru_cache(maxsize=4096)
+def _count_tokens(text: str):
+    return len(chatgpt_tokenize(text))
+
+
+def count_message_tokens(messages: List[dict]):
+    """
+    Approximate prompt tokens of a chat request.
+    """
+    return 3 + sum(4 + _count_tokens(m["content"]) for m in messages)
+
+
+def estimate_request_tokens(request: dict):
+    """
+    Tokens an OpenAI quota charges for a request: prompt + max_tokens * n.
+    """
+    prompt_tokens = count_message_tokens(request["messages"])
+    return prompt_tokens + (request["max_tokens"] or 0) * (request["n"] or 1)
+
+
+def _chat_request(
     prompt="Hello!",
     system_content="You are an AI assistant.",
     messages=None,
@@ -35,6 +254,7 @@ def chatgpt(
     presence_penalty=0,
     frequency_penalty=0,
     logit_bias={},
+    stream=False,
     **kwargs,
 ):
     assert model is not None, "model name is None"
@@ -47,8 +267,7 @@ def chatgpt(
             {"role": "user", "content": prompt},
         ]
     )
-
-    response = client.chat.completions.create(
+    request = dict(
         model=model,
         messages=messages,
         temperature=temperature,
@@ -60,58 +279,178 @@ def chatgpt(
         frequency_penalty=frequency_penalty,
         logit_bias=logit_bias,
     )
-    # content = response["choices"][0]["message"]["content"]
-    response = json.loads(response.model_dump_json())
-    return response
+    if stream:
+        request["stream"] = True
+        request["stream_options"] = {"include_usage": True}
+    return request
+
+
+def _estimate_usage(request: dict, response: dict):
+    """
+    A cut-off stream never gets to the usage chunk.
+    """
+    prompt_tokens = count_message_tokens(request["messages"])
+    completion_tokens = sum(
+        _count_tokens(c["message"]["content"]) for c in response["choices"]
+    )
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "estimated": True,
+    }
+
+
+class OpenAIBackend:
+    """
+    The default backend, see tool/llm_backend.py for the interface.
+    A request with `stream=True` is closed as soon as every choice holds a
+    complete action, see tool/streaming.py.
+    """
+
+    def chat(self, request: dict):
+        with _lease(request) as _client:
+            _remaining = remaining_time()
+            if _remaining is not None and _remaining < CLIENT_TIMEOUT:
+                _client = _client.with_options(timeout=max(_remaining, 1))
+
+            if request.get("stream"):
+                return self._chat_stream(_client, request)
+            response = _client.chat.completions.create(**request)
+            # content = response["choices"][0]["message"]["content"]
+            return json.loads(response.model_dump_json())
+
+    def _chat_stream(self, _client, request: dict):
+        collector = StreamCollector(request)
+        stream = _client.chat.completions.create(**request)
+        try:
+            for chunk in stream:
+                if collector.add(chunk):
+                    break
+        finally:
+            # closing drops the connection, the server stops generating.
+            stream.close()
+        response = collector.response()
+        if "usage" not in response:
+            response["usage"] = _estimate_usage(request, response)
+        return response
+
+    async def achat(self, request: dict):
+        async with _alease(request) as _aclient:
+            if request.get("stream"):
+                return await self._achat_stream(_aclient, request)
+            response = await _aclient.chat.completions.create(**request)
+            return json.loads(response.model_dump_json())
+
+    async def _achat_stream(self, _aclient, request: dict):
+        collector = StreamCollector(request)
+        stream = await _aclient.chat.completions.create(**request)
+        try:
+            async for chunk in stream:
+                if collector.add(chunk):
+                    break
+        finally:
+            await stream.close()
+        response = collector.response()
+        if "usage" not in response:
+            response["usage"] = _estimate_usage(request, response)
+        return response
+
+
+backend = OpenAIBackend()
+
+
+def set_backend(spec="openai", latency=None):
+    """
+    spec:
+        "openai": the OpenAI API (default).
+        "scripted:<glob of saved dialogs>": offline stand-in, see tool/llm_backend.py.
+    latency: latency distribution of the stand-in, e.g. "lognormal:0.5,0.6".
+    """
+    global backend
+    if spec == "openai":
+        backend = OpenAIBackend()
+    elif spec.startswith("scripted:"):
+        from tool.llm_backend import ScriptedBackend
+
+        backend = ScriptedBackend(spec[len("scripted:") :], latency=latency)
+    else:
+        raise ValueError(f"backend: {spec} is not supported.")
+    logger.info(f"LLM backend: {spec}")
+
+
+@retry(**_retry_policy)
+def chatgpt(**kwargs):
+    """
+    kwargs: see `_chat_request`.
+    cache_salt: extra part of the cache key, e.g. the retry attempt.
+    """
+    request = _chat_request(**kwargs)
+    if llm_cache is not None:
+        cache_key = llm_cache.key(request, salt=kwargs.get("cache_salt"))
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    def _acquire():
+        scheduler.acquire(
+            tokens=estimate_request_tokens(request) if scheduler.tokens else 0
+        )
 
+    _acquire()
+    if hedger is not None:
+        response = hedger.run(
+            functools.partial(backend.chat, request), request, before_hedge=_acquire
+        )
+    else:
+        response = backend.chat(request)
+    if llm_cache is not None:
+        llm_cache.put(cache_key, response)
+    return response
 
-thread_local = threading.local()
 
+@retry(**_retry_policy)
+async def achatgpt(**kwargs):
+    """
+    Async variant of `chatgpt`, for the event-loop runner.
+    """
+    request = _chat_request(**kwargs)
+    if llm_cache is not None:
+        cache_key = llm_cache.key(request, salt=kwargs.get("cache_salt"))
+        cached = await asyncio.to_thread(llm_cache.get, cache_key)
+        if cached is not None:
+            return cached
+
+    async def _aacquire():
+        await scheduler.aacquire(
+            tokens=estimate_request_tokens(request) if scheduler.tokens else 0
+        )
 
-def get_sqlite_client():
-    if not hasattr(thread_local, "cache_sql_client"):
-        os.makedirs("database/cache_vector_query", exist_ok=True)
-        cache_db_path = "database/cache_vector_query/local_cache.db"
-        thread_local.cache_sql_client = sqlite3.connect(cache_db_path)
-        cursor = thread_local.cache_sql_client.cursor()
-        cursor.execute(
-            """CREATE TABLE IF NOT EXISTS vec_cache (
-                name TEXT PRIMARY KEY,
-                vec TEXT NOT NULL
-            );"""
+    await _aacquire()
+    if hedger is not None:
+        response = await hedger.arun(
+            functools.partial(backend.achat, request), request, before_hedge=_aacquire
         )
-        thread_local.cache_sql_client.commit()
-    return thread_local.cache_sql_client
+    else:
+        response = await backend.achat(request)
+    if llm_cache is not None:
+        await asyncio.to_thread(llm_cache.put, cache_key, response)
+    return response
 
 
-def get_vec_cache(name):
-    sql_client = get_sqlite_client()
-    cursor = sql_client.cursor()
-    cursor.execute(
-        """SELECT vec FROM vec_cache WHERE name=?;""",
-        (name,),
-    )
-    res = cursor.fetchone()
-    if res:
-        return json.loads(res[0])
-    return None
+# embedding vectors, see tool/vec_cache.py, opened on first use.
+vec_cache = None
 
 
-def insert_vec_cache(name, vec):
-    sql_client = get_sqlite_client()
-    cursor = sql_client.cursor()
-    if get_vec_cache(name):
-        return
-    if not isinstance(vec, str):
-        vec = json.dumps(vec)
-    cursor.execute(
-        """INSERT INTO vec_cache (name, vec) VALUES (?, ?);""",
-        (name, vec),
-    )
-    sql_client.commit()
+def get_vec_cache():
+    global vec_cache
+    if vec_cache is None:
+        from tool.vec_cache import VecCache
+
+        vec_cache = VecCache("database/cache_vector_query/local_cache.db")
+    return vec_cache
 
 
-@retry(wait=wait_fixed(5), stop=stop_after_attempt(2))
 def get_embedding(
     text: str,
     model="text-embedding-3-small",
@@ -119,17 +458,10 @@ def get_embedding(
     assert (
         model in OPENAI_EMBEDDING_MODELS
     ), f"model {model} not in {OPENAI_EMBEDDING_MODELS}"
-    text_unikey = text + model
-    res = get_vec_cache(text_unikey)
-    if res:
-        assert type(res) == list
-        return res
-    res = client.embeddings.create(input=[text], model=model).data[0].embedding
-    insert_vec_cache(text_unikey, res)
-    return res
+    return get_embedding_batch([text], model=model)[0]
 
 
-@retry(wait=wait_fixed(5), stop=stop_after_attempt(2))
+@retry(**_retry_policy)
 def get_embedding_batch(
     texts: List[str],
     model="text-embedding-3-small",
@@ -137,22 +469,18 @@ def get_embedding_batch(
     assert (
         model in OPENAI_EMBEDDING_MODELS
     ), f"model {model} not in {OPENAI_EMBEDDING_MODELS}"
-    unseen_texts: List[str] = []
-    for text in texts:
-        cache = get_vec_cache(text + model)
-        if cache is None:
-            unseen_texts.append(text)
+    cache = get_vec_cache()
+    found = cache.get_many(model, texts)
+    unseen_texts: List[str] = [t for t in dict.fromkeys(texts) if t not in found]
 
     if unseen_texts:
-        req = client.embeddings.create(input=unseen_texts, model=model)
+        with _lease() as _client:
+            req = _client.embeddings.create(input=unseen_texts, model=model)
         vec_batch = [i.embedding for i in req.data]
         assert len(vec_batch) == len(unseen_texts)
-        for unseen_text, vec in zip(unseen_texts, vec_batch):
-            insert_vec_cache(unseen_text + model, vec)
+        found.update(cache.put_many(model, dict(zip(unseen_texts, vec_batch))))
 
-    res = [get_vec_cache(text + model) for text in texts]
-    assert None not in res
-    return res
+    return [found[text] for text in texts]
 
 
 chatgpt_tok = None
@@ -168,6 +496,14 @@ def chatgpt_tokenize(text):
     return res
 
 
+def count_tokens_batch(texts: List[str]):
+    """
+    Token count of each text, through the bounded cache of `_count_tokens`
+    that the dialogs use as well.
+    """
+    return [_count_tokens(t) for t in texts]
+
+
 embedding_tok = None
 
 
@@ -0,0 +1,76 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Refills `rate_per_min` units per minute, holds at most one minute's worth.
+    Reservations are debited immediately and may drive the balance negative,
+    the caller then waits until the debt is refilled.
+    """
+
+    def __init__(self, rate_per_min: float) -> None:
+        self.capacity = float(rate_per_min)
+        self.rate = self.capacity / 60.0
+        self.balance = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        """
+        Return: seconds to wait before `amount` is available.
+        """
+        self.balance = min(
+            self.capacity, self.balance + (now - self.updated) * self.rate
+        )
+        self.updated = now
+        # a single request larger than the bucket would never fit.
+        self.balance -= min(amount, self.capacity)
+        if self.balance >= 0:
+            return 0.0
+        return -self.balance / self.rate
+
+
+class RateLimiter:
+    """
+    Shared scheduler for an OpenAI-style RPM/TPM quota.
+
+    limiter = RateLimiter(rpm=500, tpm=300000)
+    limiter.acquire(tokens=1200)  # blocks until both buckets allow it
+    limiter.block_for(20)  # e.g. on a 429 with `Retry-After: 20`
+    """
+
+    def __init__(self, rpm: float = None, tpm: float = None) -> None:
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._blocked_until - now)
+            if self.requests:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens and tokens:
+                wait = max(wait, self.tokens.reserve(tokens, now))
+        return wait
+
+    def acquire(self, tokens: int = 0) -> float:
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self, tokens: int = 0) -> float:
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def block_for(self, seconds: float):
+        """
+        Hold back every caller for `seconds`, e.g. after a 429.
+        """
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
@@ -0,0 +1,80 @@
+import os
+import threading
+from collections import OrderedDict
+
+from loguru import logger
+
+
+class ToolRegistry:
+    """
+    Thread-safe LRU cache of per-(dataset, db) tools.
+
+    registry = ToolRegistry(maxsize=64)
+    tools = registry.get(("spider", "academic"), build)  # build() runs once per key
+    `release`, if given, is called when the entry is evicted, to drop the state
+    `build` left outside the entry. Prefer keeping such state in the entry
+    itself: a dialog may still be using an evicted entry, and its state is then
+    freed when the last reference goes.
+    """
+
+    def __init__(self, maxsize=64) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._building = {}  # key -> lock, one build per key at a time
+        self._release = {}  # key -> callback on eviction
+        self._lock = threading.Lock()
+
+    def get(self, key, build, release=None):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            key_lock = self._building.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # another thread may have built it while we waited.
+            with self._lock:
+                if key in self._items:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return self._items[key]
+            value = build()
+            released = []
+            with self._lock:
+                self.misses += 1
+                self._items[key] = value
+                if release is not None:
+                    self._release[key] = release
+                while len(self._items) > self.maxsize:
+                    evicted, _ = self._items.popitem(last=False)
+                    logger.debug(f"ToolRegistry evict: {evicted}")
+                    released.append(self._release.pop(evicted, None))
+                self._building.pop(key, None)
+        # outside the lock, a callback may take its own locks.
+        for callback in released:
+            if callback is not None:
+                callback()
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            released = list(self._release.values())
+            self._release.clear()
+        for callback in released:
+            callback()
+
+    def info(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._items),
+                "maxsize": self.maxsize,
+            }
+
+
+registry = ToolRegistry(maxsize=int(os.environ.get("TOOL_REGISTRY_SIZE", 64)))
@@ -0,0 +1,230 @@
+import atexit
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from glob import glob
+
+from loguru import logger
+
+from tool import spans, sqlite_wal
+from tool.jsonl import AppendLog
+from tool.manifest import get_manifest
+from utils import save_to_json
+
+"""
+Where finished dialogs are stored, see `set_result_sink`.
+
+    "json": `{save_dir}/{id}.json`, one indented file per dialog (the original layout).
+    "jsonl": `{save_dir}/results/{pid}-{n}.jsonl`, one shard per writer process,
+        rotated at `SHARD_BYTES`, fsync once per batch.
+    "sqlite": `{save_dir}/results.db` in WAL mode, one commit per batch.
+
+`put` only enqueues: a background thread per sink writes whatever has queued
+up as one batch, then records the batch in the manifest (tool/manifest.py),
+so the manifest never lists a result that is not on disk.
+`read_results(save_dir)` reads any of the layouts back.
+"""
+
+SHARD_BYTES = 256 * 1024**2
+
+sink_kind = "json"
+_sinks = {}
+_lock = threading.Lock()
+
+
+def set_result_sink(kind="json"):
+    global sink_kind
+    assert kind in SINKS, f"result sink: {kind} is not supported."
+    sink_kind = kind
+    logger.info(f"Result sink: {kind}")
+
+
+def get_sink(save_dir):
+    with _lock:
+        if save_dir not in _sinks:
+            _sinks[save_dir] = SINKS[sink_kind](save_dir)
+        return _sinks[save_dir]
+
+
+def flush_sinks():
+    """
+    Block until every queued result is written, e.g. before a worker returns.
+    """
+    with _lock:
+        sinks = list(_sinks.values())
+    for sink in sinks:
+        sink.flush()
+
+
+atexit.register(flush_sinks)
+
+
+class ResultSink:
+    """
+    sink = get_sink(save_dir)
+    sink.put(d, status="ok")
+    sink.flush()
+    """
+
+    def __init__(self, save_dir) -> None:
+        self.save_dir = save_dir
+        self.manifest = get_manifest(save_dir)
+        os.makedirs(save_dir, exist_ok=True)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def put(self, d: dict, status="ok"):
+        self._queue.put((d, status))
+
+    def flush(self):
+        self._queue.join()
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with spans.span(
+                    "save", **{"sink": sink_kind, "save.batch_size": len(batch)}
+                ):
+                    paths = self._write([d for d, _ in batch])
+                    for (d, status), path in zip(batch, paths):
+                        self.manifest.add(
+                            d["id"],
+                            status=status,
+                            model=d.get("model_name"),
+                            note=os.path.basename(self.save_dir),
+                            path=path,
+                        )
+            except Exception as e:
+                # not in the manifest, so a rerun redoes them.
+                logger.error(f"Failed to write {len(batch)} results: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch):
+        """
+        Return: where each result of `batch` went.
+        """
+        raise NotImplementedError
+
+
+class JsonFileSink(ResultSink):
+    def _write(self, batch):
+        paths = []
+        for d in batch:
+            path = f"{self.save_dir}/{d['id']}.json"
+            save_to_json(d, path)
+            paths.append(path)
+        return paths
+
+
+class JsonlSink(ResultSink):
+    def __init__(self, save_dir) -> None:
+        self._log = None
+        self._shard = 0
+        super().__init__(save_dir)
+
+    def _open(self):
+        while True:
+            path = f"{self.save_dir}/results/{os.getpid()}-{self._shard}.jsonl"
+            if not os.path.exists(path) or os.path.getsize(path) < SHARD_BYTES:
+                break
+            self._shard += 1
+        self._log = AppendLog(path, fsync=True)
+
+    def _write(self, batch):
+        if self._log is None or self._log.size() >= SHARD_BYTES:
+            if self._log is not None:
+                self._log.close()
+                self._shard += 1
+            self._open()
+        self._log.write(*batch)
+        return [self._log.path] * len(batch)
+
+
+class SqliteSink(ResultSink):
+    def __init__(self, save_dir) -> None:
+        self.path = f"{save_dir}/results.db"
+        self._conn = None  # owned by the writer thread
+        super().__init__(save_dir)
+
+    def _write(self, batch):
+        if self._conn is None:
+            self._conn = _connect_results_db(self.path)
+        t = time.time()
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO results (id, data, time) VALUES (?, ?, ?);",
+            [
+                (str(d["id"]), json.dumps(d, ensure_ascii=False, default=str), t)
+                for d in batch
+            ],
+        )
+        self._conn.commit()
+        return [self.path] * len(batch)
+
+
+def _connect_results_db(path):
+    conn = sqlite_wal.connect(path, timeout=60)
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS results (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            time REAL NOT NULL
+        );"""
+    )
+    conn.commit()
+    return conn
+
+
+SINKS = {"json": JsonFileSink, "jsonl": JsonlSink, "sqlite": SqliteSink}
+
+
+def iter_results(save_dir):
+    """
+    Yield (path, result) from every layout found in `save_dir`, later writes
+    of an id come after earlier ones within a layout.
+    """
+    for p in sorted(glob(f"{save_dir}/*.json")):
+        with open(p, encoding="utf-8") as f:
+            yield p, json.load(f)
+    for p in sorted(glob(f"{save_dir}/results/*.jsonl")):
+        with open(p, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield p, json.loads(line)
+                except json.JSONDecodeError:
+                    # a torn last line of a crashed writer.
+                    continue
+    p = f"{save_dir}/results.db"
+    if os.path.exists(p):
+        conn = sqlite3.connect(p, timeout=60)
+        try:
+            for (data,) in conn.execute("SELECT data FROM results ORDER BY time;"):
+                yield p, json.loads(data)
+        finally:
+            conn.close()
+
+
+def read_results(save_dir):
+    """
+    Return: {id: result}, the last one per id.
+    """
+    return {d["id"]: d for _, d in iter_results(save_dir)}
+
+
+def has_results(save_dir):
+    return bool(
+        glob(f"{save_dir}/*.json")
+        or glob(f"{save_dir}/results/*.jsonl")
+        or os.path.exists(f"{save_dir}/results.db")
+    )
@@ -0,0 +1,202 @@
+import contextlib
+import contextvars
+import json
+import os
+import time
+from collections import defaultdict
+
+from loguru import logger
+
+from tool.jsonl import AppendLog
+
+"""
+Span-level timing of a run, see `set_spans`.
+
+Every LLM request, tool call, pool queue wait, dialog and result write is a
+span, one JSON line each in the shape of an OTLP span (attributes flattened):
+    {"traceId": "..", "spanId": "..", "parentSpanId": "..", "name": "tool",
+     "kind": "SPAN_KIND_INTERNAL", "startTimeUnixNano": .., "endTimeUnixNano": ..,
+     "attributes": {"dialog.id": .., "db_id": "concert_singer", "round": 2,
+                    "tool.name": "ExecuteSQL", "outcome": "empty"},
+     "status": {"code": "STATUS_CODE_OK"},
+     "resource": {"service.name": "interactive-text-to-sql", "dataset": "spider-dev"}}
+The spans of one dialog share its traceId. Children inherit the attributes of
+their parent (dialog.id, db_id, round, ...).
+
+Report p50/p95/p99 latency per dataset and span / tool:
+    python -m tool.spans report trace/spans.jsonl
+"""
+
+exporter = None
+_current = contextvars.ContextVar("span", default=None)
+
+
+def set_spans(path, **resource):
+    """
+    resource: attributes of the whole run, e.g. dataset="spider-dev".
+    """
+    global exporter
+    exporter = SpanExporter(
+        path, resource={"service.name": "interactive-text-to-sql", **resource}
+    )
+    logger.info(f"Spans: {path}")
+
+
+class SpanExporter:
+    def __init__(self, path, resource: dict) -> None:
+        self.path = path
+        self.resource = resource
+        self._log = AppendLog(path)
+
+    def export(self, span: "Span"):
+        record = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "parentSpanId": span.parent_id,
+            "name": span.name,
+            "kind": span.kind,
+            "startTimeUnixNano": span.start,
+            "endTimeUnixNano": span.end,
+            "attributes": span.attributes,
+            "status": span.status,
+            "resource": self.resource,
+        }
+        self._log.write(record)
+
+
+class Span:
+    def __init__(self, name, kind="SPAN_KIND_INTERNAL", parent=None, **attributes):
+        self.name = name
+        self.kind = kind
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = {**(parent.attributes if parent else {}), **attributes}
+        self.status = {"code": "STATUS_CODE_OK"}
+        self.start = time.time_ns()
+        self.end = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class _NoopSpan:
+    def set(self, **attributes):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+@contextlib.contextmanager
+def span(name, kind="SPAN_KIND_INTERNAL", **attributes):
+    """
+    with span("tool", **{"tool.name": "ExecuteSQL"}) as s:
+        ...
+        s.set(outcome="ok")
+    An exception marks the span as failed and is re-raised.
+    """
+    if exporter is None:
+        yield _NOOP
+        return
+    s = Span(name, kind=kind, parent=_current.get(), **attributes)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.status = {"code": "STATUS_CODE_ERROR", "message": repr(e)}
+        s.attributes.setdefault("outcome", "error")
+        raise
+    finally:
+        _current.reset(token)
+        s.end = time.time_ns()
+        exporter.export(s)
+
+
+def annotate(**attributes):
+    """
+    Set attributes on the current span, the spans opened under it from now on
+    inherit them (e.g. the round of a dialog).
+    """
+    s = _current.get()
+    if s is not None:
+        s.set(**attributes)
+
+
+def record(name, start, end, parent=None, **attributes):
+    """
+    A span that already happened, times in ns since the epoch.
+    parent: the current span if None.
+    """
+    if exporter is None:
+        return
+    s = Span(name, parent=parent or _current.get(), **attributes)
+    s.start, s.end = start, end
+    exporter.export(s)
+
+
+def queued(func, name="queue", **attributes):
+    """
+    Wrap `func` before handing it to a pool: a span under the current one
+    covers the time from now until the pool starts it.
+    """
+    if exporter is None:
+        return func
+    parent, t = _current.get(), time.time_ns()
+
+    def wrapper(*args, **kwargs):
+        record(name, t, time.time_ns(), parent=parent, **attributes)
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile of sorted `values`.
+    """
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+
+def report(path):
+    """
+    Latency per dataset and span name (tool spans per tool name).
+    """
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                s = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            attributes = s.get("attributes", {})
+            dataset = s.get("resource", {}).get("dataset") or attributes.get(
+                "dataset", "-"
+            )
+            name = s["name"]
+            if name == "tool":
+                name = f"tool:{attributes.get('tool.name')}"
+            key = (dataset, name)
+            latencies[key].append((s["endTimeUnixNano"] - s["startTimeUnixNano"]) / 1e9)
+            if s.get("status", {}).get("code") == "STATUS_CODE_ERROR":
+                errors[key] += 1
+
+    print(
+        f"{'dataset':<16} {'span':<24} {'count':>7} {'err':>5} "
+        f"{'p50':>8} {'p95':>8} {'p99':>8} {'total':>9}"
+    )
+    for (dataset, name), values in sorted(latencies.items()):
+        values.sort()
+        print(
+            f"{dataset:<16} {name:<24} {len(values):>7} {errors[(dataset, name)]:>5} "
+            f"{percentile(values, 50):>8.3f} {percentile(values, 95):>8.3f} "
+            f"{percentile(values, 99):>8.3f} {sum(values):>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    # python -m tool.spans report trace/spans.jsonl
+    import fire
+
+    fire.Fire({"report": report})
@@ -7,7 +7,7 @@ from tool.utils import (
     extract_table_alias,
     extract_where_clause,
 )
-from utils import timeout
+from utils import deadline_exceeded, timeout
 
 
 def create_execute_sql(db, _hint=True):
@@ -23,6 +23,14 @@ def create_execute_sql(db, _hint=True):
         nonlocal FLAG
         return FLAG
 
+    def set_alias_flag():
+        nonlocal FLAG_table_alias
+        FLAG_table_alias = False
+
+    def get_alias_flag():
+        nonlocal FLAG_table_alias
+        return FLAG_table_alias
+
     @timeout(100)
     def execute_sql(sql, str_mode=True):
         sql = sql.strip()
@@ -62,6 +70,8 @@ def create_execute_sql(db, _hint=True):
 
         connection = sqlite3.connect(db_file)
         connection.text_factory = lambda b: b.decode(errors="ignore")
+        # abort the query once the caller's deadline has passed.
+        connection.set_progress_handler(lambda: int(deadline_exceeded()), 10000)
         cursor = connection.cursor()
 
         nonlocal FLAG
@@ -84,14 +94,17 @@ def create_execute_sql(db, _hint=True):
                     )
                 ):
                     result += " (Hint: DOUBLE-CHECK the columns in the SELECT clause, do not select irrelevant columns, and the order of the columns must strictly match the requirements of the question. Re-call ExecuteSQL function if necessary.)"
-            cursor.close()
             return result
         except Exception as e:
-            cursor.close()
             return str(e)
+        finally:
+            cursor.close()
+            connection.close()
 
     execute_sql.set_flag = set_flag
     execute_sql.get_flag = get_flag
+    execute_sql.set_alias_flag = set_alias_flag
+    execute_sql.get_alias_flag = get_alias_flag
 
     return execute_sql
 
@@ -1,12 +1,13 @@
+import functools
 import os
 import pickle
 import sqlite3
 from glob import glob
 from typing import List, Union
 
-import networkx as nx
 from loguru import logger
 
+from tool.action_parser import parse_literal
 from tool.openai_api import get_embedding_batch
 from tool.utils import get_foreign_keys, get_tables, init_chroma_client, is_dict
 from utils import read_json
@@ -17,15 +18,21 @@ COL_VEC_PKL_FILE = "database/cache_vector_db/spider_cols_tb_name_3_large.pkl"
 # -------------------------- search column -------------------------- #
 
 
+@functools.lru_cache()
+def load_spider_dbs():
+    paths = glob("dataset/spider/test_database/*")
+    dbs = [os.path.basename(p).replace(".json", "") for p in paths]
+    dbs.sort()
+    return dbs
+
+
 def create_column_searcher(db):
     """
     column_searcher = create_column_searcher("your_db_name", "path_to_col_vec_pkl_file")
     results = column_searcher("your_query", topk=5)
     print(results)
     """
-    paths = glob("dataset/spider/test_database/*")
-    dbs = [os.path.basename(p).replace(".json", "") for p in paths]
-    dbs.sort()
+    dbs = load_spider_dbs()
     assert db in dbs, f"db `{db}` not found in {dbs}"
 
     chroma_client = init_chroma_client(name="spider")
@@ -75,7 +82,7 @@ def create_column_searcher(db):
                 if "statistics" in metadata:
                     _vd = metadata["statistics"]
                     if is_dict(_vd):
-                        _vd = list(eval(_vd).keys())
+                        _vd = list(parse_literal(_vd).keys())
                         _vd = f"categorical field. {_vd}"
                         if len(_vd) > 400:
                             _vd = _vd[:400] + f"...(Omit {len(_vd) - 400} chars)"
@@ -128,38 +135,39 @@ class GraphSearcher:
         self._nx_tmp_dir = ".tmp/nx/spider"
         os.makedirs(self._nx_cache_dir, exist_ok=True)
         os.makedirs(self._nx_tmp_dir, exist_ok=True)
-        self._node_pair_to_edge = {}  # {db: {(n1,n2):edge, ...}, db2:...}
-        self._G = {}  # {db: nx.Graph}
 
-    def _make_node_pair(self, db: str, G: nx.Graph):
-        if db not in self._node_pair_to_edge:
-            self._node_pair_to_edge[db] = {}
-            for edge in G.edges(data=True):
-                start, end, data = edge
-                self._node_pair_to_edge[db][(start, end)] = data["label"]
-                self._node_pair_to_edge[db][(end, start)] = data["label"]
+    @staticmethod
+    def _make_node_pair(G: "nx.Graph"):
+        node_pair_to_edge = {}  # {(n1,n2):edge, ...}
+        for edge in G.edges(data=True):
+            start, end, data = edge
+            node_pair_to_edge[(start, end)] = data["label"]
+            node_pair_to_edge[(end, start)] = data["label"]
+        return node_pair_to_edge
 
     def _get_sqlite_file(self, db: str):
         p = f"{self.database_dir}/{db}/{db}.sqlite"
         assert os.path.exists(p), f"Database {db} not found in {self.database_dir}"
         return p
 
-    def _make_graph(self, db, force_tag=False):
+    def load_graph(self, db, force_tag=False):
         """
         Nodes: table, column
         Edges:
             1. in table: table -> column
             2. between tables: table -> ref_table
+        Return: (G, {(n1,n2):edge, ...}). Not kept by the searcher, the path
+            finder of `db` holds it and it goes with the finder (see
+            tool/registry.py), also while calls of the finder are running.
         """
-        if db in self._G and not force_tag:
-            return
+        assert db in self.dbs_name, f"Database {db} not found in {self.database_dir}"
+        import networkx as nx
 
         # load cache if exists
         if os.path.exists(f"{self._nx_cache_dir}/{db}.gpickle") and not force_tag:
             with open(f"{self._nx_cache_dir}/{db}.gpickle", "rb") as f:
                 G = pickle.load(f)
-            self._make_node_pair(db, G)
-            self._G[db] = G
+            return G, self._make_node_pair(G)
 
         conn = sqlite3.connect(self._get_sqlite_file(db))
         cursor = conn.cursor()
@@ -204,8 +212,7 @@ class GraphSearcher:
 
         with open(f"{self._nx_cache_dir}/{db}.gpickle", "wb") as f:
             pickle.dump(G, f, pickle.HIGHEST_PROTOCOL)
-        self._make_node_pair(db, G)
-        self._G[db] = G
+        return G, self._make_node_pair(G)
 
     def find_shortest_path(
         self,
@@ -213,13 +220,15 @@ class GraphSearcher:
         start: Union[str, List[str]],
         end: Union[str, List[str]],
         debug=False,
+        graph=None,
     ):
         """
+        graph: `load_graph(db)`, loaded here if not given (or debug).
         return:
             [("t1.c1","t5.c5", " xx <-> xx"), ...]
         """
-        assert db in self.dbs_name, f"Database {db} not found in {self.database_dir}"
-        self._make_graph(db, force_tag=debug)
+        if graph is None or debug:
+            graph = self.load_graph(db, force_tag=debug)
 
         if isinstance(start, str):
             start = [start]
@@ -232,14 +241,16 @@ class GraphSearcher:
         res = []
         for s in start:
             for e in end:
-                r = self._find_shortest_path(db, s, e, debug)
+                r = self._find_shortest_path(graph, db, s, e, debug)
                 res.append((s, e, r))
         if len(res) == 1:
             res = res[0][2]
         return res
 
-    def _find_shortest_path(self, db: str, start: str, end: str, debug=False):
-        G = self._G[db]
+    def _find_shortest_path(self, graph, db: str, start: str, end: str, debug=False):
+        import networkx as nx
+
+        G, node_pair_to_edge = graph
         if start not in G.nodes:
             err = f"Error. Node {start} not found in {db}."
             return err
@@ -250,7 +261,7 @@ class GraphSearcher:
         try:
             path = nx.shortest_path(G, source=start, target=end)
             node_pairs = [(path[i], path[i + 1]) for i in range(len(path) - 1)]
-            edges = [self._node_pair_to_edge[db][node_pair] for node_pair in node_pairs]
+            edges = [node_pair_to_edge[node_pair] for node_pair in node_pairs]
             res = " <-> ".join(edges)
             res = res.replace("Col: ", "").replace("FK: ", "")
             # res = f"Shortest path from {start} to {end}: {' -> '.join(path)}"
@@ -306,17 +317,23 @@ class GraphSearcher:
         return res
 
 
-g_searcher = GraphSearcher(database_dir="dataset/spider/test_database")
+@functools.lru_cache()
+def get_searcher():
+    # built on first use, not at import.
+    return GraphSearcher(database_dir="dataset/spider/test_database")
 
 
 def create_path_finder(db: str):
-    global g_searcher
-    g_searcher.find_shortest_path(db=db, start="!@#$%^", end="!@#$%^")
+    g_searcher = get_searcher()
+    # owned by the finder, freed with it.
+    graph = g_searcher.load_graph(db)
 
     def _find_shortest_path(
         start: Union[str, List[str]], end: Union[str, List[str]], debug=False
     ):
-        return g_searcher.find_shortest_path(db=db, start=start, end=end, debug=debug)
+        return g_searcher.find_shortest_path(
+            db=db, start=start, end=end, debug=debug, graph=graph
+        )
 
     return _find_shortest_path
 
@@ -324,15 +341,19 @@ def create_path_finder(db: str):
 # -------------------------- search value -------------------------- #
 
 
+@functools.lru_cache()
+def load_db_has_text_filed_list():
+    return set(read_json("preprocess/spider_db_has_text_filed_list.json"))
+
+
 def create_value_searcher(db):
     """
     db_has_text_filed_list: Output by preprocess/spider_db_indexing_es.py
     """
-    db_has_text_filed_list = read_json("preprocess/spider_db_has_text_filed_list.json")
-    if db in db_has_text_filed_list:
-        from tool.client_es import ESClient
+    if db in load_db_has_text_filed_list():
+        from tool.client_es import get_es_client
 
-        es_client = ESClient()
+        es_client = get_es_client()
         FLAG_GO = True
     else:
         FLAG_GO = False
@@ -0,0 +1,43 @@
+import os
+import sqlite3
+import threading
+
+"""
+sqlite files shared by the threads and processes of a run (the LLM, tool and
+embedding caches, the sqlite result sink): WAL mode, so readers never block
+the writer, and synchronous=NORMAL, a commit is durable once the WAL is
+checkpointed (it survives a crash of the process, not a power loss).
+"""
+
+
+def connect(path, timeout=30):
+    """
+    Return: a connection to `path` in WAL mode, its directory created.
+    timeout: seconds to wait for the write lock of another connection.
+    """
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=timeout)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    return conn
+
+
+class ThreadConnections:
+    """
+    One connection to `path` per thread, a sqlite connection must not be
+    shared across threads.
+
+    conn = ThreadConnections(path)()  # the connection of the calling thread
+    """
+
+    def __init__(self, path, timeout=30) -> None:
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def __call__(self):
+        if not hasattr(self._local, "conn"):
+            self._local.conn = connect(self.path, timeout=self.timeout)
+        return self._local.conn
@@ -0,0 +1,150 @@
+import time
+
+"""
+Streaming chat completions with an early cut-off.
+
+The model often keeps writing after its `Action: Tool(...)` line, until
+`max_tokens` or a stop word. `StreamCollector` assembles the chunks of a
+streamed completion and reports when every choice holds a complete action,
+so the backend can close the stream and the tool can start right away.
+"""
+
+ACTION_TOOLS = ["SearchColumn", "SearchValue", "FindShortestPath", "ExecuteSQL", "Done"]
+
+
+class ActionCutoff:
+    """
+    Incremental check for a complete `Action: Tool(...)` or `Action: Done`.
+
+    cutoff = ActionCutoff()
+    for delta in deltas:
+        if cutoff.feed(delta):
+            break
+    cutoff.text  # everything up to the closing `)` of the action
+    """
+
+    def __init__(self) -> None:
+        self.text = ""
+        self.done = False
+        self._state = "action"  # action -> tool -> args
+        self._pos = 0  # where the next scan starts
+        self._depth = 0
+        self._quote = None
+        self._escape = False
+
+    def feed(self, delta: str) -> bool:
+        if self.done:
+            return True
+        self.text += delta
+
+        if self._state == "action":
+            idx = self.text.find("Action:", self._pos)
+            if idx == -1:
+                # "Action:" may be split across chunks.
+                self._pos = max(0, len(self.text) - len("Action:"))
+                return False
+            self._pos = idx + len("Action:")
+            self._state = "tool"
+
+        if self._state == "tool":
+            rest = self.text[self._pos :]
+            starts = [(rest.find(t), t) for t in ACTION_TOOLS]
+            starts = [(i, t) for i, t in starts if i != -1]
+            if not starts:
+                return False
+            idx, tool = min(starts)
+            if tool == "Done":
+                self.text = self.text[: self._pos + idx + len("Done")]
+                self.done = True
+                return True
+            paren = rest.find("(", idx + len(tool))
+            if paren == -1:
+                return False
+            self._pos += paren + 1
+            self._depth = 1
+            self._state = "args"
+
+        # args: match parentheses outside of string literals.
+        for i in range(self._pos, len(self.text)):
+            c = self.text[i]
+            if self._escape:
+                self._escape = False
+            elif c == "\\":
+                self._escape = True
+            elif self._quote:
+                if c == self._quote:
+                    self._quote = None
+            elif c in "'\"":
+                self._quote = c
+            elif c == "(":
+                self._depth += 1
+            elif c == ")":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.text = self.text[: i + 1]
+                    self.done = True
+                    return True
+        self._pos = len(self.text)
+        return False
+
+
+class StreamCollector:
+    """
+    Assembles `chat.completions` chunks into one response dict.
+
+    collector = StreamCollector(request)
+    for chunk in stream:
+        if collector.add(chunk):  # every choice has a complete action
+            break
+    response = collector.response()  # "usage" is missing if cut off
+    """
+
+    def __init__(self, request: dict, start: float = None) -> None:
+        self.request = request
+        self.start = start or time.time()
+        self.ttft = None
+        self.id = None
+        self.usage = None
+        n = request.get("n") or 1
+        self._choices = [ActionCutoff() for _ in range(n)]
+        self._finish = [None] * n
+
+    def add(self, chunk) -> bool:
+        self.id = self.id or chunk.id
+        if chunk.usage is not None:
+            self.usage = chunk.usage.model_dump()
+        for choice in chunk.choices:
+            delta = choice.delta.content if choice.delta else None
+            if delta:
+                if self.ttft is None:
+                    self.ttft = time.time() - self.start
+                if self._choices[choice.index].feed(delta):
+                    self._finish[choice.index] = self._finish[choice.index] or "cutoff"
+            if choice.finish_reason:
+                self._finish[choice.index] = choice.finish_reason
+        return all(c.done for c in self._choices)
+
+    @property
+    def cutoff(self):
+        return "cutoff" in self._finish
+
+    def response(self):
+        response = {
+            "id": self.id,
+            "object": "chat.completion",
+            "model": self.request["model"],
+            "choices": [
+                {
+                    "index": i,
+                    "message": {"role": "assistant", "content": c.text},
+                    "finish_reason": self._finish[i] or "cutoff",
+                }
+                for i, c in enumerate(self._choices)
+            ],
+            "ttft": self.ttft,
+            "latency": time.time() - self.start,
+            "cutoff": self.cutoff,
+        }
+        if self.usage is not None:
+            response["usage"] = self.usage
+        return response
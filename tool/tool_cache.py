@@ -0,0 +1,201 @@
+import functools
+import hashlib
+import inspect
+import json
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from loguru import logger
+
+from tool.sqlite_wal import ThreadConnections
+
+"""
+Cross-question cache of tool results.
+
+Questions on the same database keep issuing the same `SearchColumn("name")`,
+`SearchValue(...)` and `FindShortestPath(...)` calls, and spider-dev/-syn/
+-realistic/-dk share their databases. A result is keyed by
+(dataset, db, tool, normalized args, fingerprint), where the fingerprint
+covers the database file and the index the tool reads (chroma collection,
+ES index, schema graph), so a rebuilt index never serves stale results.
+
+Two tiers: an in-memory LRU per process over a sqlite file (WAL mode) shared
+by every process and run.
+"""
+
+# optional, see `set_tool_cache`.
+tool_cache = None
+
+
+def set_tool_cache(path="database/cache_tool/tool_cache.db", maxsize=100000):
+    global tool_cache
+    tool_cache = ToolCache(path=path, maxsize=maxsize) if path else None
+    logger.info(f"Tool cache: {path}")
+
+
+def file_fingerprint(*paths):
+    """
+    Return: a digest of the size and mtime of `paths`, missing ones included.
+    """
+    parts = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            parts.append(f"{p}:{st.st_size}:{st.st_mtime_ns}")
+        except FileNotFoundError:
+            parts.append(f"{p}:-")
+    return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+class ToolCache:
+    """
+    cache = ToolCache("database/cache_tool/tool_cache.db")
+    key = cache.key(("spider", "academic", "SearchColumn"), {"query": "name"}, fp)
+    result = cache.get(key, tool="SearchColumn")  # None on miss
+    cache.put(key, result)
+    """
+
+    def __init__(self, path="database/cache_tool/tool_cache.db", maxsize=100000):
+        self.path = path
+        self.maxsize = maxsize
+        self.stats = Counter()  # (tool, "memory" | "disk" | "miss") -> count
+        self._items = OrderedDict()
+        self._conn = ThreadConnections(path)
+        self._lock = threading.Lock()
+        conn = self._conn()
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS tool_cache (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                created REAL NOT NULL
+            );"""
+        )
+        conn.commit()
+
+    @staticmethod
+    def key(namespace, args: dict, fingerprint: str):
+        payload = json.dumps(
+            [list(namespace), args, fingerprint],
+            sort_keys=True,
+            ensure_ascii=False,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._items[key] = result
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def get(self, key, tool=None):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.stats[(tool, "memory")] += 1
+                return self._items[key]
+        rows = (
+            self._conn()
+            .execute("SELECT result FROM tool_cache WHERE key=?;", (key,))
+            .fetchall()
+        )
+        if not rows:
+            with self._lock:
+                self.stats[(tool, "miss")] += 1
+            return None
+        result = json.loads(rows[0][0])
+        self._remember(key, result)
+        with self._lock:
+            self.stats[(tool, "disk")] += 1
+        return result
+
+    def put(self, key, result):
+        self._remember(key, result)
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO tool_cache (key, result, created) VALUES (?, ?, ?);",
+            (key, json.dumps(result, ensure_ascii=False), time.time()),
+        )
+        conn.commit()
+
+    def info(self):
+        """
+        Return: {tool: {"memory": .., "disk": .., "miss": .., "hit_rate": ..}}
+        """
+        with self._lock:
+            stats = dict(self.stats)
+        res = {}
+        for (tool, tier), count in sorted(stats.items(), key=str):
+            res.setdefault(tool, {"memory": 0, "disk": 0, "miss": 0})[tier] = count
+        for r in res.values():
+            total = r["memory"] + r["disk"] + r["miss"]
+            r["hit_rate"] = round((r["memory"] + r["disk"]) / total, 4) if total else 0
+        return res
+
+
+def _lower_strip(value):
+    if isinstance(value, str):
+        return value.strip().lower()
+    if isinstance(value, list):
+        return [_lower_strip(v) for v in value]
+    return value
+
+
+def _node_set(value):
+    if isinstance(value, str):
+        value = [value]
+    if isinstance(value, list) and all(isinstance(v, str) for v in value):
+        return sorted(set(value))
+    return value
+
+
+# tool -> {argument: normalize}, the normalization the tool applies itself
+# (SearchColumn strips and lowercases its queries, FindShortestPath takes a set
+# of nodes), so that "Name" and " name" share one entry.
+NORMALIZE = {
+    "SearchColumn": {"query": _lower_strip},
+    "FindShortestPath": {"start": _node_set, "end": _node_set},
+}
+
+
+def cached_tool(func, namespace, fingerprint):
+    """
+    Wrap a tool so that its results go through `tool_cache` when it is set.
+    namespace: (dataset, db, tool name).
+    fingerprint: () -> str, evaluated once on the first cached call.
+    Only `str` results are cached, i.e. what the dialog sees (str_mode=True).
+    The arguments are normalized by NORMALIZE[tool] first, for the key and the
+    call alike.
+    """
+    signature = inspect.signature(func)
+    fingerprint = functools.lru_cache(maxsize=None)(fingerprint)
+    tool = namespace[-1]
+    normalize = NORMALIZE.get(tool, {})
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        cache = tool_cache
+        if cache is None:
+            return func(*args, **kwargs)
+        try:
+            bound = signature.bind(*args, **kwargs)
+        except TypeError:
+            # let the tool report the bad call.
+            return func(*args, **kwargs)
+        bound.apply_defaults()
+        for name, norm in normalize.items():
+            if name in bound.arguments:
+                bound.arguments[name] = norm(bound.arguments[name])
+        key = cache.key(namespace, bound.arguments, fingerprint())
+        result = cache.get(key, tool=tool)
+        if result is not None:
+            return result
+        result = func(*bound.args, **bound.kwargs)
+        if isinstance(result, str):
+            cache.put(key, result)
+        return result
+
+    return wrapper
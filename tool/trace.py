@@ -0,0 +1,124 @@
+import hashlib
+import json
+import threading
+from collections import defaultdict, deque
+
+from loguru import logger
+
+from tool.jsonl import AppendLog
+
+"""
+Record / replay of whole agent runs.
+
+A trace is a JSONL file, one line per step of a dialog, keyed by (id, attempt):
+    {"id": .., "attempt": 0, "kind": "llm", "request_hash": .., "n_messages": 5, "response": {..}, "latency": 1.2}
+    {"id": .., "attempt": 0, "kind": "tool", "action": "SearchColumn(..)", "observation": "..", "latency": 0.3}
+
+record: every LLM request/response and every tool call/observation is appended.
+replay: LLM responses are served from the trace in order, no network. Tools run
+    for real, so the tool side can be profiled alone; observations that differ
+    from the recorded ones are counted.
+"""
+
+recorder = None
+replayer = None
+
+
+def set_trace(path, mode="record"):
+    global recorder, replayer
+    if mode == "record":
+        recorder = TraceRecorder(path)
+    elif mode == "replay":
+        replayer = TraceReplayer(path)
+    else:
+        raise ValueError(f"trace mode: {mode} is not supported.")
+    logger.info(f"Trace {mode}: {path}")
+
+
+def request_hash(request: dict):
+    payload = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TraceRecorder:
+    def __init__(self, path) -> None:
+        self.path = path
+        self._log = AppendLog(path)
+
+    def write(self, record: dict):
+        self._log.write(record)
+
+    def llm(self, key, request: dict, response: dict, latency: float):
+        self.write(
+            {
+                "id": key[0],
+                "attempt": key[1],
+                "kind": "llm",
+                "request_hash": request_hash(request),
+                "n_messages": len(request["messages"]),
+                "response": response,
+                "latency": latency,
+            }
+        )
+
+    def tool(self, key, action: str, observation, latency: float):
+        self.write(
+            {
+                "id": key[0],
+                "attempt": key[1],
+                "kind": "tool",
+                "action": action,
+                "observation": str(observation),
+                "latency": latency,
+            }
+        )
+
+
+class TraceReplayer:
+    def __init__(self, path) -> None:
+        self.path = path
+        self._llm = defaultdict(deque)  # (id, attempt) -> llm records in order
+        self._tool = defaultdict(dict)  # (id, attempt) -> {action: observation}
+        self._lock = threading.Lock()
+        self.llm_replayed = 0
+        self.diverged = 0
+        self.tool_mismatch = 0
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                r = json.loads(line)
+                key = (r["id"], r["attempt"])
+                if r["kind"] == "llm":
+                    self._llm[key].append(r)
+                elif r["kind"] == "tool":
+                    self._tool[key].setdefault(r["action"], r["observation"])
+        logger.info(f"Loaded trace of {len(self._llm)} dialogs from {path}")
+
+    def ids(self):
+        return {key[0] for key in self._llm}
+
+    def llm(self, key, request: dict):
+        with self._lock:
+            if not self._llm.get(key):
+                raise KeyError(f"Trace has no more LLM responses for {key}.")
+            r = self._llm[key].popleft()
+            self.llm_replayed += 1
+            if r["request_hash"] != request_hash(request):
+                self.diverged += 1
+                logger.warning(
+                    f"Replay diverged for {key}: request #{r['n_messages']} differs."
+                )
+        return r["response"]
+
+    def check_tool(self, key, action: str, observation):
+        recorded = self._tool.get(key, {}).get(action)
+        if recorded is not None and recorded != str(observation):
+            with self._lock:
+                self.tool_mismatch += 1
+
+    def info(self):
+        with self._lock:
+            return {
+                "llm_replayed": self.llm_replayed,
+                "diverged": self.diverged,
+                "tool_mismatch": self.tool_mismatch,
+            }
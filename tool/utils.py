@@ -1,8 +1,7 @@
 import re
 import sqlite3
 
-import chromadb
-import sqlparse
+from tool.action_parser import parse_literal
 
 chroma_client = None
 
@@ -10,6 +9,8 @@ chroma_client = None
 def init_chroma_client(name):
     global chroma_client
     if chroma_client is None:
+        import chromadb
+
         chroma_client = chromadb.PersistentClient(path=f"./database/db_chroma_{name}")
     return chroma_client
 
@@ -66,6 +67,8 @@ def is_text_filed(col_type):
 
 
 def extract_where_clause(sql: str):
+    import sqlparse
+
     # Parse the SQL query
     parsed_query = sqlparse.parse(sql)
     if not parsed_query:
@@ -210,9 +213,11 @@ def extract_last_valid_sql(dialog):
             # extract sql from ExecuteSQL("...")
             pred_sql = dia["content"].split("ExecuteSQL(")[1][:-1]
             try:
-                pred_sql = eval(pred_sql)
+                pred_sql = parse_literal(pred_sql)
             except:
                 continue
+            if not isinstance(pred_sql, str):
+                continue
             if not pred_sql.startswith("SELECT * FROM"):
                 return pred_sql
             if not default_sql:
@@ -226,8 +231,7 @@ def is_dict(text):
     if "min:" in text and "max:" in text:
         return False
     try:
-        eval(text)
-        return True
+        return isinstance(parse_literal(text), dict)
     except:
         return False
 
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from array import array
+
+from loguru import logger
+
+from tool.sqlite_wal import ThreadConnections
+
+"""
+Cache of embedding vectors in one sqlite file (WAL mode), see
+`tool.openai_api.get_embedding_batch`.
+
+A vector is stored as packed float32 (12 KB for 3072 dims, JSON text took
+~5x that), keyed by sha256 of (model, text). Lookups and inserts go in
+batches: one `IN (...)` query per 500 texts, one transaction per insert batch.
+
+Caches written before this format keep the old `vec_cache` table
+(name = text + model, vec = JSON). Its rows are moved over on a miss, or all
+at once, dropping the old table and compacting the file:
+    python -m tool.vec_cache migrate database/cache_vector_query/local_cache.db
+"""
+
+BATCH = 500  # below SQLITE_MAX_VARIABLE_NUMBER of old sqlite builds
+LEGACY_TABLE = "vec_cache"
+
+
+def _key(model, text):
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).digest()
+
+
+def _pack(vec):
+    return array("f", vec).tobytes()
+
+
+def _unpack(blob):
+    return array("f", blob).tolist()
+
+
+class VecCache:
+    """
+    cache = VecCache("database/cache_vector_query/local_cache.db")
+    found = cache.get_many(model, texts)  # {text: vec}, misses absent
+    cache.put_many(model, {text: vec, ...})
+    """
+
+    def __init__(self, path="database/cache_vector_query/local_cache.db") -> None:
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._conn = ThreadConnections(path)
+        self._lock = threading.Lock()
+        conn = self._conn()
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS vec_cache_f32 (
+                key BLOB PRIMARY KEY,
+                vec BLOB NOT NULL
+            );"""
+        )
+        conn.commit()
+        self.legacy = self._has_legacy(conn)
+        if self.legacy:
+            logger.warning(
+                f"{path} has a `{LEGACY_TABLE}` table of JSON vectors, they are "
+                f"moved on a miss, or run `python -m tool.vec_cache migrate {path}`."
+            )
+
+    @staticmethod
+    def _has_legacy(conn):
+        row = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?;",
+            (LEGACY_TABLE,),
+        ).fetchone()
+        return row is not None
+
+    def get_many(self, model, texts):
+        """
+        Return: {text: vec} of the cached texts.
+        """
+        keys = {_key(model, t): t for t in dict.fromkeys(texts)}
+        conn = self._conn()
+        res = {}
+        key_list = list(keys)
+        for i in range(0, len(key_list), BATCH):
+            chunk = key_list[i : i + BATCH]
+            rows = conn.execute(
+                f"SELECT key, vec FROM vec_cache_f32 WHERE key IN ({','.join('?' * len(chunk))});",
+                chunk,
+            ).fetchall()
+            for key, blob in rows:
+                res[keys[key]] = _unpack(blob)
+        if self.legacy and len(res) < len(keys):
+            res.update(
+                self._get_legacy(model, [t for t in keys.values() if t not in res])
+            )
+        with self._lock:
+            self.hits += len(res)
+            self.misses += len(keys) - len(res)
+        return res
+
+    def _get_legacy(self, model, texts):
+        """
+        Look up texts in the old JSON table, move the ones found to the new one.
+        """
+        conn = self._conn()
+        res = {}
+        for i in range(0, len(texts), BATCH):
+            names = {t + model: t for t in texts[i : i + BATCH]}
+            try:
+                rows = conn.execute(
+                    f"SELECT name, vec FROM {LEGACY_TABLE} WHERE name IN ({','.join('?' * len(names))});",
+                    list(names),
+                ).fetchall()
+            except sqlite3.OperationalError:
+                # dropped by a migration in another process.
+                self.legacy = False
+                break
+            for name, vec in rows:
+                res[names[name]] = json.loads(vec)
+        if res:
+            self.put_many(model, res)
+        return res
+
+    def put_many(self, model, vecs: dict):
+        """
+        vecs: {text: vec}, written in one transaction.
+        Return: {text: vec} as stored (float32), what a later `get_many` returns.
+        """
+        blobs = {t: _pack(v) for t, v in vecs.items()}
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO vec_cache_f32 (key, vec) VALUES (?, ?);",
+                [(_key(model, t), b) for t, b in blobs.items()],
+            )
+        return {t: _unpack(b) for t, b in blobs.items()}
+
+    def info(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "path": self.path}
+
+
+def migrate(path="database/cache_vector_query/local_cache.db", keep_old=False):
+    """
+    Move every vector of the old JSON table to the float32 table, then drop the
+    old table and VACUUM, unless `keep_old`.
+    The model is the suffix of the old name, rows of unknown models are skipped.
+    """
+    from tool.openai_api import OPENAI_EMBEDDING_MODELS
+
+    cache = VecCache(path)
+    if not cache.legacy:
+        logger.info(f"{path}: nothing to migrate.")
+        return 0
+    conn = cache._conn()
+    # longest first: a model name may be the suffix of another one.
+    models = sorted(OPENAI_EMBEDDING_MODELS, key=len, reverse=True)
+    moved, skipped, last = 0, 0, 0
+    size = os.path.getsize(path)
+    while True:
+        chunk = conn.execute(
+            f"SELECT rowid, name, vec FROM {LEGACY_TABLE} WHERE rowid > ? ORDER BY rowid LIMIT ?;",
+            (last, BATCH),
+        ).fetchall()
+        if not chunk:
+            break
+        last = chunk[-1][0]
+        batch = []
+        for _, name, vec in chunk:
+            model = next((m for m in models if name.endswith(m)), None)
+            if model is None:
+                skipped += 1
+                continue
+            batch.append((_key(model, name[: -len(model)]), _pack(json.loads(vec))))
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO vec_cache_f32 (key, vec) VALUES (?, ?);", batch
+            )
+        moved += len(batch)
+    if not keep_old:
+        conn.execute(f"DROP TABLE {LEGACY_TABLE};")
+        conn.commit()
+        conn.execute("VACUUM;")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    logger.info(
+        f"{path}: moved {moved} vectors, skipped {skipped} of unknown models, "
+        f"{size / 1024**2:.1f} MB -> {os.path.getsize(path) / 1024**2:.1f} MB."
+    )
+    return moved
+
+
+if __name__ == "__main__":
+    # python -m tool.vec_cache migrate database/cache_vector_query/local_cache.db
+    import fire
+
+    fire.Fire({"migrate": migrate})
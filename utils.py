@@ -1,10 +1,10 @@
+import contextvars
 import functools
 import json
 import os
 import pickle
-import subprocess
+import threading
 import time
-from concurrent import futures
 from datetime import date, datetime
 from glob import glob
 from traceback import print_exc
@@ -66,10 +66,14 @@ def save_to_json(obj, path, _print=True):
             default=_set_default,
         )
     if _print:
-        res = subprocess.check_output(f"ls -lh {path}", shell=True).decode(
-            encoding="utf-8"
-        )
-        print(res)
+        print(f"{human_size(os.path.getsize(path))}\t{path}")
+
+
+def human_size(n):
+    for unit in ["B", "K", "M", "G"]:
+        if n < 1024 or unit == "G":
+            return f"{n:.1f}{unit}" if unit != "B" else f"{n}B"
+        n /= 1024
 
 
 def read_pkl(path="test.pkl"):
@@ -85,10 +89,7 @@ def save_to_pkl(obj, path, _print=True):
     with open(path, "wb") as f1:
         pickle.dump(obj, f1)
     if _print:
-        res = subprocess.check_output(f"ls -lh {path}", shell=True).decode(
-            encoding="utf-8"
-        )
-        print(res)
+        print(f"{human_size(os.path.getsize(path))}\t{path}")
 
 
 def read_jsonl(path="test.jsonl", desc="", max_instances=None, _id_to_index_key=False):
@@ -118,10 +119,7 @@ def save_to_jsonl(obj, path, _print=True):
         for line in obj:
             f1.write(json.dumps(line, ensure_ascii=False) + "\n")
     if _print:
-        res = subprocess.check_output(f"ls -lh {path}", shell=True).decode(
-            encoding="utf-8"
-        )
-        print(res)
+        print(f"{human_size(os.path.getsize(path))}\t{path}")
 
 
 def get_filename(path):
@@ -173,14 +171,80 @@ def colorful(text, color="yellow"):
     return text
 
 
+# ------------------------ deadline ------------------------ #
+
+# absolute `time.monotonic()` deadline of the innermost `timeout` scope.
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+def remaining_time(default=None):
+    """
+    Seconds left before the current deadline, `default` if no deadline is set.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return default
+    return max(0.0, deadline - time.monotonic())
+
+
+def deadline_exceeded():
+    deadline = _deadline.get()
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def check_deadline():
+    """
+    Cooperative cancellation point: raise TimeoutError once the deadline has passed.
+    """
+    if deadline_exceeded():
+        raise TimeoutError("Deadline exceeded.")
+
+
 def timeout(seconds):
-    executor = futures.ThreadPoolExecutor(1)
+    """
+    Enforce a per-call wall-clock limit.
+
+    Each call runs in its own short-lived daemon thread, so concurrent callers
+    never queue behind each other and nothing outlives the call itself.
+    The deadline is propagated to the callee (see `remaining_time` and
+    `check_deadline`) and nested scopes only ever shrink it, so a timed-out
+    call stops at its next cancellation point instead of running on.
+    The caller gets the TimeoutError right away, but the thread is not killed:
+    it keeps running (e.g. an LLM request in flight, still billed) until that
+    cancellation point. `_dialog` checks before every LLM request.
+    seconds: the limit, or a function of the call's arguments that returns it.
+    """
 
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kw):
-            future = executor.submit(func, *args, **kw)
-            return future.result(timeout=seconds)
+            limit = seconds(*args, **kw) if callable(seconds) else seconds
+            deadline = time.monotonic() + limit
+            outer = _deadline.get()
+            if outer is not None:
+                deadline = min(deadline, outer)
+
+            ctx = contextvars.copy_context()
+            ctx.run(_deadline.set, deadline)
+            res = {}
+
+            def target():
+                try:
+                    res["value"] = func(*args, **kw)
+                except BaseException as e:
+                    res["error"] = e
+
+            t = threading.Thread(
+                target=ctx.run, args=(target,), name=f"timeout-{func.__name__}"
+            )
+            t.daemon = True
+            t.start()
+            t.join(max(0.0, deadline - time.monotonic()))
+            if t.is_alive():
+                raise TimeoutError(f"{func.__name__} timed out after {limit}s.")
+            if "error" in res:
+                raise res["error"]
+            return res["value"]
 
         return wrapper
 